@@ -0,0 +1,311 @@
+"""Офлайн-бэктест сигналов по правилам бота.
+
+Сайзинг как в /new_trade (risk_amount / stop_distance, округление qty/цен
+вниз до step/tick), лимиты как в check_limits (дневная/недельная просадка в %
+от депо, max сделок в сутки, UTC), отчёт как в /report и equity как в /equity.
+
+Исход каждой сделки (какой уровень и на каком баре сработал) от размера
+позиции не зависит, поэтому TP/SL ищутся векторно по всем сигналам сразу,
+а последовательный проход по событиям с депо и лимитами — дешёвый O(сигналов).
+
+Пример:
+    python backtest.py --signals signals.csv --klines BTCUSDT=btc_1m.csv \\
+        --depo 1000 --risk 1 --grid risk=0.5,1,2 daily=3,5 --equity-png equity.png
+
+signals.csv: time,symbol,entry,tp,sl (time — ISO или unix ms).
+Свечи: CSV в формате выгрузки Binance (open_time,open,high,low,close,volume,...)
+или Parquet с такими же колонками; рядом кэшируется .npy для memory-map.
+"""
+import os
+import csv
+import heapq
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import numpy as np
+
+KLINE_COLUMNS = ["open_time", "open", "high", "low", "close", "volume"]
+T, O, H, L, C, V = range(6)
+
+# ---------------- Данные ----------------
+def _to_ms(value: str) -> int:
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+def load_klines(path: str) -> np.ndarray:
+    """Свечи (n, 6) float64 через memory-map: CSV/Parquet один раз конвертируются в .npy."""
+    cache = os.path.splitext(path)[0] + ".npy"
+    if not os.path.exists(cache) or os.path.getmtime(cache) < os.path.getmtime(path):
+        if path.endswith(".parquet"):
+            import pyarrow.parquet as pq
+            table = pq.read_table(path, columns=KLINE_COLUMNS)
+            arr = np.column_stack([table.column(c).to_numpy().astype(np.float64) for c in KLINE_COLUMNS])
+        else:
+            with open(path) as f:
+                header = not f.readline().split(",")[0].strip().isdigit()
+            arr = np.loadtxt(path, delimiter=",", usecols=range(6), skiprows=int(header), dtype=np.float64)
+        arr = arr[np.argsort(arr[:, T], kind="stable")]
+        np.save(cache, arr)
+    return np.load(cache, mmap_mode="r")
+
+def load_signals(path: str) -> dict:
+    """signals.csv -> колонки numpy, отсортированные по времени."""
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    rows.sort(key=lambda r: _to_ms(r["time"]))
+    return {
+        "time": np.array([_to_ms(r["time"]) for r in rows], dtype=np.int64),
+        "symbol": np.array([r["symbol"].upper() for r in rows]),
+        "entry": np.array([float(r["entry"]) for r in rows]),
+        "tp": np.array([float(r["tp"]) for r in rows]),
+        "sl": np.array([float(r["sl"]) for r in rows]),
+    }
+
+# ---------------- TP/SL ----------------
+def resolve_exits(klines: np.ndarray, time, entry, tp, sl, intrabar: str = "sl",
+                  window: int = 1024, batch: int = 2048):
+    """Для каждого сигнала: индекс бара выхода (-1 — не вышли) и признак TP.
+
+    Поиск с первого бара, открывшегося не раньше сигнала, окнами по window
+    баров на пачку сигналов. Если в одном баре задеты оба уровня, решает
+    intrabar: sl (пессимистично), tp, или open — уровень, ближайший к open бара.
+    """
+    n, nbars = len(time), len(klines)
+    exit_bar = np.full(n, -1, dtype=np.int64)
+    is_tp = np.zeros(n, dtype=bool)
+    short = tp < entry
+    start = np.searchsorted(klines[:, T], time, side="left")
+    offs = np.arange(window)
+    for b0 in range(0, n, batch):
+        idx = np.arange(b0, min(b0 + batch, n))
+        pos = start[idx]
+        while idx.size:
+            bars = pos[:, None] + offs
+            valid = bars < nbars
+            bars = np.minimum(bars, nbars - 1)
+            hi, lo = klines[bars, H], klines[bars, L]
+            s = short[idx][:, None]
+            tp_i, sl_i = tp[idx][:, None], sl[idx][:, None]
+            hit_tp = valid & np.where(s, lo <= tp_i, hi >= tp_i)
+            hit_sl = valid & np.where(s, hi >= sl_i, lo <= sl_i)
+            any_hit = hit_tp | hit_sl
+            found = any_hit.any(axis=1)
+            first = any_hit.argmax(axis=1)
+            rows = np.nonzero(found)[0]
+            fb = bars[rows, first[rows]]
+            both = hit_tp[rows, first[rows]] & hit_sl[rows, first[rows]]
+            win = hit_tp[rows, first[rows]] & ~both
+            if intrabar == "tp":
+                win |= both
+            elif intrabar == "open":
+                op = klines[fb, O]
+                win |= both & (np.abs(op - tp[idx[rows]]) < np.abs(op - sl[idx[rows]]))
+            exit_bar[idx[rows]] = fb
+            is_tp[idx[rows]] = win
+            # не найденные и ещё не упёршиеся в конец данных — следующее окно
+            more = ~found & (pos + window < nbars)
+            idx, pos = idx[more], pos[more] + window
+    return exit_bar, is_tp
+
+def prepare(signals: dict, klines_by_symbol: dict, intrabar: str = "sl") -> dict:
+    """Исходы всех сигналов (не зависят от параметров сайзинга/лимитов)."""
+    n = len(signals["time"])
+    close_time = np.full(n, -1, dtype=np.int64)
+    exit_price = np.full(n, np.nan)
+    for symbol, kl in klines_by_symbol.items():
+        m = np.nonzero(signals["symbol"] == symbol)[0]
+        if not m.size:
+            continue
+        bar, win = resolve_exits(kl, signals["time"][m], signals["entry"][m],
+                                 signals["tp"][m], signals["sl"][m], intrabar)
+        ok = bar >= 0
+        close_time[m[ok]] = kl[bar[ok], T].astype(np.int64)
+        exit_price[m[ok]] = np.where(win[ok], signals["tp"][m[ok]], signals["sl"][m[ok]])
+    return dict(signals, close_time=close_time, exit=exit_price)
+
+# ---------------- Прогон с депо и лимитами ----------------
+def _floor(value: float, step: float) -> float:
+    if not step:
+        return value
+    d, s = Decimal(str(value)), Decimal(str(step))
+    return float((d // s) * s)
+
+def _day_week(ms: int):
+    dt = datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+    day = dt.date()
+    return day, day - timedelta(days=dt.weekday())
+
+def run(prepared: dict, depo: float, risk: float, daily: float = 5, weekly: float = 15,
+        max_trades: int = 20, step: float = 0.0, tick: float = 0.0) -> dict:
+    """Последовательный проход: открытия по времени сигналов, закрытия из кучи по close_time."""
+    pnl_day, pnl_week, trades_day = {}, {}, {}
+    pending = []  # (close_time, i, pnl)
+    taken, closed = [], []
+    start_depo = depo
+
+    def settle_until(t):
+        nonlocal depo
+        while pending and pending[0][0] <= t:
+            ct, i, pnl = heapq.heappop(pending)
+            depo += pnl
+            d, w = _day_week(ct)
+            pnl_day[d] = pnl_day.get(d, 0.0) + pnl
+            pnl_week[w] = pnl_week.get(w, 0.0) + pnl
+            closed.append((ct, i, pnl))
+
+    for i in range(len(prepared["time"])):
+        t = int(prepared["time"][i])
+        settle_until(t)
+        if depo <= 0 or risk <= 0:
+            continue
+        d, w = _day_week(t)
+        if pnl_day.get(d, 0.0) / depo * 100.0 <= -abs(daily):
+            continue
+        if pnl_week.get(w, 0.0) / depo * 100.0 <= -abs(weekly):
+            continue
+        if trades_day.get(d, 0) >= int(max_trades):
+            continue
+        entry = _floor(prepared["entry"][i], tick)
+        tp, sl = _floor(prepared["tp"][i], tick), _floor(prepared["sl"][i], tick)
+        stop_distance = abs(entry - sl)
+        if stop_distance <= 0:
+            continue
+        qty = _floor(depo * (risk / 100.0) / stop_distance, step)
+        if qty <= 0:
+            continue
+        trades_day[d] = trades_day.get(d, 0) + 1
+        taken.append(i)
+        ct = int(prepared["close_time"][i])
+        if ct >= 0:
+            direction = -1 if tp < entry else 1
+            exit_price = _floor(prepared["exit"][i], tick)
+            heapq.heappush(pending, (ct, i, (exit_price - entry) * qty * direction))
+    settle_until(np.iinfo(np.int64).max)
+    return summarize(closed, len(taken), start_depo, depo)
+
+def summarize(closed: list, total: int, start_depo: float, depo: float) -> dict:
+    """Метрики как в /report + кривая equity как в /equity."""
+    pnl = np.array([p for _, _, p in closed], dtype=np.float64)
+    equity = np.cumsum(pnl)
+    wins, losses = pnl[pnl > 0], pnl[pnl <= 0]
+    peak = np.maximum.accumulate(np.concatenate([[0.0], equity]))[1:] if pnl.size else pnl
+    gross_loss = float(losses.sum())
+    return {
+        "total_trades": total,
+        "closed_trades": int(pnl.size),
+        "wins": int(wins.size),
+        "losses": int(losses.size),
+        "winrate_%": float(wins.size / pnl.size * 100.0) if pnl.size else 0.0,
+        "total_pnl": float(pnl.sum()),
+        "avg_win": float(wins.mean()) if wins.size else 0.0,
+        "avg_loss": float(losses.mean()) if losses.size else 0.0,
+        "profit_factor": float(wins.sum() / -gross_loss) if gross_loss < 0 else float("inf"),
+        "expectancy": float(pnl.mean()) if pnl.size else 0.0,
+        "max_drawdown": float((peak - equity).max()) if pnl.size else 0.0,
+        "start_depo": start_depo,
+        "final_depo": depo,
+        "equity": [(ct, float(e)) for (ct, _, _), e in zip(closed, equity)],
+    }
+
+def sweep(prepared: dict, base: dict, grid: dict, workers: int = None) -> list:
+    """Перебор сетки параметров в пуле процессов; prepared считается один раз."""
+    keys = list(grid)
+    combos = [dict(base, **dict(zip(keys, vals))) for vals in itertools.product(*grid.values())]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run, prepared, **params) for params in combos]
+        return [(params, f.result()) for params, f in zip(combos, futures)]
+
+# ---------------- Вывод ----------------
+def format_report(s: dict) -> str:
+    return ("📊 Отчёт (бэктест)\n"
+            f"Всего: {s['total_trades']} | Закрыто: {s['closed_trades']}\n"
+            f"🏆 {s['wins']} | ❌ {s['losses']} | Winrate: {s['winrate_%']:.2f}%\n"
+            f"💵 Total PnL: {s['total_pnl']:.2f}\n"
+            f"📈 Avg Win: {s['avg_win']:.2f} | 📉 Avg Loss: {s['avg_loss']:.2f}\n"
+            f"⚖️ Profit factor: {s['profit_factor']:.2f} | Expectancy: {s['expectancy']:.2f}\n"
+            f"📉 Max drawdown: {s['max_drawdown']:.2f}\n"
+            f"💰 Депозит: {s['start_depo']:.2f} → {s['final_depo']:.2f} USDT")
+
+def save_equity(s: dict, path: str):
+    """equity.csv (closed_at, cum_pnl) или PNG в стиле /equity."""
+    rows = [(datetime.fromtimestamp(ct / 1000, tz=timezone.utc).replace(tzinfo=None), e) for ct, e in s["equity"]]
+    if path.endswith(".png"):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=(7, 4.5))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        ax.plot([r[0] for r in rows], [r[1] for r in rows], marker="o")
+        ax.set_title("Equity Curve (Cumulative PnL)")
+        ax.set_xlabel("Дата")
+        ax.set_ylabel("USDT")
+        ax.grid(True)
+        fig.tight_layout()
+        fig.savefig(path)
+        return
+    with open(path, "w", newline="") as f:
+        w = csv.writer(f, lineterminator="\n")
+        w.writerow(["closed_at", "cum_pnl"])
+        w.writerows((dt.isoformat(" "), e) for dt, e in rows)
+
+def _parse_grid(items) -> dict:
+    grid = {}
+    for item in items or []:
+        key, _, vals = item.partition("=")
+        cast = int if key == "max_trades" else float
+        grid[key] = [cast(v) for v in vals.split(",")]
+    return grid
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--signals", required=True)
+    ap.add_argument("--klines", nargs="+", required=True, metavar="SYMBOL=PATH")
+    ap.add_argument("--depo", type=float, default=1000)
+    ap.add_argument("--risk", type=float, default=1)
+    ap.add_argument("--daily", type=float, default=5)
+    ap.add_argument("--weekly", type=float, default=15)
+    ap.add_argument("--max-trades", type=int, default=20)
+    ap.add_argument("--step", type=float, default=0.0, help="LOT_SIZE.stepSize")
+    ap.add_argument("--tick", type=float, default=0.0, help="PRICE_FILTER.tickSize")
+    ap.add_argument("--intrabar", choices=["sl", "tp", "open"], default="sl")
+    ap.add_argument("--grid", nargs="*", metavar="PARAM=V1,V2", help="risk, daily, weekly, max_trades")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--equity-csv")
+    ap.add_argument("--equity-png")
+    args = ap.parse_args()
+
+    klines = {}
+    for item in args.klines:
+        symbol, _, path = item.partition("=")
+        klines[symbol.upper()] = load_klines(path)
+    prepared = prepare(load_signals(args.signals), klines, args.intrabar)
+    base = dict(depo=args.depo, risk=args.risk, daily=args.daily, weekly=args.weekly,
+                max_trades=args.max_trades, step=args.step, tick=args.tick)
+
+    grid = _parse_grid(args.grid)
+    if grid:
+        results = sweep(prepared, base, grid, args.workers)
+        results.sort(key=lambda r: r[1]["total_pnl"], reverse=True)
+        for params, s in results:
+            shown = " ".join(f"{k}={params[k]}" for k in grid)
+            print(f"{shown}: PnL={s['total_pnl']:.2f} WR={s['winrate_%']:.1f}% "
+                  f"PF={s['profit_factor']:.2f} DD={s['max_drawdown']:.2f} trades={s['total_trades']}")
+        return
+
+    s = run(prepared, **base)
+    print(format_report(s))
+    if args.equity_csv:
+        save_equity(s, args.equity_csv)
+    if args.equity_png:
+        save_equity(s, args.equity_png)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+"""Офлайн-бенчмарки бота: биржа — FakeClient, Telegram — fake_telegram.py.
+
+bot.py импортируется в этот же процесс, апдейты идут через dp.process_update,
+ответы уходят на фейковый Bot API, поднятый тут же. База — во временном
+каталоге. Лимиты Outbox и вес Binance подняты, чтобы мерить сам бот, а не
+чужие лимиты; любую переменную окружения бота можно задать снаружи.
+
+Примеры:
+    python bench.py new_trade --users 200 --latency 0.05
+    python bench.py storage --users 5000 --trades 5
+    python bench.py report --rows 10000 100000 1000000
+    python bench.py webhook --workers 1 2 4 --users 500 --messages 4
+    python bench.py dispatch --users 100 --messages 200
+    python bench.py archive --rows 10000000 --users 100 --days 30
+    python bench.py --json imports.jsonl imports --runs 10   # на каждый релиз
+    python bench.py new_trade --users 200 --json bench.jsonl   # строка результата в файл
+
+new_trade — N юзеров одновременно шлют /new_trade: задержка хендлера
+(p50/p95/p99) и лаг event loop с планировщиком биржи и без него
+(blocking — REST прямо в loop, как до ExchangeScheduler).
+storage — тысячи юзеров одновременно: профиль, сделки, закрытия и чтения
+через DBWriter/пул читателей; group commit против коммита на операцию.
+report — /report одного юзера, пока его история растёт до 1M сделок, рядом
+с полным чтением истории, которое /report делал раньше (df_user_trades).
+webhook — bot.py отдельным процессом в BOT_MODE=webhook на 1, 2, 4...
+воркерах: фейковый Telegram шлёт апдейты на webhook, считаем ответы в секунду
+и задержку от апдейта до ответа. Генератор нагрузки и приём ответов живут в
+этом процессе — на многих воркерах упор может оказаться в нём.
+dispatch — сообщений в секунду через dp.process_update: обычный текст вне
+мастера ключей (ни один хендлер не срабатывает — чистая стоимость роутера)
+и /help с ответом.
+archive — /report, /equity (без кэша) и /export_csv по большой истории:
+сначала всё в SQLite, потом после переноса старых сделок в Parquet (нужен pyarrow).
+imports — время `import bot` в чистом процессе (min/медиана по запускам), какие
+тяжёлые модули подгрузились сразу, и топ прямых импортов bot.py по -X importtime.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import random
+import argparse
+import subprocess
+import tempfile
+import importlib
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+from fake_telegram import FakeTelegram, make_update
+
+BENCH_ENV = {
+    "TG_TOKEN": "123456:ABCdefGhIJKlmnoPQRstuVWXyz012345678",
+    "EXCHANGE_BACKEND": "fake",
+    "OUTBOX_GLOBAL_RATE": "1000000",
+    "OUTBOX_CHAT_RATE": "1000000",
+    "BINANCE_WEIGHT_LIMIT": "1000000000",
+    "METRICS_WINDOW": "1000000",
+}
+NEW_TRADE = "/new_trade BTCUSDT 30000 32000 29000"
+SYMBOLS = ("BTCUSDT", "ETHUSDT", "BNBUSDT", "SOLUSDT", "XRPUSDT")
+
+# ---------------- Общее ----------------
+def bench_env(workdir: str, **extra) -> dict:
+    """Окружение бота: BENCH_ENV (если не задано снаружи), база в workdir, extra поверх."""
+    env = {k: os.environ.get(k, v) for k, v in BENCH_ENV.items()}
+    env.update(DB_PATH=os.path.join(workdir, "trades.db"), ARCHIVE_DIR=os.path.join(workdir, "archive"))
+    env.update({k: str(v) for k, v in extra.items()})
+    return env
+
+def percentiles(xs, qs=(0.5, 0.95, 0.99)) -> list:
+    xs = sorted(xs)
+    return [xs[min(int(len(xs) * q), len(xs) - 1)] for q in qs] if xs else [0.0] * len(qs)
+
+def latency_stats(xs) -> dict:
+    p50, p95, p99 = percentiles(xs)
+    return {"count": len(xs), "p50": p50, "p95": p95, "p99": p99, "max": max(xs, default=0.0)}
+
+def fmt_ms(s: dict) -> str:
+    return " ".join(f"{k}={s[k] * 1000:.1f}ms" for k in ("p50", "p95", "p99", "max"))
+
+async def start_fake_telegram(chat_rate: float = 0, global_rate: float = 0):
+    """FakeTelegram на свободном порту -> (fake, runner, base_url)."""
+    fake = FakeTelegram(chat_rate, global_rate)
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return fake, runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+class LoopLag:
+    """Фоновая задача: насколько позже положенного просыпается sleep(interval) — блокировки loop."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(loop.time() - t - self.interval, 0.0))
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+class InProcessBot:
+    """bot.py в этом процессе поверх фейкового Telegram.
+
+    async with InProcessBot(workdir, FAKE_EXCHANGE_LATENCY=0.05) as b:
+        seconds = await b.send(uid, "/help")
+    """
+
+    def __init__(self, workdir: str, **env):
+        self.workdir = workdir
+        self.env = env
+        self.update_id = 0
+
+    async def __aenter__(self):
+        self.fake, self.runner, url = await start_fake_telegram()
+        os.environ.update(bench_env(self.workdir, TG_API_SERVER=url, **self.env))
+        self.bot = B = importlib.import_module("bot")
+        B.Bot.set_current(B.bot)
+        B.Dispatcher.set_current(B.dp)
+        await B.on_startup(B.dp)
+        return self
+
+    async def __aexit__(self, *exc):
+        B = self.bot
+        if B._render_pool is not None:
+            B._render_pool.shutdown(wait=True, cancel_futures=True)
+        await (await B.bot.get_session()).close()
+        await self.runner.cleanup()
+
+    async def send(self, uid: int, text: str) -> float:
+        """Апдейт от uid через диспетчер целиком (включая доставку ответа) -> секунд."""
+        self.update_id += 1
+        update = self.bot.types.Update(**make_update(self.update_id, uid, text))
+        t = time.perf_counter()
+        # своя задача на апдейт, как в _user_chain: ctx_state aiogram не переносится
+        # с прошлого апдейта, и шаги FSM каждый раз читаются из storage
+        await asyncio.create_task(self.bot.dp.process_update(update))
+        return time.perf_counter() - t
+
+    async def auto_users(self, uids, depo: float = 1000.0):
+        await asyncio.gather(*(self.bot.set_user(uid, mode="auto", binance_api_key="k", binance_api_secret="s",
+                                                 depo=depo) for uid in uids))
+
+def fill_history(c, uid: int, n: int, days: float, seed: int = 0):
+    """n закрытых сделок uid, равномерно за последние days дней (пишется прямо в trades)."""
+    rnd = random.Random(seed)
+    now = datetime.utcnow()
+    step = timedelta(days=days) / max(n, 1)
+    def rows():
+        for i in range(n):
+            created = now - timedelta(days=days) + step * i
+            win = rnd.random() < 0.55
+            pnl = rnd.uniform(1, 30) if win else -rnd.uniform(1, 20)
+            yield (uid, SYMBOLS[i % len(SYMBOLS)], 30000.0, 32000.0, 29000.0, 0.01, "win" if win else "loss",
+                   31000.0 if win else 29500.0, pnl, created.isoformat(" ", "seconds"),
+                   (created + step / 2).isoformat(" ", "seconds"))
+    c.executemany("""INSERT INTO trades (user_id, symbol, entry, tp, sl, volume, status, exit, pnl,
+                                         created_at, closed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows())
+
+async def load_history(B, uid: int, n: int, days: float, seed: int = 0) -> float:
+    """История через писателя бота + пересчёт user_stats тем же шагом миграции -> секунд."""
+    t = time.perf_counter()
+    def op(c):
+        fill_history(c, uid, n, days, seed)
+        B._m4_user_stats(c)
+    await B.db_write(op)
+    return time.perf_counter() - t
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_for(cond, timeout: float, what: str):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"не дождались: {what}")
+        await asyncio.sleep(0.01)
+
+async def wait_port(port: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        return
+
+async def timed_repeat(fn, repeat: int) -> dict:
+    lat = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        await fn()
+        lat.append(time.perf_counter() - t)
+    return latency_stats(lat)
+
+# ---------------- new_trade ----------------
+async def _inline_call(uid: int, fn, *args, **kwargs):
+    """Как до ExchangeScheduler: блокирующий REST прямо в event loop."""
+    return fn(*args, **kwargs)
+
+async def bench_new_trade(args, workdir: str) -> dict:
+    results = {}
+    async with InProcessBot(workdir, FAKE_EXCHANGE_LATENCY=args.latency) as b:
+        B = b.bot
+        await b.auto_users([1])
+        await b.send(1, NEW_TRADE)  # прогрев: метаданные символа, клиент, пулы потоков
+        modes = ["blocking", "scheduler"] if args.mode == "both" else [args.mode]
+        for n, mode in enumerate(modes, start=1):
+            uids = range(n * 1_000_000, n * 1_000_000 + args.users)
+            await b.auto_users(uids)
+            ex_call = B.ex_call
+            if mode == "blocking":
+                B.ex_call = _inline_call
+            try:
+                with LoopLag() as lag:
+                    t = time.perf_counter()
+                    lat = await asyncio.gather(*(b.send(uid, NEW_TRADE) for uid in uids))
+                    wall = time.perf_counter() - t
+            finally:
+                B.ex_call = ex_call
+            opened = (await B.db_query("SELECT COUNT(*) FROM trades WHERE user_id BETWEEN ? AND ? AND status='open'",
+                                       (uids[0], uids[-1]), one=True))[0]
+            s = results[mode] = dict(latency_stats(lat), wall=wall, opened=opened, loop_lag_max=max(lag.lags, default=0.0))
+            print(f"{mode:>9}: {args.users} юзеров, latency={args.latency}s | {fmt_ms(s)} | "
+                  f"всё за {wall:.2f}s, открыто {opened}, лаг loop до {s['loop_lag_max'] * 1000:.0f}ms")
+    return results
+
+# ---------------- storage ----------------
+async def _storage_user(B, uid: int, trades: int, lat: dict):
+    async def timed(kind, coro):
+        t = time.perf_counter()
+        result = await coro
+        lat[kind].append(time.perf_counter() - t)
+        return result
+    await timed("write", B.set_user(uid, mode="signal", depo=1000.0))
+    ids = [await timed("write", B.save_trade(uid, "BTCUSDT", 30000.0, 32000.0, 29000.0, 0.01, status="signal_open"))
+           for _ in range(trades)]
+    for n, trade_id in enumerate(ids[::2]):
+        await timed("write", B.settle_trade(trade_id, 31000.0 if n % 2 else 29500.0))
+    await timed("read", B.db_query("SELECT trades, closed, equity FROM user_stats WHERE user_id=?", (uid,), one=True))
+    await timed("read", B.db_query("""SELECT id, symbol, status, pnl FROM trades WHERE user_id=?
+                                      ORDER BY created_at DESC LIMIT 20""", (uid,)))
+
+async def bench_storage(args, workdir: str) -> dict:
+    results = {}
+    async with InProcessBot(workdir) as b:
+        B = b.bot
+        batch_max = B.DB_BATCH_MAX
+        for n, (mode, batch) in enumerate((("group", batch_max), ("per-op", 1)), start=1):
+            B.DB_BATCH_MAX = batch  # DBWriter.run читает его на каждой пачке
+            lat = {"write": [], "read": []}
+            t = time.perf_counter()
+            await asyncio.gather(*(_storage_user(B, n * 1_000_000 + uid, args.trades, lat) for uid in range(args.users)))
+            wall = time.perf_counter() - t
+            ops = len(lat["write"]) + len(lat["read"])
+            s = results[mode] = {"ops": ops, "ops_per_sec": ops / wall, "wall": wall,
+                                 "write": latency_stats(lat["write"]), "read": latency_stats(lat["read"])}
+            print(f"{mode:>6} (DB_BATCH_MAX={batch}): {args.users} юзеров, {ops} операций за {wall:.2f}s "
+                  f"= {s['ops_per_sec']:.0f}/s\n        write {fmt_ms(s['write'])}\n        read  {fmt_ms(s['read'])}")
+        B.DB_BATCH_MAX = batch_max
+    return results
+
+# ---------------- report ----------------
+def _report_scan(c, uid: int) -> tuple:
+    """Как /report до user_stats: вся история юзера в память и подсчёт по ней."""
+    rows = c.execute("""SELECT id, symbol, entry, tp, sl, volume, status, exit, pnl, created_at, closed_at
+                        FROM trades WHERE user_id=?
+                        ORDER BY COALESCE(closed_at, created_at)""", (uid,)).fetchall()
+    closed = [r[8] or 0.0 for r in rows if r[6] in ("win", "loss")]
+    return len(rows), len(closed), sum(1 for p in closed if p > 0), sum(closed)
+
+async def bench_report(args, workdir: str) -> dict:
+    results = {}
+    uid, have = 1, 0
+    async with InProcessBot(workdir) as b:
+        B = b.bot
+        await B.set_user(uid, depo=1000.0)
+        for rows in sorted(args.rows):
+            load = await load_history(B, uid, rows - have, 365, seed=rows)
+            have = rows
+            report = await timed_repeat(lambda: b.send(uid, "/report"), args.repeat)
+            scan = await timed_repeat(lambda: B.db_read(lambda c: _report_scan(c, uid)), args.scan_repeat)
+            results[rows] = {"report": report, "scan": scan, "load": load}
+            print(f"{rows:>9} сделок (загрузка {load:.1f}s)\n   /report {fmt_ms(report)}\n"
+                  f"   scan    {fmt_ms(scan)}")
+    return results
+
+# ---------------- webhook ----------------
+async def _webhook_run(fake, url: str, workers: int, args, workdir: str) -> dict:
+    port = free_port()
+    os.makedirs(workdir, exist_ok=True)
+    env = dict(os.environ, **bench_env(workdir, TG_API_SERVER=url, BOT_MODE="webhook", BOT_WORKERS=workers,
+                                       WEBAPP_HOST="127.0.0.1", WEBAPP_PORT=port,
+                                       WEBHOOK_URL=f"http://127.0.0.1:{port}/webhook"))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    proc = await asyncio.create_subprocess_exec(sys.executable, script, env=env, stdout=asyncio.subprocess.DEVNULL)
+    answered = lambda: fake.stats()["messages"]
+    try:
+        fake.webhook = None
+        await wait_for(lambda: fake.webhook, 60, "setWebhook")
+        await wait_port(port, 30)  # setWebhook уходит из on_startup, до того как фронт слушает порт
+        # по апдейту в каждый шард: ответили все — воркеры поднялись
+        base = answered()
+        for uid in range(1, workers + 1):
+            await fake.inject(uid, "/help")
+        await wait_for(lambda: answered() >= base + workers, 60, "ответ каждого воркера")
+        total = args.users * args.messages
+        base = answered()
+        fake.latencies.clear()
+        t = time.perf_counter()
+        for _ in range(args.messages):
+            await asyncio.gather(*(fake.inject(uid, args.text) for uid in range(1, args.users + 1)))
+        await wait_for(lambda: answered() >= base + total, args.timeout, f"{total} ответов")
+        wall = time.perf_counter() - t
+    finally:
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(proc.wait(), 30)
+            except asyncio.TimeoutError:
+                proc.kill()
+    return dict(updates=total, wall=wall, per_sec=total / wall, reply=latency_stats(fake.latencies))
+
+async def bench_webhook(args, workdir: str) -> dict:
+    results = {}
+    fake, runner, url = await start_fake_telegram()
+    print(f"CPU: {os.cpu_count()} — bot.py запускает не больше воркеров, чем ядер")
+    try:
+        for workers in args.workers:
+            s = results[workers] = await _webhook_run(fake, url, workers, args, os.path.join(workdir, f"workers{workers}"))
+            print(f"BOT_WORKERS={workers}: {s['updates']} апдейтов за {s['wall']:.2f}s = {s['per_sec']:.0f}/s | "
+                  f"ответ {fmt_ms(s['reply'])}")
+    finally:
+        await runner.cleanup()
+    return results
+
+# ---------------- dispatch ----------------
+async def bench_dispatch(args, workdir: str) -> dict:
+    results = {}
+    async with InProcessBot(workdir) as b:
+        uids = range(1, args.users + 1)
+        await asyncio.gather(*(b.bot.set_user(uid, depo=1000.0) for uid in uids))
+        for kind, text in (("text", "просто текст"), ("command", "/help")):
+            async def chain(uid):  # апдейты одного юзера — по порядку, как в воркере
+                return [await b.send(uid, text) for _ in range(args.messages)]
+            t = time.perf_counter()
+            lat = [x for xs in await asyncio.gather(*(chain(uid) for uid in uids)) for x in xs]
+            wall = time.perf_counter() - t
+            s = results[kind] = dict(latency_stats(lat), wall=wall, per_sec=len(lat) / wall)
+            print(f"{kind:>7}: {len(lat)} сообщений за {wall:.2f}s = {s['per_sec']:.0f}/s | {fmt_ms(s)}")
+    return results
+
+# ---------------- archive ----------------
+async def _archive_reads(b, uid: int, repeat: int) -> dict:
+    async def equity():
+        b.bot._equity_cache.clear()
+        await b.send(uid, "/equity")
+    return {"report": await timed_repeat(lambda: b.send(uid, "/report"), repeat),
+            "equity": await timed_repeat(equity, repeat),
+            "export_csv": await timed_repeat(lambda: b.send(uid, "/export_csv"), repeat)}
+
+async def bench_archive(args, workdir: str) -> dict:
+    results = {}
+    async with InProcessBot(workdir) as b:
+        B = b.bot
+        if B._arrow() is None:
+            sys.exit("archive: нужен pyarrow")
+        per_user = args.rows // args.users
+        t = time.perf_counter()
+        def op(c):
+            for uid in range(1, args.users + 1):
+                fill_history(c, uid, per_user, args.history_days, seed=uid)
+            B._m4_user_stats(c)
+        await B.db_write(op)
+        print(f"{per_user * args.users} сделок у {args.users} юзеров за {args.history_days} дней "
+              f"(загрузка {time.perf_counter() - t:.1f}s), меряем юзера 1: {per_user} сделок")
+        results["hot"] = await _archive_reads(b, 1, args.repeat)
+        t = time.perf_counter()
+        moved = await B.archive_old_trades(args.days)
+        results["archive"] = {"rows": moved, "seconds": time.perf_counter() - t}
+        print(f"в архив старше {args.days} дней: {moved} сделок за {results['archive']['seconds']:.1f}s")
+        results["cold"] = await _archive_reads(b, 1, args.repeat)
+        for name in results["hot"]:
+            print(f"{name:>10}  SQLite  {fmt_ms(results['hot'][name])}\n"
+                  f"{'':>10}  архив   {fmt_ms(results['cold'][name])}")
+    return results
+
+# ---------------- imports ----------------
+HEAVY_MODULES = ("matplotlib", "binance", "openpyxl", "pandas", "pyarrow", "requests", "numpy")
+_IMPORT_PROBE = f"""
+import sys, time, json
+t = time.perf_counter()
+import bot
+print(json.dumps({{"seconds": time.perf_counter() - t,
+                  "loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+
+async def bench_imports(args, workdir: str) -> dict:
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, **bench_env(workdir))
+    runs = [json.loads(subprocess.run([sys.executable, "-c", _IMPORT_PROBE], cwd=here, env=env, check=True,
+                                      capture_output=True, text=True).stdout.splitlines()[-1])
+            for _ in range(args.runs)]
+    seconds = sorted(r["seconds"] for r in runs)
+    trace = subprocess.run([sys.executable, "-X", "importtime", "-c", "import bot"], cwd=here, env=env, check=True,
+                           capture_output=True, text=True).stderr
+    top = []
+    for line in trace.splitlines():  # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2][1:]  # отступ в два пробела на уровень вложенности
+        if name.startswith("  ") and not name.startswith("    "):
+            top.append((int(parts[1]), name.strip()))  # что bot.py импортирует напрямую
+    top = sorted(top, reverse=True)[:args.top]
+    results = {"min": seconds[0], "median": seconds[len(seconds) // 2], "runs": len(seconds),
+               "loaded": runs[0]["loaded"], "top": {name: us / 1e6 for us, name in top}}
+    print(f"import bot: min={results['min'] * 1000:.0f}ms median={results['median'] * 1000:.0f}ms "
+          f"({len(seconds)} запусков)")
+    print(f"тяжёлые модули при импорте: {', '.join(results['loaded']) or 'нет'}")
+    for us, name in top:
+        print(f"  {us / 1000:8.1f}ms  {name}")
+    return results
+
+# ---------------- CLI ----------------
+BENCHES = {"new_trade": bench_new_trade, "storage": bench_storage, "report": bench_report,
+           "webhook": bench_webhook, "dispatch": bench_dispatch, "archive": bench_archive,
+           "imports": bench_imports}
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--workdir", help="каталог для базы и архива (по умолчанию временный)")
+    ap.add_argument("--json", metavar="PATH", help="дописать результат строкой JSON (история по релизам)")
+    sub = ap.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("new_trade", help="p99 /new_trade при N одновременных юзерах")
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--latency", type=float, default=0.05, help="сек на каждый REST-вызов FakeClient")
+    p.add_argument("--mode", choices=["both", "scheduler", "blocking"], default="both")
+
+    p = sub.add_parser("storage", help="нагрузка на SQLite тысячами юзеров")
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--trades", type=int, default=5, help="сделок на юзера, половина закрывается")
+
+    p = sub.add_parser("report", help="латентность /report по мере роста истории")
+    p.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    p.add_argument("--repeat", type=int, default=50, help="замеров /report на каждом шаге")
+    p.add_argument("--scan-repeat", type=int, default=5, help="замеров полного чтения истории")
+
+    p = sub.add_parser("webhook", help="пропускная способность webhook по числу воркеров")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--messages", type=int, default=5, help="апдейтов от каждого юзера")
+    p.add_argument("--text", default="/report")
+    p.add_argument("--timeout", type=float, default=300)
+
+    p = sub.add_parser("dispatch", help="сообщений/с через роутер aiogram")
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--messages", type=int, default=100, help="сообщений от каждого юзера")
+
+    p = sub.add_parser("archive", help="/report, /equity, экспорт до и после архива в Parquet")
+    p.add_argument("--rows", type=int, default=1_000_000, help="сделок всего")
+    p.add_argument("--users", type=int, default=10)
+    p.add_argument("--history-days", type=float, default=730)
+    p.add_argument("--days", type=int, default=30, help="в архив — закрытые старше")
+    p.add_argument("--repeat", type=int, default=5)
+
+    p = sub.add_parser("imports", help="время импорта bot.py")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--top", type=int, default=10, help="сколько самых долгих импортов показать")
+
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp:
+        workdir = args.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+        results = asyncio.run(BENCHES[args.bench](args, workdir))
+    if args.json:
+        params = {k: v for k, v in vars(args).items() if k not in ("bench", "json", "workdir")}
+        with open(args.json, "a") as f:
+            f.write(json.dumps({"bench": args.bench, "at": datetime.utcnow().isoformat(" ", "seconds"),
+                                "python": sys.version.split()[0], "params": params, "results": results}) + "\n")
+
+if __name__ == "__main__":
+    main()
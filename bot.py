@@ -1,92 +1,617 @@
 import os
+import io
+import sys
+import csv
+import tempfile
+import json
+import time
+import random
+import bisect
+import heapq
+import logging
+import asyncio
 import sqlite3
+import queue
+import threading
+import multiprocessing
+from collections import OrderedDict, Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import accumulate
+from types import SimpleNamespace
 from datetime import datetime, timedelta, time as dtime
 from decimal import Decimal
+from typing import TYPE_CHECKING
 
-import pandas as pd
-import matplotlib.pyplot as plt
+# matplotlib, python-binance и openpyxl грузятся лениво, при первом графике /
+# обращении к бирже / выгрузке: рестарт не ждёт их импорта, а signal-only
+# боту они не нужны вовсе. numpy — при первом пересчёте портфеля, aiohttp.web —
+# только для webhook и /metrics. Backend без GUI фиксируем заранее — и для воркеров пула рендера.
+os.environ.setdefault("MPLBACKEND", "Agg")
+_IMPORT_STARTED = time.perf_counter()
+
+import aiohttp
 
 from aiogram import Bot, Dispatcher, executor, types
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.utils.exceptions import RetryAfter
+from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.handler import current_handler
 from aiogram.types import ReplyKeyboardMarkup, ReplyKeyboardRemove
 
-from binance.client import Client
-from binance.enums import SIDE_BUY, SIDE_SELL, ORDER_TYPE_MARKET
+if TYPE_CHECKING:
+    from binance.client import Client
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
+SIDE_BUY, SIDE_SELL, ORDER_TYPE_MARKET = "BUY", "SELL", "MARKET"  # значения binance.enums
 
 # =============== CONFIG (замени/используй .env) ===============
 TG_TOKEN = os.getenv("TG_TOKEN", "YOUR_TG_TOKEN")  # 🔑 токен Telegram бота (BotFather)
 REPORT_TZ_NAME = os.getenv("REPORT_TZ", "Europe/Berlin")  # для будущих отчётов/времени
+TG_API_SERVER = os.getenv("TG_API_SERVER", "")  # свой/фейковый Bot API сервер, напр. http://127.0.0.1:8081
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))  # сообщений/с на бота (лимит Telegram ~30)
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))  # сообщений/с в один чат
+OUTBOX_CHAT_MAX = int(os.getenv("OUTBOX_CHAT_MAX", "50"))  # уведомлений в очереди одного чата
+OUTBOX_MAX = int(os.getenv("OUTBOX_MAX", "10000"))  # уведомлений в очереди всего
+EXCHANGE_BACKEND = os.getenv("EXCHANGE_BACKEND", "binance")  # binance | fake (офлайн-заглушка)
+EXCHANGE_WORKERS = int(os.getenv("EXCHANGE_WORKERS", "16"))  # потоков под REST-запросы к бирже
+USER_EXCHANGE_CONCURRENCY = int(os.getenv("USER_EXCHANGE_CONCURRENCY", "2"))  # параллельных запросов на юзера
+FAKE_EXCHANGE_LATENCY = float(os.getenv("FAKE_EXCHANGE_LATENCY", "0"))  # сек, имитация задержки REST
+FAKE_EXCHANGE_PRICE = float(os.getenv("FAKE_EXCHANGE_PRICE", "30000"))
+CLIENT_CACHE_SIZE = int(os.getenv("CLIENT_CACHE_SIZE", "1000"))  # макс. закэшированных Binance клиентов
+CLIENT_IDLE_TTL = int(os.getenv("CLIENT_IDLE_TTL", "1800"))  # сек простоя до выселения клиента
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))  # keep-alive соединений на клиента
+SYMBOL_META_TTL = int(os.getenv("SYMBOL_META_TTL", "3600"))  # сек между обновлениями exchangeInfo
+MARKET_WS_URL = os.getenv("MARKET_WS_URL", "wss://stream.binance.com:9443/stream")  # combined streams
+MARKET_REPLAY_FILE = os.getenv("MARKET_REPLAY_FILE", "")  # jsonl записанных сообщений вместо сети
+MARKET_RECORD_FILE = os.getenv("MARKET_RECORD_FILE", "")  # дописывать сюда сырые сообщения стрима
+PRICE_MAX_AGE = float(os.getenv("PRICE_MAX_AGE", "5"))  # сек, до какого возраста цена из стрима годна
+OCO_POLL_SEC = float(os.getenv("OCO_POLL_SEC", "10"))  # как часто сверять OCO по сработавшим уровням
+USER_WS_URL = os.getenv("USER_WS_URL", "wss://stream.binance.com:9443/ws")  # user-data stream, + /<listenKey>
+USER_WS_TESTNET_URL = os.getenv("USER_WS_TESTNET_URL", "wss://stream.testnet.binance.vision/ws")
+USER_STREAM_KEEPALIVE = float(os.getenv("USER_STREAM_KEEPALIVE", "1800"))  # сек между продлениями listenKey
+USER_STREAM_REPLAY_FILE = os.getenv("USER_STREAM_REPLAY_FILE", "")  # jsonl {"uid", "event"} вместо сети
+USER_STREAM_RECORD_FILE = os.getenv("USER_STREAM_RECORD_FILE", "")  # дописывать сюда события user-data stream
+RECONCILE_SEC = float(os.getenv("RECONCILE_SEC", "300"))  # полная сверка открытых auto-сделок с биржей
+DB_PATH = os.getenv("DB_PATH", "trades.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))  # соединений в пуле читателей
+DB_BATCH_MAX = int(os.getenv("DB_BATCH_MAX", "256"))  # операций на один коммит писателя
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000"))  # профилей пользователей в памяти
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "2"))  # процессов под отрисовку графиков
+WARMUP_DELAY = float(os.getenv("WARMUP_DELAY", "1"))  # сек после старта до фонового прогрева импортов/пула рендера
+EQUITY_CACHE_SIZE = int(os.getenv("EQUITY_CACHE_SIZE", "1000"))  # готовых PNG equity в памяти
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))  # параллельных выгрузок CSV/XLSX
+EXPORT_SPOOL_BYTES = int(os.getenv("EXPORT_SPOOL_BYTES", str(8 * 1024 * 1024)))  # дальше буфер уходит на диск
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")  # Parquet: user_id=<id>/month=<YYYY-MM>/trades.parquet
+ARCHIVE_DAYS = int(os.getenv("ARCHIVE_DAYS", "0"))  # закрытые сделки старше — в архив (нужен pyarrow); 0 — выкл.
+ARCHIVE_EVERY = float(os.getenv("ARCHIVE_EVERY", "21600"))  # сек между проходами архиватора
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "50000"))  # сделок за одну запись/удаление
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "100"))  # сетапов в одном /bulk_trade или CSV
+ORDERS_PER_10S = int(os.getenv("ORDERS_PER_10S", "45"))  # лимит Binance 50 ордеров / 10 с на аккаунт, с запасом
+BINANCE_WEIGHT_LIMIT = int(os.getenv("BINANCE_WEIGHT_LIMIT", "6000"))  # вес запросов на IP в минуту
+RISK_VERIFY = os.getenv("RISK_VERIFY", "0") == "1"  # сверять счётчики лимитов с SQL на каждой сделке
+PORTFOLIO_SCAN_SEC = float(os.getenv("PORTFOLIO_SCAN_SEC", "5"))  # пересчёт экспозиции всех юзеров по ценам
+PORTFOLIO_RATE_TTL = float(os.getenv("PORTFOLIO_RATE_TTL", "300"))  # сек, сколько годен курс котировки из REST
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))  # процессов-обработчиков в режиме webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес для setWebhook; пусто — не трогать
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # X-Telegram-Bot-Api-Secret-Token
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+WORKER_QUEUE_MAX = int(os.getenv("WORKER_QUEUE_MAX", "10000"))  # апдейтов в очереди одного воркера
+WORKER_CHECK_SEC = float(os.getenv("WORKER_CHECK_SEC", "5"))  # как часто фронт проверяет, живы ли воркеры
+WORKER_STOP_SEC = float(os.getenv("WORKER_STOP_SEC", "10"))  # сколько воркер дорабатывает апдейты при остановке
+# у каждого воркера свой писатель SQLite, писатели ждут друг друга на локе записи
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", str(5000 * max(BOT_WORKERS, 1))))  # мс
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # /metrics для Prometheus (+ номер воркера); 0 — выкл.
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1024"))  # последних замеров на span для p50/p95/p99
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(",", " ").split()}  # кому доступен /stats
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # сек между сэмплами профилировщика
+FSM_PERSIST = os.getenv("FSM_PERSIST", "0") == "1"  # хранить шаг мастера ключей в SQLite между рестартами
 # ===============================================================
 
-bot = Bot(token=TG_TOKEN)
-dp = Dispatcher(bot)
+class FSMStorage(MemoryStorage):
+    """Состояния FSM в памяти; с FSM_PERSIST=1 каждое изменение пишется в fsm_state и поднимается при старте."""
+
+    async def load(self) -> int:
+        if not FSM_PERSIST:
+            return 0
+        rows = await db_query("SELECT chat, user, state, data FROM fsm_state WHERE user % ? = ?",
+                              (WORKER_COUNT, WORKER_INDEX))
+        for chat, user, state, data in rows:
+            await super().set_state(chat=chat, user=user, state=state)
+            await super().set_data(chat=chat, user=user, data=json.loads(data or "{}"))
+        return len(rows)
+
+    async def _persist(self, chat, user):
+        if not FSM_PERSIST:
+            return
+        chat, user = self.check_address(chat=chat, user=user)
+        state = await self.get_state(chat=chat, user=user)
+        data = await self.get_data(chat=chat, user=user)
+        if state is None and not data:
+            await db_execute("DELETE FROM fsm_state WHERE chat=? AND user=?", (chat, user))
+        else:
+            await db_execute("""INSERT INTO fsm_state (chat, user, state, data) VALUES (?, ?, ?, ?)
+                                ON CONFLICT(chat, user) DO UPDATE SET state=excluded.state, data=excluded.data""",
+                             (chat, user, state, json.dumps(data)))
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await super().set_state(chat=chat, user=user, state=state)
+        await self._persist(chat, user)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await super().set_data(chat=chat, user=user, data=data)
+        await self._persist(chat, user)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        await super().update_data(chat=chat, user=user, data=data, **kwargs)
+        await self._persist(chat, user)
+
+bot = Bot(token=TG_TOKEN, server=TelegramAPIServer.from_base(TG_API_SERVER)) if TG_API_SERVER else Bot(token=TG_TOKEN)
+dp = Dispatcher(bot, storage=FSMStorage())
+
+# Шард этого процесса: в webhook-режиме воркер держит в памяти (мониторинг,
+# лимиты, кэши) только своих юзеров, user_id % WORKER_COUNT == WORKER_INDEX.
+WORKER_INDEX, WORKER_COUNT = 0, 1
+
+# ------------------- Metrics -------------------
+# Span = имя + длительность. На span — кольцо последних METRICS_WINDOW замеров
+# (квантили считаются только при чтении) и накопительные count/sum/errors.
+class Span:
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name: str):
+        self.metrics, self.name = metrics, name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, exc_type is not None)
+
+class Metrics:
+    def __init__(self, window: int):
+        self.window = window
+        self.samples = {}  # name -> deque[сек]
+        self.totals = {}   # name -> [count, sum, errors]
+
+    def span(self, name: str) -> Span:
+        return Span(self, name)
+
+    def observe(self, name: str, seconds: float, error: bool = False):
+        q = self.samples.get(name)
+        if q is None:
+            q = self.samples[name] = deque(maxlen=self.window)
+            self.totals[name] = [0, 0.0, 0]
+        q.append(seconds)
+        t = self.totals[name]
+        t[0] += 1
+        t[1] += seconds
+        if error:
+            t[2] += 1
+
+    def quantiles(self, name: str, qs=(0.5, 0.95, 0.99)) -> list:
+        w = sorted(self.samples.get(name, ()))
+        return [w[min(int(len(w) * q), len(w) - 1)] for q in qs] if w else [0.0] * len(qs)
+
+    def prometheus(self, gauges: dict) -> str:
+        """Текст в формате Prometheus: спаны как summary, gauges — {(имя, ключ): значение}."""
+        lines = ["# TYPE bot_span_seconds summary"]
+        for name in sorted(self.samples):
+            for q, v in zip(("0.5", "0.95", "0.99"), self.quantiles(name)):
+                lines.append(f'bot_span_seconds{{span="{name}",quantile="{q}"}} {v:.6f}')
+            count, total, errors = self.totals[name]
+            lines.append(f'bot_span_seconds_sum{{span="{name}"}} {total:.6f}')
+            lines.append(f'bot_span_seconds_count{{span="{name}"}} {count}')
+            lines.append(f'bot_span_errors_total{{span="{name}"}} {errors}')
+        for (group, key), value in sorted(gauges.items()):
+            lines.append(f'bot_{group}_{key}{{worker="{WORKER_INDEX}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRICS_WINDOW)
+metrics.observe("startup.imports", _IMPORT_SECONDS)
+
+class SamplingProfiler:
+    """Сэмплирует стек потока event loop (sys._current_frames) — видно, чем занят или заблокирован loop.
+
+    Результат — collapsed stacks (формат flamegraph.pl / speedscope) и топ функций по self-time.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()  # "f1;f2;...;leaf" -> сэмплов
+        self.samples, self.started = 0, 0.0
+        self._target = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        self.stacks.clear()
+        self.samples, self.started = 0, time.monotonic()
+        self._target = threading.get_ident()  # вызывается из потока event loop
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None and len(stack) < 64:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+    def top(self, n: int = 15) -> list:
+        leaf = Counter()
+        for stack, k in self.stacks.items():
+            leaf[stack.rsplit(";", 1)[-1]] += k
+        return leaf.most_common(n)
+
+profiler = SamplingProfiler(PROFILE_INTERVAL)
+
+class TimingMiddleware(BaseMiddleware):
+    """Span на каждый обработанный хендлером message: cmd:<команда> или handler:<функция>."""
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        handler = current_handler.get()
+        cmd = message.get_command(pure=True) if message.is_command() else None
+        data["_span"] = (f"cmd:{cmd}" if cmd else f"handler:{getattr(handler, '__name__', '?')}",
+                         time.perf_counter())
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        span = data.get("_span")
+        if span:
+            metrics.observe(span[0], time.perf_counter() - span[1])
+
+dp.middleware.setup(TimingMiddleware())
 
 # ------------------- SQLite -------------------
-conn = sqlite3.connect("trades.db", check_same_thread=False)
-cur = conn.cursor()
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    mode TEXT DEFAULT 'signal',        -- signal | auto
-    binance_api_key TEXT,
-    binance_api_secret TEXT,
-    use_testnet INTEGER DEFAULT 1,     -- 1=testnet, 0=mainnet
-    depo REAL DEFAULT 0,
-    risk REAL DEFAULT 1,
-    limits_daily REAL DEFAULT 5,
-    limits_weekly REAL DEFAULT 15,
-    limits_max_trades INTEGER DEFAULT 20
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS trades (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    symbol TEXT,
-    entry REAL,
-    tp REAL,
-    sl REAL,
-    volume REAL,
-    status TEXT DEFAULT 'open',  -- open|win|loss|signal_open
-    exit REAL,
-    pnl REAL DEFAULT 0,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    closed_at TIMESTAMP
-)
-""")
-conn.commit()
+# WAL: читатели не ждут писателя. Пишет только DBWriter (одно соединение в
+# своём потоке, пачка операций = один коммит); читают соединения из пула.
+def _db_connect(readonly: bool = False) -> sqlite3.Connection:
+    c = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30, isolation_level=None)
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT}")
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute("PRAGMA cache_size=-20000")
+    c.execute("PRAGMA mmap_size=268435456")
+    if readonly:
+        c.execute("PRAGMA query_only=1")
+    return c
+
+def _m1_base(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        mode TEXT DEFAULT 'signal',        -- signal | auto
+        binance_api_key TEXT,
+        binance_api_secret TEXT,
+        use_testnet INTEGER DEFAULT 1,     -- 1=testnet, 0=mainnet
+        depo REAL DEFAULT 0,
+        risk REAL DEFAULT 1,
+        limits_daily REAL DEFAULT 5,
+        limits_weekly REAL DEFAULT 15,
+        limits_max_trades INTEGER DEFAULT 20
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS trades (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        symbol TEXT,
+        entry REAL,
+        tp REAL,
+        sl REAL,
+        volume REAL,
+        status TEXT DEFAULT 'open',  -- open|win|loss|signal_open
+        exit REAL,
+        pnl REAL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        closed_at TIMESTAMP
+    )
+    """)
+
+def _m2_oco_list_id(c):
+    if "oco_list_id" not in {r[1] for r in c.execute("PRAGMA table_info(trades)")}:
+        c.execute("ALTER TABLE trades ADD COLUMN oco_list_id INTEGER")  # orderListId OCO (auto)
+
+def _m3_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trades_user_status_closed ON trades(user_id, status, closed_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trades_user_created ON trades(user_id, created_at)")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_trades_live ON trades(status, symbol)
+                 WHERE status IN ('open','signal_open')""")
+
+def _m4_user_stats(c):
+    """Материализованная статистика для /report: обновляется при закрытии сделки."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER PRIMARY KEY,
+        trades INTEGER DEFAULT 0,          -- всего сделок
+        closed INTEGER DEFAULT 0,
+        wins INTEGER DEFAULT 0,            -- pnl > 0
+        gross_win REAL DEFAULT 0,
+        gross_loss REAL DEFAULT 0,         -- сумма pnl <= 0 (<= 0)
+        equity REAL DEFAULT 0,             -- накопленный PnL
+        peak REAL DEFAULT 0,
+        max_dd REAL DEFAULT 0              -- макс. просадка equity от пика, USDT
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS user_symbol_stats (
+        user_id INTEGER,
+        symbol TEXT,
+        closed INTEGER DEFAULT 0,
+        wins INTEGER DEFAULT 0,
+        pnl REAL DEFAULT 0,
+        PRIMARY KEY (user_id, symbol)
+    ) WITHOUT ROWID
+    """)
+    c.execute("DELETE FROM user_stats")
+    c.execute("DELETE FROM user_symbol_stats")
+    c.execute("INSERT INTO user_stats (user_id, trades) SELECT user_id, COUNT(*) FROM trades GROUP BY user_id")
+    for trade_id, pnl in c.execute("""SELECT id, pnl FROM trades WHERE status IN ('win','loss')
+                                      ORDER BY closed_at, id""").fetchall():
+        _record_close(c, trade_id, pnl or 0.0)
+
+def _m5_fills(c):
+    """Фактические исполнения (user-data stream / myTrades) и ноги OCO для сверки с биржей."""
+    cols = {r[1] for r in c.execute("PRAGMA table_info(trades)")}
+    for name, decl in (("entry_order_id", "INTEGER"),     # orderId MARKET BUY
+                       ("oco_order_ids", "TEXT"),         # orderId ног OCO через запятую
+                       ("commission", "REAL DEFAULT 0")): # комиссии сделки в валюте котировки
+        if name not in cols:
+            c.execute(f"ALTER TABLE trades ADD COLUMN {name} {decl}")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS fills (
+        symbol TEXT,
+        exec_id INTEGER,                   -- tradeId биржи
+        order_id INTEGER,
+        user_id INTEGER,
+        side TEXT,
+        price REAL,
+        qty REAL,
+        commission REAL,
+        commission_asset TEXT,
+        fee_quote REAL,                    -- комиссия в валюте котировки (0, если в третьей валюте, напр. BNB)
+        ts INTEGER,                        -- время исполнения, мс
+        PRIMARY KEY (symbol, exec_id)
+    ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_fills_order ON fills(symbol, order_id)")
+
+def _m6_fsm_state(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_state (
+        chat INTEGER,
+        user INTEGER,
+        state TEXT,
+        data TEXT,                         -- JSON
+        PRIMARY KEY (chat, user)
+    ) WITHOUT ROWID
+    """)
+
+def _m7_portfolio_limits(c):
+    """Лимиты портфеля, % от депо; 0 — выключен."""
+    cols = {r[1] for r in c.execute("PRAGMA table_info(users)")}
+    for name in ("limits_max_exposure",   # суммарный открытый notional
+                 "limits_max_asset",      # notional в одном базовом активе
+                 "limits_max_open_dd"):   # нереализованный убыток открытых сделок
+        if name not in cols:
+            c.execute(f"ALTER TABLE users ADD COLUMN {name} REAL DEFAULT 0")
+
+def _m8_trade_managed(c):
+    """Кто ведёт OCO открытой сделки: 1 — бот (Reconciler), 0 — юзер (/cancel_all),
+    2 — сделка открыта до учёта ног OCO: её живой OCO надо найти и привязать."""
+    if "managed" not in {r[1] for r in c.execute("PRAGMA table_info(trades)")}:
+        c.execute("ALTER TABLE trades ADD COLUMN managed INTEGER DEFAULT 1")
+        c.execute("UPDATE trades SET managed=2 WHERE status='open' AND oco_order_ids IS NULL")
+
+MIGRATIONS = [_m1_base, _m2_oco_list_id, _m3_indexes, _m4_user_stats, _m5_fills, _m6_fsm_state,
+              _m7_portfolio_limits, _m8_trade_managed]  # индекс + 1 = PRAGMA user_version
+
+def migrate(c: sqlite3.Connection):
+    # версию перечитываем под блокировкой: несколько процессов на одной БД
+    # не применят один шаг дважды
+    for n, step in enumerate(MIGRATIONS, start=1):
+        c.execute("BEGIN IMMEDIATE")
+        if c.execute("PRAGMA user_version").fetchone()[0] < n:
+            step(c)
+            c.execute(f"PRAGMA user_version={n}")
+        c.execute("COMMIT")
+
+class DBWriter:
+    """Единственный писатель с group commit.
+
+    Операция — функция fn(conn), выполняемая в потоке писателя. Всё, что
+    накопилось в очереди, идёт одной транзакцией (каждая операция под своим
+    SAVEPOINT, ошибка одной не откатывает соседей); await db_write()
+    возвращается только после коммита.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.conn = None
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+    def open(self):
+        self.conn = _db_connect()
+        migrate(self.conn)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < DB_BATCH_MAX and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                results = await loop.run_in_executor(self._pool, self._apply, [fn for fn, _ in batch])
+            except Exception as e:
+                results = [(False, e)] * len(batch)
+            for (_, fut), (ok, value) in zip(batch, results):
+                if fut.done():
+                    continue
+                if ok:
+                    fut.set_result(value)
+                else:
+                    fut.set_exception(value)
+
+    def _apply(self, fns):
+        c = self.conn
+        results = []
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            for fn in fns:
+                c.execute("SAVEPOINT op")
+                try:
+                    results.append((True, fn(c)))
+                    c.execute("RELEASE op")
+                except Exception as e:
+                    c.execute("ROLLBACK TO op")
+                    c.execute("RELEASE op")
+                    results.append((False, e))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        return results
+
+db_writer = DBWriter()
+_db_readers = queue.SimpleQueue()
+_db_read_pool = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="db-reader")
+
+def init_db():
+    db_writer.open()
+    for _ in range(DB_READERS):
+        _db_readers.put(_db_connect(readonly=True))
+
+async def db_write(fn):
+    fut = asyncio.get_running_loop().create_future()
+    with metrics.span("db.write"):
+        await db_writer.queue.put((fn, fut))
+        return await fut
+
+async def db_execute(sql: str, params=()) -> int:
+    """Один оператор через писателя; возвращает rowcount."""
+    return await db_write(lambda c: c.execute(sql, params).rowcount)
+
+def _with_reader(fn):
+    c = _db_readers.get()
+    try:
+        return fn(c)
+    finally:
+        _db_readers.put(c)
+
+async def db_read(fn):
+    """fn(conn) на соединении из пула читателей, вне event loop."""
+    with metrics.span("db.read"):
+        return await asyncio.get_running_loop().run_in_executor(_db_read_pool, _with_reader, fn)
+
+async def db_query(sql: str, params=(), one: bool = False):
+    def run(c):
+        cursor = c.execute(sql, params)
+        return cursor.fetchone() if one else cursor.fetchall()
+    return await db_read(run)
 
 # ------------------- Helpers -------------------
-def get_user(user_id: int):
-    cur.execute("SELECT user_id, mode, binance_api_key, binance_api_secret, use_testnet, depo, risk, limits_daily, limits_weekly, limits_max_trades FROM users WHERE user_id=?",
-                (user_id,))
-    row = cur.fetchone()
+USER_COLUMNS = ("user_id", "mode", "binance_api_key", "binance_api_secret", "use_testnet",
+                "depo", "risk", "limits_daily", "limits_weekly", "limits_max_trades",
+                "limits_max_exposure", "limits_max_asset", "limits_max_open_dd")
+USER_KEYS = ("user_id", "mode", "api_key", "api_secret", "use_testnet",
+             "depo", "risk", "limit_daily", "limit_weekly", "limit_max_trades",
+             "limit_max_exposure", "limit_max_asset", "limit_max_open_dd")
+_USER_SLOT = dict(zip(USER_COLUMNS, USER_KEYS))
+_USER_SELECT = f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id=?"
+
+class UserProfile:
+    """Настройки пользователя; u["mode"] работает как раньше со словарём."""
+    __slots__ = USER_KEYS
+
+    def __init__(self, row):
+        for k, v in zip(USER_KEYS, row):
+            setattr(self, k, v)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+class UserCache:
+    """Write-through LRU профилей: get_user без SQL, set_user пишет в БД и сюда."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.users = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, uid: int):
+        u = self.users.get(uid)
+        if u is None:
+            self.stats["misses"] += 1
+            return None
+        self.users.move_to_end(uid)
+        self.stats["hits"] += 1
+        return u
+
+    def put(self, u: UserProfile):
+        self.users[u.user_id] = u
+        self.users.move_to_end(u.user_id)
+        while len(self.users) > self.maxsize:
+            self.users.popitem(last=False)
+
+    def update(self, uid: int, **columns):
+        u = self.users.get(uid)
+        if u is not None:
+            for col, v in columns.items():
+                setattr(u, _USER_SLOT[col], v)
+
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+user_cache = UserCache(USER_CACHE_SIZE)
+
+async def get_user(user_id: int) -> UserProfile:
+    u = user_cache.get(user_id)
+    if u is not None:
+        return u
+    row = await db_query(_USER_SELECT, (user_id,), one=True)
     if not row:
-        cur.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
-        conn.commit()
-        return get_user(user_id)
-    keys = ["user_id","mode","api_key","api_secret","use_testnet","depo","risk","limit_daily","limit_weekly","limit_max_trades"]
-    return dict(zip(keys, row))
-
-def set_user(user_id: int, **kwargs):
-    fields = []
-    values = []
-    for k,v in kwargs.items():
-        fields.append(f"{k}=?")
-        values.append(v)
-    values.append(user_id)
-    cur.execute(f"UPDATE users SET {', '.join(fields)} WHERE user_id=?", values)
-    conn.commit()
-
-def _get_symbol_filters(client: Client, symbol: str):
-    info = client.get_symbol_info(symbol)
-    if not info:
-        raise ValueError(f"Символ {symbol} не найден на Binance")
-    f = {x['filterType']: x for x in info['filters']}
-    lot = Decimal(f['LOT_SIZE']['stepSize'])
-    tick = Decimal(f['PRICE_FILTER']['tickSize'])
-    return lot, tick
+        def op(c):
+            c.execute("INSERT INTO users (user_id) VALUES (?) ON CONFLICT(user_id) DO NOTHING", (user_id,))
+            return c.execute(_USER_SELECT, (user_id,)).fetchone()
+        row = await db_write(op)
+    u = UserProfile(row)
+    user_cache.put(u)
+    return u
+
+async def set_user(user_id: int, **kwargs):
+    """Все поля одним upsert'ом; кэш обновляется после коммита."""
+    cols = list(kwargs)
+    await db_execute(
+        f"INSERT INTO users (user_id, {', '.join(cols)}) VALUES (?{', ?' * len(cols)}) "
+        f"ON CONFLICT(user_id) DO UPDATE SET {', '.join(f'{k}=excluded.{k}' for k in cols)}",
+        [user_id, *kwargs.values()])
+    user_cache.update(user_id, **kwargs)
+    if kwargs.keys() & {"binance_api_key", "binance_api_secret", "use_testnet"}:
+        client_registry.invalidate(user_id)
 
 def _round_qty(qty: float, step: Decimal) -> Decimal:
     q = Decimal(str(qty))
@@ -96,39 +621,1348 @@ def _round_price(price: float, tick: Decimal) -> Decimal:
     p = Decimal(str(price))
     return (p // tick) * tick if tick != 0 else p
 
-def get_user_client(u: dict) -> Client:
-    """Создаёт Binance client c ключами пользователя (для авто‑трейда)."""
-    if not u["api_key"] or not u["api_secret"]:
-        raise RuntimeError("Не заданы Binance API ключи.")
-    return Client(u["api_key"], u["api_secret"], testnet=bool(u["use_testnet"]))
-
-def user_get_price(client: Client, symbol: str) -> float:
+def user_get_price(client: "Client", symbol: str) -> float:
     return float(client.get_symbol_ticker(symbol=symbol)['price'])
 
-def user_get_balance(client: Client, asset: str="USDT") -> float:
+def user_get_balance(client: "Client", asset: str="USDT") -> float:
     bal = client.get_asset_balance(asset=asset)
     return float(bal['free']) if bal else 0.0
 
-def save_trade(uid, symbol, entry, tp, sl, vol, status="open"):
-    cur.execute("""INSERT INTO trades (user_id, symbol, entry, tp, sl, volume, status)
-                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                (uid, symbol, entry, tp, sl, vol, status))
-    conn.commit()
-    cur.execute("SELECT last_insert_rowid()")
-    return cur.fetchone()[0]
-
-def close_trade_db(trade_id: int, exit_price: float, pnl: float, status: str):
-    cur.execute("""UPDATE trades
-                   SET status=?, exit=?, pnl=?, closed_at=CURRENT_TIMESTAMP
-                   WHERE id=?""",
-                (status, exit_price, pnl, trade_id))
-    conn.commit()
-
-def df_user_trades(uid: int) -> pd.DataFrame:
-    q = """SELECT id, symbol, entry, tp, sl, volume, status, exit, pnl, created_at, closed_at
-           FROM trades WHERE user_id=?
-           ORDER BY COALESCE(closed_at, created_at)"""
-    return pd.read_sql_query(q, conn, params=(uid,))
+def _insert_trade(c, uid, symbol, entry, tp, sl, vol, status, oco_list_id=None,
+                  entry_order_id=None, oco_order_ids=None, commission=0.0) -> int:
+    trade_id = c.execute("""INSERT INTO trades (user_id, symbol, entry, tp, sl, volume, status, oco_list_id,
+                                                entry_order_id, oco_order_ids, commission)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                         (uid, symbol, entry, tp, sl, vol, status, oco_list_id,
+                          entry_order_id, oco_order_ids, commission)).lastrowid
+    c.execute("""INSERT INTO user_stats (user_id, trades) VALUES (?, 1)
+                 ON CONFLICT(user_id) DO UPDATE SET trades=trades+1""", (uid,))
+    return trade_id
+
+async def save_trade(uid, symbol, entry, tp, sl, vol, status="open", oco_list_id=None, **fill):
+    """fill: entry_order_id, oco_order_ids, commission — для auto-сделок."""
+    trade_id = await db_write(lambda c: _insert_trade(c, uid, symbol, entry, tp, sl, vol, status, oco_list_id, **fill))
+    risk_book.on_open(uid)
+    portfolio.on_open(trade_id, uid, symbol, entry, tp, vol)
+    return trade_id
+
+async def save_trades(uid, rows: list) -> list:
+    """Пачка сделок одной транзакцией; rows: (symbol, entry, tp, sl, vol, status, oco_list_id
+    [, entry_order_id, oco_order_ids, commission])."""
+    ids = await db_write(lambda c: [_insert_trade(c, uid, *r) for r in rows])
+    for trade_id, (symbol, entry, tp, _, vol) in zip(ids, (r[:5] for r in rows)):
+        risk_book.on_open(uid)
+        portfolio.on_open(trade_id, uid, symbol, entry, tp, vol)
+    return ids
+
+def _record_close(c, trade_id: int, pnl: float):
+    """Инкремент user_stats/user_symbol_stats закрытой сделкой (equity, пик и просадка — в SQL)."""
+    uid, symbol = c.execute("SELECT user_id, symbol FROM trades WHERE id=?", (trade_id,)).fetchone()
+    win = 1 if pnl > 0 else 0
+    c.execute("""INSERT INTO user_stats (user_id, closed, wins, gross_win, gross_loss, equity, peak, max_dd)
+                 VALUES (:uid, 1, :win, :gw, :gl, :pnl, MAX(0, :pnl), MAX(0, -:pnl))
+                 ON CONFLICT(user_id) DO UPDATE SET
+                     closed = closed + 1,
+                     wins = wins + :win,
+                     gross_win = gross_win + :gw,
+                     gross_loss = gross_loss + :gl,
+                     equity = equity + :pnl,
+                     peak = MAX(peak, equity + :pnl),
+                     max_dd = MAX(max_dd, MAX(peak, equity + :pnl) - (equity + :pnl))""",
+              {"uid": uid, "win": win, "pnl": pnl,
+               "gw": pnl if win else 0.0, "gl": 0.0 if win else pnl})
+    c.execute("""INSERT INTO user_symbol_stats (user_id, symbol, closed, wins, pnl) VALUES (?, ?, 1, ?, ?)
+                 ON CONFLICT(user_id, symbol) DO UPDATE SET
+                     closed = closed + 1, wins = wins + excluded.wins, pnl = pnl + excluded.pnl""",
+              (uid, symbol, win, pnl))
+
+def _close_trade(c, trade_id: int, exit_price: float, pnl: float, status: str) -> bool:
+    closed = c.execute("""UPDATE trades
+                          SET status=?, exit=?, pnl=?, closed_at=CURRENT_TIMESTAMP
+                          WHERE id=? AND status IN ('open','signal_open')""",
+                       (status, exit_price, pnl, trade_id)).rowcount > 0
+    if closed:
+        _record_close(c, trade_id, pnl)
+    return closed
+
+def trade_pnl(entry: float, tp: float, exit_price: float, vol: float) -> float:
+    """PnL с учётом направления: TP ниже входа — шорт (бывает у сигналов)."""
+    direction = -1 if tp is not None and float(tp) < float(entry) else 1
+    return (exit_price - float(entry)) * float(vol) * direction
+
+async def settle_trade(trade_id: int, exit_price: float, status: str = None, fee: float = 0.0,
+                       owner: int = None):
+    """Закрывает открытую сделку и переносит PnL в виртуальный депо (одна транзакция).
+
+    fee — комиссия закрытия в валюте котировки; PnL считается за вычетом всех комиссий сделки.
+    owner — закрыть, только если сделка принадлежит этому юзеру (команды из чата).
+    Возвращает (user_id, pnl, status, depo) или None, если сделки нет или она уже закрыта.
+    """
+    def op(c):
+        row = c.execute("""SELECT user_id, entry, tp, volume, COALESCE(commission, 0) FROM trades
+                           WHERE id=? AND (? IS NULL OR user_id=?)""", (trade_id, owner, owner)).fetchone()
+        if not row:
+            return None
+        uid, entry, tp, vol, commission = row
+        pnl = trade_pnl(entry, tp, exit_price, vol) - commission - fee
+        st = status or ("win" if pnl > 0 else "loss")
+        if not _close_trade(c, trade_id, exit_price, pnl, st):
+            return None
+        if fee:
+            c.execute("UPDATE trades SET commission=? WHERE id=?", (commission + fee, trade_id))
+        c.execute("UPDATE users SET depo=COALESCE(depo,0)+? WHERE user_id=?", (pnl, uid))
+        depo = c.execute("SELECT depo FROM users WHERE user_id=?", (uid,)).fetchone()
+        return uid, pnl, st, depo[0] if depo else None
+    res = await db_write(op)
+    if res:
+        user_cache.update(res[0], depo=res[3])
+        _equity_cache.pop(res[0], None)
+        trade_monitor.discard(trade_id)
+        risk_book.on_close(res[0], res[1])
+        portfolio.on_close(trade_id)
+    return res
+
+def fee_in_quote(symbol: str, commission: float, asset: str, price: float) -> float:
+    """Комиссия исполнения в валюте котировки; в третьей валюте (BNB) — 0, она только пишется в fills."""
+    if not commission or not asset:
+        return 0.0
+    if symbol.endswith(asset):
+        return commission
+    if symbol.startswith(asset):
+        return commission * price
+    return 0.0
+
+def _record_fills(c, uid: int, symbol: str, order_id: int, side: str, fills):
+    """fills: [(exec_id, price, qty, commission, commission_asset, ts)]; повторы (реплей, сверка) игнорируются."""
+    c.executemany("""INSERT OR IGNORE INTO fills (symbol, exec_id, order_id, user_id, side, price, qty,
+                                                  commission, commission_asset, fee_quote, ts)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                  [(symbol, e, order_id, uid, side, p, q, n, a, fee_in_quote(symbol, n, a, p), ts)
+                   for e, p, q, n, a, ts in fills])
+
+# ---------------- Exchange gateway ----------------
+# python-binance Client синхронный: все вызовы уходят в пул потоков, чтобы
+# медленный REST одного пользователя не останавливал event loop для остальных.
+# Перед пулом стоит ExchangeScheduler: вес IP, ордер-лимиты аккаунта, приоритеты.
+_exchange_pool = ThreadPoolExecutor(max_workers=EXCHANGE_WORKERS, thread_name_prefix="exchange")
+
+# вес запросов Binance (spot REST); для хелперов — вес запроса внутри
+REQUEST_WEIGHT = {
+    "get_exchange_info": 20, "load_symbol_meta": 20, "get_symbol_info": 20, "_get_symbol_filters": 20,
+    "get_account": 20, "get_asset_balance": 20, "user_get_balance": 20,
+    "get_symbol_ticker": 2, "user_get_price": 2, "public_price": 2, "get_open_orders": 6, "get_order": 4, "get_my_trades": 20,
+    "stream_get_listen_key": 2, "stream_keepalive": 2, "stream_close": 2,
+    "create_order": 1, "create_oco_order": 1, "cancel_open_orders": 1, "cancel_order": 1,
+    "get_user_client": 1,  # ping; в очередь попадает только промах кэша (user_client)
+}
+ORDER_COUNT = {"create_order": 1, "create_oco_order": 2}  # сколько ордеров уходит в лимит аккаунта
+PRIORITY = {"create_order": 0, "create_oco_order": 0, "cancel_open_orders": 0, "cancel_order": 0}  # прочее — 1
+
+class ExchangeJob:
+    __slots__ = ("uid", "fn", "args", "kwargs", "weight", "orders", "priority", "queued", "future")
+
+    def __init__(self, uid, fn, args, kwargs, future):
+        name = getattr(fn, "__name__", "")
+        self.uid, self.fn, self.args, self.kwargs, self.future = uid, fn, args, kwargs, future
+        self.weight = REQUEST_WEIGHT.get(name, 1)
+        self.orders = ORDER_COUNT.get(name, 0)
+        self.priority = PRIORITY.get(name, 1)
+        self.queued = time.monotonic()
+
+# client.response общий на клиента: при USER_EXCHANGE_CONCURRENCY > 1 там может
+# оказаться ответ соседнего вызова. Response-hook сессии пишет заголовки в
+# thread-local, а поток пула выполняет один вызов за раз.
+_call_response = threading.local()
+
+def _capture_response(response, *args, **kwargs):
+    _call_response.headers = response.headers
+    return response
+
+def _response_headers() -> dict:
+    """Заголовки последнего HTTP-ответа текущего вызова."""
+    return {k.lower(): v for k, v in getattr(_call_response, "headers", {}).items()}
+
+def _run_job(job: ExchangeJob):
+    _call_response.headers = {}
+    try:
+        result = job.fn(*job.args, **job.kwargs)
+    except Exception as e:
+        return False, e, _response_headers()
+    return True, result, _response_headers()
+
+class ExchangeScheduler:
+    """Очередь запросов к бирже перед пулом потоков.
+
+    - вес IP за минуту (локальная оценка + X-MBX-USED-WEIGHT-1M из ответов);
+    - ордера аккаунта за 10 с (скользящее окно + X-MBX-ORDER-COUNT-10S);
+    - ордера/отмены (priority 0) раньше балансов и справочных запросов;
+    - внутри приоритета юзеры по кругу, не больше USER_EXCHANGE_CONCURRENCY на юзера;
+    - на 429/418 вся очередь ждёт Retry-After.
+    """
+
+    def __init__(self, weight_limit: int, orders_per_10s: int, user_concurrency: int, max_inflight: int):
+        self.weight_limit = weight_limit
+        self.orders_per_10s = orders_per_10s
+        self.user_concurrency = user_concurrency
+        self.max_inflight = max_inflight
+        self.queues = (OrderedDict(), OrderedDict())  # priority -> uid -> deque[ExchangeJob]
+        self.inflight = 0
+        self.user_inflight = {}
+        self.minute = 0
+        self.used_weight = 0
+        self.order_times = {}   # uid -> deque[monotonic]
+        self.paused_until = 0.0
+        self.waits = (deque(maxlen=1000), deque(maxlen=1000))
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "weight_throttled": 0,
+                      "order_throttled": 0, "rate_limited": 0}
+        self._wake = None
+        self._task = None
+
+    async def submit(self, uid: int, fn, *args, **kwargs):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self.run())
+        job = ExchangeJob(uid, fn, args, kwargs, asyncio.get_running_loop().create_future())
+        self.queues[job.priority].setdefault(uid, deque()).append(job)
+        self.stats["submitted"] += 1
+        self._wake.set()
+        return await job.future
+
+    def queue_depth(self, priority: int = None) -> int:
+        qs = self.queues if priority is None else (self.queues[priority],)
+        return sum(len(d) for q in qs for d in q.values())
+
+    def wait_stats(self, priority: int) -> dict:
+        w = sorted(self.waits[priority])
+        if not w:
+            return {"count": 0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+        return {"count": len(w), "p50": w[len(w) // 2], "p95": w[int(len(w) * 0.95) - 1 if len(w) > 1 else 0],
+                "max": w[-1]}
+
+    def _orders_wait(self, uid: int, n: int, now: float) -> float:
+        q = self.order_times.setdefault(uid, deque())
+        while q and now - q[0] >= 10:
+            q.popleft()
+        if len(q) + n <= self.orders_per_10s:
+            return 0.0
+        return 10 - (now - q[0])
+
+    def _pick(self, now: float):
+        """Следующая задача и сколько до неё ждать (None, если брать нечего)."""
+        if self.inflight >= self.max_inflight:
+            return None, None
+        if now < self.paused_until:
+            return None, self.paused_until - now
+        minute = int(time.time() // 60)
+        if minute != self.minute:
+            self.minute, self.used_weight = minute, 0
+        best_wait = None
+        for q in self.queues:
+            for uid, jobs in q.items():
+                if self.user_inflight.get(uid, 0) >= self.user_concurrency:
+                    continue
+                job = jobs[0]
+                if self.used_weight + job.weight > self.weight_limit:
+                    self.stats["weight_throttled"] += 1
+                    return None, 60 - time.time() % 60
+                wait = self._orders_wait(uid, job.orders, now) if job.orders else 0.0
+                if wait:
+                    self.stats["order_throttled"] += 1
+                    best_wait = wait if best_wait is None else min(best_wait, wait)
+                    continue
+                jobs.popleft()
+                if jobs:
+                    q.move_to_end(uid)  # круговая очередь между юзерами
+                else:
+                    del q[uid]
+                return job, 0.0
+        return None, best_wait
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            job, wait = self._pick(now)
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.used_weight += job.weight
+            if job.orders:
+                self.order_times[job.uid].extend([now] * job.orders)
+            self.inflight += 1
+            self.user_inflight[job.uid] = self.user_inflight.get(job.uid, 0) + 1
+            self.waits[job.priority].append(now - job.queued)
+            asyncio.create_task(self._execute(job))
+
+    async def _execute(self, job: ExchangeJob):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            ok, value, headers = await loop.run_in_executor(_exchange_pool, _run_job, job)
+        except Exception as e:
+            ok, value, headers = False, e, {}
+        metrics.observe(f"exchange.{getattr(job.fn, '__name__', 'call')}", time.perf_counter() - started, not ok)
+        self._observe(job, ok, value, headers)
+        self.inflight -= 1
+        left = self.user_inflight.get(job.uid, 1) - 1
+        if left:
+            self.user_inflight[job.uid] = left
+        else:
+            self.user_inflight.pop(job.uid, None)
+        self._wake.set()
+        if job.future.done():
+            return
+        if ok:
+            job.future.set_result(value)
+        else:
+            job.future.set_exception(value)
+
+    def _observe(self, job: ExchangeJob, ok: bool, value, headers: dict):
+        self.stats["completed" if ok else "failed"] += 1
+        used = headers.get("x-mbx-used-weight-1m")
+        if used is not None:
+            self.used_weight = max(self.used_weight, int(used))
+        orders = headers.get("x-mbx-order-count-10s")
+        if orders is not None and int(orders) >= self.orders_per_10s:
+            q = self.order_times.setdefault(job.uid, deque())
+            q.extend([time.monotonic()] * max(self.orders_per_10s - len(q), 0))
+        status = getattr(value, "status_code", None) if not ok else None
+        if status in (429, 418):
+            self.stats["rate_limited"] += 1
+            retry = float(headers.get("retry-after") or 60)
+            self.paused_until = max(self.paused_until, time.monotonic() + retry)
+
+exchange_scheduler = ExchangeScheduler(int(BINANCE_WEIGHT_LIMIT * 0.9), ORDERS_PER_10S,
+                                       USER_EXCHANGE_CONCURRENCY, EXCHANGE_WORKERS)
+
+async def ex_call(uid: int, fn, *args, **kwargs):
+    """Выполняет блокирующий вызов биржи вне event loop через общий планировщик."""
+    return await exchange_scheduler.submit(uid, fn, *args, **kwargs)
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code: int, headers: dict):
+        super().__init__(f"APIError(code={status_code}): Too many requests")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers)
+
+class FakeClient:
+    """Офлайн-заглушка Binance Client (EXCHANGE_BACKEND=fake): те же методы, мгновенные fills.
+
+    Как настоящая биржа считает вес IP за минуту (общий на все экземпляры) и
+    ордера аккаунта за 10 с, отдаёт их в response.headers и отвечает 429 при превышении.
+    """
+    _ip = {"minute": 0, "weight": 0}
+    _ip_lock = threading.Lock()
+
+    def __init__(self, api_key=None, api_secret=None, testnet=True, latency=None):
+        self.testnet = testnet
+        self.latency = FAKE_EXCHANGE_LATENCY if latency is None else latency
+        self.prices = {}
+        self.balances = {"USDT": 100000.0}
+        self.open_orders = []
+        self.my_trades = []
+        self.response = SimpleNamespace(headers={})
+        self._orders = deque()
+        self._next_id = 1
+
+    def _io(self, weight: int = 1, orders: int = 0):
+        if self.latency:
+            time.sleep(self.latency)
+        now = time.time()
+        with self._ip_lock:
+            if int(now // 60) != self._ip["minute"]:
+                self._ip.update(minute=int(now // 60), weight=0)
+            self._ip["weight"] += weight
+            used = self._ip["weight"]
+        while self._orders and now - self._orders[0] >= 10:
+            self._orders.popleft()
+        self._orders.extend([now] * orders)
+        headers = {"X-MBX-USED-WEIGHT-1M": str(used), "X-MBX-ORDER-COUNT-10S": str(len(self._orders))}
+        limited = used > BINANCE_WEIGHT_LIMIT or len(self._orders) > 50
+        if limited:
+            headers["Retry-After"] = str(60 - int(now) % 60)
+        self.response = _capture_response(SimpleNamespace(headers=headers))
+        if limited:
+            raise FakeAPIError(429, headers)
+
+    def _id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def get_symbol_info(self, symbol):
+        self._io(20)
+        return self._symbol_info(symbol)
+
+    @staticmethod
+    def _symbol_info(symbol):
+        return {"symbol": symbol, "baseAsset": symbol[:-4], "quoteAsset": "USDT", "filters": [
+            {"filterType": "PRICE_FILTER", "tickSize": "0.01000000"},
+            {"filterType": "LOT_SIZE", "stepSize": "0.00001000", "minQty": "0.00001000"},
+            {"filterType": "NOTIONAL", "minNotional": "5.00000000"},
+        ]}
+
+    def get_exchange_info(self):
+        self._io(20)
+        return {"symbols": [self._symbol_info(s) for s in ("BTCUSDT", "ETHUSDT", "BNBUSDT")]}
+
+    def get_symbol_ticker(self, symbol):
+        self._io(2)
+        return {"symbol": symbol, "price": str(self.prices.get(symbol, FAKE_EXCHANGE_PRICE))}
+
+    def get_asset_balance(self, asset):
+        self._io(20)
+        return {"asset": asset, "free": str(self.balances.get(asset, 0.0)), "locked": "0"}
+
+    def get_account(self):
+        self._io(20)
+        return {"balances": [{"asset": a, "free": str(v), "locked": "0"} for a, v in self.balances.items()]}
+
+    def create_order(self, symbol, side, type, quantity, **kwargs):
+        self._io(1, orders=1)
+        price = self.prices.get(symbol, FAKE_EXCHANGE_PRICE)
+        qty = float(quantity)
+        base = symbol[:-4] if symbol.endswith("USDT") else symbol
+        sign = 1 if side == SIDE_BUY else -1
+        self.balances["USDT"] = self.balances.get("USDT", 0.0) - sign * qty * price
+        self.balances[base] = self.balances.get(base, 0.0) + sign * qty
+        order_id, trade_id, ts = self._id(), self._id(), int(time.time() * 1000)
+        self.my_trades.append({"symbol": symbol, "id": trade_id, "orderId": order_id, "price": str(price),
+                               "qty": str(quantity), "commission": "0", "commissionAsset": "USDT",
+                               "time": ts, "isBuyer": side == SIDE_BUY})
+        return {"symbol": symbol, "orderId": order_id, "status": "FILLED", "transactTime": ts,
+                "fills": [{"price": str(price), "qty": str(quantity), "commission": "0",
+                           "commissionAsset": "USDT", "tradeId": trade_id}]}
+
+    def create_oco_order(self, symbol, side, quantity, price, stopPrice, stopLimitPrice, **kwargs):
+        self._io(1, orders=2)
+        list_id = self._id()
+        orders = [{"symbol": symbol, "orderId": self._id(), "orderListId": list_id, "side": side, "type": t,
+                   "origQty": str(quantity), "price": str(p), "stopPrice": str(stop)}
+                  for t, p, stop in (("STOP_LOSS_LIMIT", stopLimitPrice, stopPrice), ("LIMIT_MAKER", price, 0))]
+        self.open_orders.extend(orders)
+        return {"orderListId": list_id, "symbol": symbol, "orders": orders}
+
+    def get_open_orders(self, symbol=None):
+        self._io(6 if symbol else 80)
+        return [o for o in self.open_orders if symbol is None or o["symbol"] == symbol]
+
+    def cancel_open_orders(self, symbol):
+        self._io()
+        cancelled = [o for o in self.open_orders if o["symbol"] == symbol]
+        self.open_orders = [o for o in self.open_orders if o["symbol"] != symbol]
+        return cancelled
+
+    def get_my_trades(self, symbol, orderId=None, **kwargs):
+        self._io(20)
+        return [t for t in self.my_trades if t["symbol"] == symbol and orderId in (None, t["orderId"])]
+
+    def stream_get_listen_key(self):
+        self._io(2)
+        return f"fake-listen-key-{self._id()}"
+
+    def stream_keepalive(self, listenKey):
+        self._io(2)
+        return {}
+
+    def stream_close(self, listenKey):
+        self._io(2)
+        return {}
+
+# ---------------- Binance clients ----------------
+_binance_client_cls = None
+
+def binance_client_cls():
+    """binance.client.Client, импорт при первом обращении (тянет requests, dateparser и т.п.)."""
+    global _binance_client_cls
+    if _binance_client_cls is None:
+        with metrics.span("import.binance"):
+            from binance.client import Client
+        _binance_client_cls = Client
+    return _binance_client_cls
+
+def _build_client(api_key: str, api_secret: str, testnet: bool):
+    if EXCHANGE_BACKEND == "fake":
+        return FakeClient(api_key, api_secret, testnet=testnet)
+    from requests.adapters import HTTPAdapter
+    client = binance_client_cls()(api_key, api_secret, testnet=testnet)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    client.session.mount("https://", adapter)
+    client.session.hooks["response"].append(_capture_response)
+    return client
+
+class ClientRegistry:
+    """LRU-кэш Binance клиентов по user_id: сессия, TLS и ping делаются один раз.
+
+    Клиент пересоздаётся, если у юзера сменились ключи или testnet/mainnet;
+    простаивающие дольше idle_ttl выселяются. Клиент без ключей (публичные
+    запросы) — один на сеть и не выселяется.
+    """
+
+    def __init__(self, maxsize: int, idle_ttl: float):
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self._clients = OrderedDict()  # uid -> (fingerprint, client, last_used)
+        self._public = {}  # testnet -> client
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "constructions": 0, "evictions": 0, "invalidations": 0}
+
+    def cached(self, u: dict):
+        """Клиент из кэша или None; в сеть не ходит, можно звать прямо из event loop."""
+        uid = u["user_id"]
+        fingerprint = (u["api_key"], u["api_secret"], bool(u["use_testnet"]))
+        with self._lock:
+            entry = self._clients.get(uid)
+            if entry and entry[0] == fingerprint:
+                self._clients[uid] = (fingerprint, entry[1], time.monotonic())
+                self._clients.move_to_end(uid)
+                self.stats["hits"] += 1
+                return entry[1]
+        return None
+
+    def get(self, u: dict):
+        # повторная проверка: пока запрос стоял в очереди, клиента мог собрать соседний
+        client = self.cached(u)
+        if client is not None:
+            return client
+        with self._lock:
+            self.stats["misses"] += 1
+        return self._build(u)
+
+    def _build(self, u: dict):
+        uid = u["user_id"]
+        fingerprint = (u["api_key"], u["api_secret"], bool(u["use_testnet"]))
+        now = time.monotonic()
+        # конструктор ходит в сеть — строим вне блокировки
+        client = _build_client(*fingerprint)
+        with self._lock:
+            self.stats["constructions"] += 1
+            stale = self._clients.pop(uid, None)
+            self._clients[uid] = (fingerprint, client, now)
+            evicted = self._evict(now)
+        if stale and stale[1] is not client:
+            evicted.append(stale[1])
+        for c in evicted:
+            _close_client(c)
+        return client
+
+    def public(self, testnet: bool):
+        testnet = bool(testnet)
+        with self._lock:
+            client = self._public.get(testnet)
+            if client is not None:
+                self.stats["hits"] += 1
+                return client
+            self.stats["misses"] += 1
+        client = _build_client(None, None, testnet)
+        with self._lock:
+            self.stats["constructions"] += 1
+            shared = self._public.setdefault(testnet, client)
+        if shared is not client:
+            _close_client(client)  # соседний поток успел раньше
+        return shared
+
+    def invalidate(self, uid: int):
+        with self._lock:
+            entry = self._clients.pop(uid, None)
+            if entry:
+                self.stats["invalidations"] += 1
+        if entry:
+            _close_client(entry[1])
+
+    def _evict(self, now: float) -> list:
+        evicted = []
+        while self._clients:
+            uid, (_, client, last_used) = next(iter(self._clients.items()))
+            if len(self._clients) <= self.maxsize and now - last_used < self.idle_ttl:
+                break
+            self._clients.popitem(last=False)
+            self.stats["evictions"] += 1
+            evicted.append(client)
+        return evicted
+
+def _close_client(client):
+    close = getattr(client, "close_connection", None)
+    if close:
+        try:
+            close()
+        except Exception:
+            pass
+
+client_registry = ClientRegistry(CLIENT_CACHE_SIZE, CLIENT_IDLE_TTL)
+
+def get_user_client(u: dict) -> "Client":
+    """Binance client c ключами пользователя (для авто‑трейда), из пула."""
+    if not u["api_key"] or not u["api_secret"]:
+        raise RuntimeError("Не заданы Binance API ключи.")
+    return client_registry.get(u)
+
+async def user_client(u: dict) -> "Client":
+    """get_user_client без очереди на попадании в кэш.
+
+    Через планировщик (и с весом ping) идёт только создание нового клиента.
+    """
+    if not u["api_key"] or not u["api_secret"]:
+        raise RuntimeError("Не заданы Binance API ключи.")
+    client = client_registry.cached(u)
+    if client is None:
+        client = await ex_call(u["user_id"], get_user_client, u)
+    return client
+
+# ---------------- Symbol metadata cache ----------------
+class SymbolMeta:
+    """Фильтры символа, нужные для валидации ордера."""
+    __slots__ = ("step", "tick", "min_qty", "min_notional", "base", "quote")
+
+    def __init__(self, step: Decimal, tick: Decimal, min_qty: Decimal, min_notional: float,
+                 base: str = "", quote: str = ""):
+        self.step = step
+        self.tick = tick
+        self.min_qty = min_qty
+        self.min_notional = min_notional
+        self.base = base
+        self.quote = quote
+
+    @classmethod
+    def from_info(cls, info: dict) -> "SymbolMeta":
+        f = {x['filterType']: x for x in info['filters']}
+        lot = f['LOT_SIZE']
+        notional = f.get('NOTIONAL') or f.get('MIN_NOTIONAL') or {}
+        return cls(Decimal(lot['stepSize']), Decimal(f['PRICE_FILTER']['tickSize']),
+                   Decimal(lot.get('minQty', '0')), float(notional.get('minNotional', 0)),
+                   info.get('baseAsset', ''), info.get('quoteAsset', ''))
+
+# отдельно testnet (True) и mainnet (False); словарь целиком подменяется при обновлении
+_symbol_meta = {True: {}, False: {}}
+
+def cached_symbol_meta(symbol: str, testnet: bool):
+    return _symbol_meta[bool(testnet)].get(symbol)
+
+QUOTE_ASSETS = ("USDT", "FDUSD", "USDC", "TUSD", "BUSD", "BTC", "ETH", "BNB", "EUR", "TRY")
+STABLE_ASSETS = {"USDT", "FDUSD", "USDC", "TUSD", "BUSD"}
+INVERSE_QUOTES = {"TRY"}  # курс к USDT — обратная пара (USDTTRY)
+
+def split_symbol(symbol: str):
+    """(base, quote): из exchangeInfo, если символ уже в кэше, иначе по известным котировкам."""
+    meta = _symbol_meta[False].get(symbol) or _symbol_meta[True].get(symbol)
+    if meta and meta.base:
+        return meta.base, meta.quote
+    for quote in QUOTE_ASSETS:
+        if symbol.endswith(quote) and len(symbol) > len(quote):
+            return symbol[:-len(quote)], quote
+    return symbol, ""
+
+def rate_symbol(quote: str):
+    """Пара, по которой котировка переводится в USDT, или None для стейблов."""
+    if not quote or quote in STABLE_ASSETS:
+        return None
+    return f"USDT{quote}" if quote in INVERSE_QUOTES else f"{quote}USDT"
+
+def public_price(symbol: str) -> float:
+    """Цена символа без ключей юзера (сеть рыночного стрима); зовётся, когда в PRICE_BOOK пары нет."""
+    return float(client_registry.public(MARKET_FEED_TESTNET).get_symbol_ticker(symbol=symbol)["price"])
+
+def load_symbol_meta(testnet: bool) -> int:
+    """Один запрос exchangeInfo -> фильтры всех символов сети."""
+    info = client_registry.public(testnet).get_exchange_info()
+    _symbol_meta[testnet] = {s['symbol']: SymbolMeta.from_info(s) for s in info['symbols']}
+    return len(_symbol_meta[testnet])
+
+def _get_symbol_filters(client: "Client", symbol: str, testnet: bool) -> SymbolMeta:
+    meta = cached_symbol_meta(symbol, testnet)
+    if meta:
+        return meta
+    info = client.get_symbol_info(symbol)
+    if not info:
+        raise ValueError(f"Символ {symbol} не найден на Binance")
+    meta = _symbol_meta[bool(testnet)][symbol] = SymbolMeta.from_info(info)
+    return meta
+
+async def has_auto_users() -> bool:
+    return bool(await db_query("SELECT 1 FROM users WHERE mode='auto' LIMIT 1"))
+
+async def symbol_meta_refresher():
+    """Фоновое обновление кэша фильтров раз в SYMBOL_META_TTL (пока нет auto-юзеров — биржа не нужна)."""
+    while True:
+        for testnet in (False, True) if EXCHANGE_BACKEND == "fake" or await has_auto_users() else ():
+            try:
+                await ex_call(0, load_symbol_meta, testnet)
+            except Exception:
+                pass  # остаётся прошлый снимок, промахи добираются через get_symbol_info
+        await asyncio.sleep(SYMBOL_META_TTL)
+
+# ---------------- Outbound messages ----------------
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "ts")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.ts = capacity, time.monotonic()
+
+    def take(self) -> float:
+        """Берёт токен; 0 — можно слать сейчас, иначе сколько секунд ждать."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            wait = self.take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+class Outbox:
+    """Вся исходящая почта бота: лимиты Telegram на чат и глобально, RetryAfter, склейка уведомлений.
+
+    На чат — своя очередь и свой воркер (порядок сообщений сохраняется),
+    воркер живёт, пока в очереди что-то есть. Ответы хендлеров ждут отправки;
+    уведомления (notify) не ждут, подряд идущие в один чат склеиваются в одно
+    сообщение, а при переполнении выбрасываются самые старые.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self.chats = {}    # chat_id -> deque[(method, args, kwargs, future | None)]
+        self.buckets = {}  # chat_id -> TokenBucket; простаивающие (уже полные) периодически чистятся
+        self.notes = 0
+        self.stats = {"sent": 0, "coalesced": 0, "dropped": 0, "retry_after": 0, "failed": 0}
+
+    async def send(self, chat_id: int, method, *args, **kwargs):
+        fut = asyncio.get_running_loop().create_future()
+        self._push(chat_id, (method, args, kwargs, fut))
+        return await fut
+
+    def notify(self, chat_id: int, text: str):
+        q = self.chats.get(chat_id)
+        if q and sum(1 for x in q if x[3] is None) >= OUTBOX_CHAT_MAX:
+            self._drop_oldest_note(q)
+        elif self.notes >= OUTBOX_MAX:
+            self._drop_oldest_note()
+        self.notes += 1
+        self._push(chat_id, (None, (text,), {}, None))
+
+    def _drop_oldest_note(self, q=None):
+        for dq in ([q] if q else self.chats.values()):
+            for i, item in enumerate(dq):
+                if item[3] is None:
+                    del dq[i]
+                    self.notes -= 1
+                    self.stats["dropped"] += 1
+                    return
+
+    def _push(self, chat_id: int, item):
+        q = self.chats.get(chat_id)
+        if q is None:
+            q = self.chats[chat_id] = deque()
+            if chat_id not in self.buckets:
+                if len(self.buckets) > len(self.chats) + 1000:
+                    self._prune_buckets()
+                self.buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, 1)
+            asyncio.create_task(self._chat_worker(chat_id, q))
+        q.append(item)
+
+    def _prune_buckets(self):
+        now = time.monotonic()
+        for chat_id, b in list(self.buckets.items()):
+            if chat_id not in self.chats and now - b.ts >= b.capacity / b.rate:
+                del self.buckets[chat_id]
+
+    def _next(self, q: deque):
+        """Следующая отправка; подряд идущие уведомления склеиваются до лимита длины."""
+        method, args, kwargs, fut = q.popleft()
+        if fut is not None:
+            return method, args, kwargs, fut
+        self.notes -= 1
+        text = args[0]
+        while q and q[0][3] is None and len(text) + 2 + len(q[0][1][0]) <= 4096:
+            text += "\n\n" + q.popleft()[1][0]
+            self.notes -= 1
+            self.stats["coalesced"] += 1
+        return bot.send_message, (text,), {}, None
+
+    async def _chat_worker(self, chat_id: int, q: deque):
+        try:
+            while q:
+                await self.buckets[chat_id].acquire()
+                method, args, kwargs, fut = self._next(q)
+                await self.global_bucket.acquire()
+                try:
+                    result = await self._deliver(chat_id, method, args, kwargs)
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    if fut is not None and not fut.done():
+                        fut.set_exception(e)
+                    continue
+                self.stats["sent"] += 1
+                if fut is not None and not fut.done():
+                    fut.set_result(result)
+        finally:
+            del self.chats[chat_id]
+
+    async def _deliver(self, chat_id, method, args, kwargs, attempts: int = 5):
+        for attempt in range(attempts):
+            for a in list(args) + list(kwargs.values()):
+                f = getattr(a, "file", None)  # InputFile из BytesIO — перечитать с начала
+                if hasattr(f, "seek"):
+                    f.seek(0)
+            try:
+                with metrics.span(f"telegram.{getattr(method, '__name__', 'call')}"):
+                    return await method(chat_id, *args, **kwargs)
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(e.timeout)
+
+outbox = Outbox()
+
+async def reply(message: types.Message, text: str, **kwargs):
+    """message.answer через очередь исходящих."""
+    return await outbox.send(message.chat.id, bot.send_message, text, **kwargs)
+
+# ---------------- Market data ----------------
+# Общая книга цен: symbol -> Quote. Значение всегда заменяется целиком новым
+# кортежем, поэтому читать её можно из любого потока без блокировок.
+Quote = namedtuple("Quote", "last bid ask ts")
+PRICE_BOOK = {}
+MARKET_FEED_TESTNET = "testnet" in MARKET_WS_URL
+
+def fresh_price(symbol: str, testnet: bool):
+    """Последняя цена из стрима, если она свежая и из той же сети, иначе None."""
+    q = PRICE_BOOK.get(symbol)
+    if q is None or bool(testnet) != MARKET_FEED_TESTNET or time.time() - q.ts > PRICE_MAX_AGE:
+        return None
+    return q.last
+
+async def open_trade_symbols() -> set:
+    """Символы открытых сделок и пары курсов их котировок к USDT (для оценки экспозиции)."""
+    rows = await db_query("""SELECT DISTINCT symbol FROM trades
+                             WHERE status IN ('open','signal_open') AND user_id % ? = ?""",
+                          (WORKER_COUNT, WORKER_INDEX))
+    symbols = {r[0] for r in rows}
+    return symbols | {p for p in (rate_symbol(split_symbol(s)[1]) for s in symbols) if p}
+
+class MarketFeed:
+    """Одно multiplexed-соединение miniTicker+bookTicker только по нужным символам.
+
+    Переподключается с экспоненциальной задержкой; с MARKET_REPLAY_FILE
+    проигрывает записанные сообщения вместо сети.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.wanted = set()
+        self.subscribed = set()
+        self._ws = None
+        self._has_symbols = asyncio.Event()
+        self._sync_lock = asyncio.Lock()
+        self._req_id = 0
+        self.listeners = []  # callback(symbol, last_price) на каждое обновление miniTicker
+
+    @staticmethod
+    def _streams(symbols):
+        return [f"{s.lower()}@{kind}" for s in sorted(symbols) for kind in ("miniTicker", "bookTicker")]
+
+    def set_symbols(self, symbols: set):
+        self.wanted = set(symbols)
+        if self.wanted:
+            self._has_symbols.set()
+        else:
+            self._has_symbols.clear()
+        if self._ws is not None:
+            asyncio.create_task(self._sync())
+
+    def watch(self, symbol: str):
+        if symbol not in self.wanted:
+            self.set_symbols(self.wanted | {symbol})
+
+    async def _send(self, method: str, symbols):
+        streams = self._streams(symbols)
+        for i in range(0, len(streams), 200):
+            self._req_id += 1
+            await self._ws.send_json({"method": method, "params": streams[i:i + 200], "id": self._req_id})
+
+    async def _sync(self):
+        async with self._sync_lock:
+            if self._ws is None:
+                return
+            add, drop = self.wanted - self.subscribed, self.subscribed - self.wanted
+            if add:
+                await self._send("SUBSCRIBE", add)
+            if drop:
+                await self._send("UNSUBSCRIBE", drop)
+            self.subscribed = set(self.wanted)
+
+    def _apply(self, msg: dict):
+        data = msg.get("data")
+        if not data:
+            return  # ответы на SUBSCRIBE/UNSUBSCRIBE
+        symbol = data["s"]
+        prev = PRICE_BOOK.get(symbol)
+        if msg.get("stream", "").endswith("@bookTicker"):
+            bid, ask = float(data["b"]), float(data["a"])
+            last = prev.last if prev else (bid + ask) / 2
+            PRICE_BOOK[symbol] = Quote(last, bid, ask, time.time())
+            return
+        last = float(data["c"])
+        bid, ask = (prev.bid, prev.ask) if prev else (last, last)
+        PRICE_BOOK[symbol] = Quote(last, bid, ask, time.time())
+        for cb in self.listeners:
+            cb(symbol, last)
+
+    async def _session(self):
+        record = open(MARKET_RECORD_FILE, "a") if MARKET_RECORD_FILE else None
+        try:
+            async with aiohttp.ClientSession() as http:
+                async with http.ws_connect(self.url, heartbeat=30) as ws:
+                    self._ws, self.subscribed = ws, set()
+                    await self._sync()
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        self._apply(json.loads(msg.data))
+                        if record:
+                            record.write(msg.data + "\n")
+        finally:
+            self._ws = None
+            if record:
+                record.close()
+
+    async def replay(self, path: str):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    self._apply(json.loads(line))
+                    await asyncio.sleep(0)
+
+    async def run(self):
+        if MARKET_REPLAY_FILE:
+            await self.replay(MARKET_REPLAY_FILE)
+            return
+        delay = 1.0
+        while True:
+            await self._has_symbols.wait()
+            started = time.monotonic()
+            try:
+                await self._session()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+            if time.monotonic() - started > 60:
+                delay = 1.0  # соединение жило долго — не наказываем
+            await asyncio.sleep(delay + random.random())
+            delay = min(delay * 2, 60.0)
+
+    async def track_open_trades(self, every: float = 30):
+        """Подписка следует за символами открытых сделок."""
+        while True:
+            try:
+                self.set_symbols(await open_trade_symbols())
+            except Exception:
+                pass
+            await asyncio.sleep(every)
+
+market_feed = MarketFeed(MARKET_WS_URL)
+
+# ---------------- TP/SL monitor ----------------
+class TradeMonitor:
+    """Следит за TP/SL открытых сделок по тикам из MarketFeed.
+
+    На символ два отсортированных списка уровней: upper срабатывает при
+    price >= level, lower при price <= level. Тик делает bisect и срезает
+    только пересечённые уровни, без прохода по всем сделкам. Закрытая или
+    сработавшая сделка убирает и второй свой уровень (bisect по точной записи).
+    signal_open закрываются по уровню сразу; у auto (open) закрывает биржевой
+    OCO, поэтому сделка уходит в awaiting и закрывается после сверки с биржей.
+    """
+
+    def __init__(self):
+        self.trades = {}    # id -> (uid, symbol, entry, tp, sl, status, oco_list_id)
+        self.upper = {}     # symbol -> [(level, id, is_tp)]
+        self.lower = {}
+        self.awaiting = {}  # id -> (level, is_tp) — уровень пересечён, ждём OCO
+
+    def add(self, trade_id, uid, symbol, entry, tp, sl, status, oco_list_id=None):
+        self.trades[trade_id] = (uid, symbol, entry, tp, sl, status, oco_list_id)
+        self._index(trade_id)
+
+    @staticmethod
+    def _levels(trade_id, t):
+        """-> (symbol, запись в upper, запись в lower)."""
+        _, symbol, entry, tp, sl, _, _ = t
+        short = tp < entry
+        return symbol, (sl if short else tp, trade_id, not short), (tp if short else sl, trade_id, short)
+
+    def _index(self, trade_id):
+        symbol, up, low = self._levels(trade_id, self.trades[trade_id])
+        bisect.insort(self.upper.setdefault(symbol, []), up)
+        bisect.insort(self.lower.setdefault(symbol, []), low)
+
+    def _unindex(self, trade_id, t):
+        symbol, up, low = self._levels(trade_id, t)
+        for book, entry in ((self.upper, up), (self.lower, low)):
+            levels = book.get(symbol)
+            if not levels:
+                continue
+            i = bisect.bisect_left(levels, entry)
+            if i < len(levels) and levels[i] == entry:
+                del levels[i]
+            if not levels:
+                del book[symbol]
+
+    def discard(self, trade_id):
+        t = self.trades.pop(trade_id, None)
+        if t is not None and self.awaiting.pop(trade_id, None) is None:
+            self._unindex(trade_id, t)  # в awaiting уровней в индексе уже нет
+
+    def relink(self, trade_id, oco_list_id):
+        t = self.trades.get(trade_id)
+        if t:
+            self.trades[trade_id] = t[:6] + (oco_list_id,)
+
+    async def load(self):
+        rows = await db_query("""SELECT id, user_id, symbol, entry, tp, sl, status, oco_list_id FROM trades
+                                 WHERE status IN ('open','signal_open') AND tp IS NOT NULL AND sl IS NOT NULL
+                                   AND managed != 0 AND user_id % ? = ?""", (WORKER_COUNT, WORKER_INDEX))
+        for tid, uid, symbol, entry, tp, sl, status, oco in rows:
+            self.add(tid, uid, symbol, entry, tp, sl, status, oco)
+        return len(self.trades)
+
+    def on_price(self, symbol: str, price: float):
+        hits = []
+        up = self.upper.get(symbol)
+        if up and up[0][0] <= price:
+            k = bisect.bisect_right(up, (price, float("inf")))
+            hits.extend(up[:k])
+            del up[:k]
+        low = self.lower.get(symbol)
+        if low and low[-1][0] >= price:
+            k = bisect.bisect_left(low, (price, float("-inf")))
+            hits.extend(low[k:])
+            del low[k:]
+        for level, tid, is_tp in hits:
+            t = self.trades.get(tid)
+            if t is None or tid in self.awaiting:
+                continue
+            self._unindex(tid, t)  # второй уровень сделки; вернёт poll_oco, если OCO ещё висит
+            if t[5] == "signal_open":
+                del self.trades[tid]
+                asyncio.create_task(self._close(tid, t, level, is_tp))
+            else:
+                self.awaiting[tid] = (level, is_tp)
+
+    async def close_at_level(self, trade_id) -> bool:
+        """Закрывает сработавшую (awaiting) сделку по пересечённому уровню; False — уровень не пересекался."""
+        hit, t = self.awaiting.get(trade_id), self.trades.get(trade_id)
+        if hit is None or t is None:
+            return False
+        del self.trades[trade_id]
+        await self._close(trade_id, t, *hit)
+        return True
+
+    async def _close(self, trade_id, t, level, is_tp):
+        res = await settle_trade(trade_id, level, "win" if is_tp else "loss")
+        if not res:
+            return
+        uid, pnl = res[0], res[1]
+        mark = "🎯 TP" if is_tp else "🛑 SL"
+        outbox.notify(uid, f"{mark} #{trade_id} {t[1]} закрыта по {level} | PnL={pnl:.2f}")
+
+    async def poll_oco(self):
+        """Сработавшие auto-сделки сверяет Reconciler (закрытие по фактическому fill);
+        если OCO ещё висит, уровни возвращаются в индекс."""
+        while True:
+            await asyncio.sleep(OCO_POLL_SEC)
+            tids = list(self.awaiting)
+            if not tids:
+                continue
+            try:
+                await reconciler.reconcile({self.trades[tid][0] for tid in tids if tid in self.trades})
+            except Exception:
+                logging.exception("OCO poll failed")
+            for tid in tids:
+                if self.awaiting.pop(tid, None) is not None and tid in self.trades:
+                    self._index(tid)
+
+trade_monitor = TradeMonitor()
+market_feed.listeners.append(trade_monitor.on_price)
+
+# ---------------- Fills & reconciliation ----------------
+# Auto-сделка закрывается по фактическому исполнению ноги OCO: событие
+# executionReport из user-data stream, а что стрим пропустил — добирает
+# Reconciler по open orders + myTrades. Он же ставит OCO заново, если его нет.
+async def settle_fill(trade_id: int, symbol: str, exit_price: float, fee: float):
+    res = await settle_trade(trade_id, exit_price, fee=fee)
+    if res:
+        uid, pnl = res[0], res[1]
+        mark = "🎯" if pnl > 0 else "🛑"
+        outbox.notify(uid, f"{mark} #{trade_id} {symbol} исполнена по {exit_price:.8f} "
+                           f"(комиссия {fee:.4f}) | PnL={pnl:.2f}")
+    return res
+
+class UserStreams:
+    """User-data stream (listenKey + keepalive) для юзеров с открытыми auto-сделками.
+
+    Одно соединение на юзера; executionReport пишутся в fills, исполнение ноги
+    OCO закрывает сделку. С USER_STREAM_REPLAY_FILE проигрывает записанные события.
+    """
+
+    def __init__(self):
+        self.tasks = {}  # uid -> asyncio.Task соединения
+        self._http = None
+        self.stats = {"events": 0, "fills": 0, "closed": 0, "reconnects": 0}
+
+    def watch(self, uid: int):
+        if EXCHANGE_BACKEND != "fake" and not USER_STREAM_REPLAY_FILE and uid not in self.tasks:
+            self.tasks[uid] = asyncio.create_task(self._run(uid))
+
+    async def apply(self, uid: int, ev: dict):
+        self.stats["events"] += 1
+        if ev.get("e") != "executionReport":
+            return
+        symbol, order_id, list_id = ev["s"], ev["i"], ev.get("g", -1)
+        if ev["x"] == "TRADE":
+            fill = (ev["t"], float(ev["L"]), float(ev["l"]), float(ev["n"] or 0), ev.get("N"), ev["T"])
+            await db_write(lambda c: _record_fills(c, uid, symbol, order_id, ev["S"], [fill]))
+            self.stats["fills"] += 1
+        if list_id == -1 or ev["S"] != SIDE_SELL:
+            return
+        if ev["X"] == "FILLED":
+            row = await db_query("SELECT id FROM trades WHERE user_id=? AND oco_list_id=? AND status='open'",
+                                 (uid, list_id), one=True)
+            if not row:
+                return
+            fee = await db_query("SELECT COALESCE(SUM(fee_quote), 0) FROM fills WHERE symbol=? AND order_id=?",
+                                 (symbol, order_id), one=True)
+            if await settle_fill(row[0], symbol, float(ev["Z"]) / float(ev["z"]), fee[0]):
+                self.stats["closed"] += 1
+        elif ev["X"] in ("CANCELED", "EXPIRED", "REJECTED"):
+            reconciler.poke(uid)  # вторая нога при исполнении первой тоже EXPIRED — сверка разберётся
+
+    async def _keepalive(self, uid: int, client, key: str):
+        while True:
+            await asyncio.sleep(USER_STREAM_KEEPALIVE)
+            await ex_call(uid, client.stream_keepalive, key)
+
+    async def _session(self, uid: int):
+        u = await get_user(uid)
+        client = await user_client(u)
+        key = await ex_call(uid, client.stream_get_listen_key)
+        url = f"{USER_WS_TESTNET_URL if u['use_testnet'] else USER_WS_URL}/{key}"
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession()
+        keepalive = asyncio.create_task(self._keepalive(uid, client, key))
+        record = open(USER_STREAM_RECORD_FILE, "a") if USER_STREAM_RECORD_FILE else None
+        try:
+            async with self._http.ws_connect(url, heartbeat=30) as ws:
+                reconciler.poke(uid)  # пока не были подключены, что-то могло исполниться
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    ev = json.loads(msg.data)
+                    if record:
+                        record.write(json.dumps({"uid": uid, "event": ev}) + "\n")
+                    if ev.get("e") == "listenKeyExpired":
+                        break
+                    await self.apply(uid, ev)
+        finally:
+            keepalive.cancel()
+            if record:
+                record.close()
+
+    async def _run(self, uid: int):
+        delay = 1.0
+        while True:
+            started = time.monotonic()
+            try:
+                await self._session(uid)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+            self.stats["reconnects"] += 1
+            if time.monotonic() - started > 60:
+                delay = 1.0
+            await asyncio.sleep(delay + random.random())
+            delay = min(delay * 2, 60.0)
+
+    async def replay(self, path: str):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    d = json.loads(line)
+                    await self.apply(d["uid"], d["event"])
+
+    async def run(self, every: float = 30):
+        """Соединения следуют за юзерами с открытыми auto-сделками (своего шарда)."""
+        if USER_STREAM_REPLAY_FILE:
+            await self.replay(USER_STREAM_REPLAY_FILE)
+            await reconciler.reconcile()
+            return
+        if EXCHANGE_BACKEND == "fake":
+            return
+        while True:
+            try:
+                rows = await db_query("SELECT DISTINCT user_id FROM trades WHERE status='open' AND user_id % ? = ?",
+                                      (WORKER_COUNT, WORKER_INDEX))
+                wanted = {r[0] for r in rows}
+                for uid in wanted - self.tasks.keys():
+                    self.watch(uid)
+                for uid in self.tasks.keys() - wanted:
+                    self.tasks.pop(uid).cancel()
+            except Exception:
+                pass
+            await asyncio.sleep(every)
+
+def _oco_matches(legs: list, tp: float, sl: float) -> bool:
+    """Живой OCO (его ноги из get_open_orders) — это TP/SL сделки: SELL, цены с точностью до тика."""
+    prices = [float(o.get(k) or 0) for o in legs for k in ("price", "stopPrice")]
+    near = lambda level: any(abs(p - level) <= abs(level) * 1e-3 for p in prices)
+    return all(o.get("side") == SIDE_SELL for o in legs) and near(tp) and near(sl)
+
+class Reconciler:
+    """Сверка открытых auto-сделок с биржей: один get_open_orders на (юзер, символ).
+
+    OCO сделки нет среди открытых ордеров -> ищем исполнение его ног (myTrades)
+    и закрываем по факту; ноги не исполнены (OCO отменён или не встал после
+    покупки) -> ставим OCO заново, не вышло — предупреждаем юзера один раз.
+    Сделки после /cancel_all (managed=0) не трогает; у сделок, открытых до учёта
+    ног (managed=2), ищет их живой OCO и привязывает, новый не ставит.
+    """
+
+    def __init__(self):
+        self.dirty = set()   # uid, которых сверить в ближайший проход
+        self.warned = set()  # id сделок, о незащищённой позиции уже сказали
+        self.locks = {}      # uid -> asyncio.Lock: один проход сверки на юзера за раз
+        self.stats = {"runs": 0, "closed": 0, "reprotected": 0, "unprotected": 0, "adopted": 0}
+
+    def poke(self, uid: int):
+        self.dirty.add(uid)
+
+    async def reconcile(self, uids=None):
+        if uids is None:
+            rows = await db_query("""SELECT DISTINCT user_id FROM trades
+                                     WHERE status='open' AND managed != 0 AND user_id % ? = ?""",
+                                  (WORKER_COUNT, WORKER_INDEX))
+            uids = {r[0] for r in rows}
+        for uid in uids:
+            # проходы run и poll_oco могут пересечься: без лока оба поставят OCO одной сделке
+            async with self.locks.setdefault(uid, asyncio.Lock()):
+                await self._reconcile_user(uid)
+        self.stats["runs"] += 1
+
+    async def _reconcile_user(self, uid: int):
+        # сделки перечитываются под локом — прошлый проход мог уже привязать или поставить OCO
+        rows = await db_query("""SELECT id, user_id, symbol, entry, tp, sl, volume, oco_list_id, oco_order_ids,
+                                        managed
+                                 FROM trades WHERE status='open' AND managed != 0 AND user_id=?""", (uid,))
+        groups = {}
+        for row in rows:
+            groups.setdefault(row[2], []).append(row)
+        for symbol, trades in groups.items():
+            try:
+                client = await user_client(await get_user(uid))
+                orders = await ex_call(uid, client.get_open_orders, symbol=symbol)
+            except Exception:
+                continue
+            lists = {}
+            for o in orders:
+                if o.get("orderListId", -1) != -1:
+                    lists.setdefault(o["orderListId"], []).append(o)
+            claimed = {row[7] for row in trades if row[9] == 1}
+            for row in trades:
+                try:
+                    if row[9] == 2:
+                        await self._adopt(uid, row, lists, claimed)
+                    elif row[7] is None or row[7] not in lists:
+                        await self._repair(uid, client, row)
+                except Exception:
+                    logging.exception("reconcile of trade %s failed", row[0])
+
+    async def _adopt(self, uid: int, row, lists: dict, claimed: set):
+        """Сделка до учёта ног OCO: привязывает её живой OCO (по listId или по ценам TP/SL)."""
+        tid, _, symbol, entry, tp, sl, vol, list_id = row[:8]
+        if list_id not in lists:
+            list_id = next((i for i, legs in lists.items() if i not in claimed and _oco_matches(legs, tp, sl)), None)
+        if list_id is not None:
+            claimed.add(list_id)
+            leg_ids = ",".join(str(o["orderId"]) for o in lists[list_id])
+            await db_execute("""UPDATE trades SET oco_list_id=?, oco_order_ids=?, managed=1
+                                WHERE id=? AND status='open'""", (list_id, leg_ids, tid))
+            trade_monitor.relink(tid, list_id)
+            self.stats["adopted"] += 1
+            return
+        # OCO уже нет, а без id ног исполнение не найти: закрываем по пересечённому уровню
+        if await trade_monitor.close_at_level(tid):
+            return
+        if tid not in self.warned:
+            self.warned.add(tid)
+            outbox.notify(uid, f"⚠️ #{tid} {symbol}: OCO этой сделки на бирже не найден, заново его бот не ставит.\n"
+                               f"Проверь позицию на Binance и закрой сделку: /close_trade {tid} win|loss ЦЕНА")
+
+    async def _repair(self, uid: int, client, row):
+        tid, _, symbol, entry, tp, sl, vol, list_id, leg_ids = row[:9]
+        for order_id in (int(x) for x in (leg_ids or "").split(",") if x):
+            trades = await ex_call(uid, client.get_my_trades, symbol=symbol, orderId=order_id)
+            if not trades:
+                continue
+            fills = [(t["id"], float(t["price"]), float(t["qty"]), float(t["commission"]), t["commissionAsset"],
+                      t["time"]) for t in trades]
+            await db_write(lambda c: _record_fills(c, uid, symbol, order_id, SIDE_SELL, fills))
+            qty = sum(f[2] for f in fills)
+            exit_price = sum(f[1] * f[2] for f in fills) / qty
+            fee = sum(fee_in_quote(symbol, f[3], f[4], f[1]) for f in fills)
+            if await settle_fill(tid, symbol, exit_price, fee):
+                self.stats["closed"] += 1
+            return
+        await self._protect(uid, client, row)
+
+    async def _protect(self, uid: int, client, row):
+        tid, _, symbol, entry, tp, sl, vol = row[:7]
+        testnet = bool((await get_user(uid))["use_testnet"])
+        try:
+            meta = cached_symbol_meta(symbol, testnet) or await ex_call(uid, _get_symbol_filters, client, symbol, testnet)
+            list_id, leg_ids = await place_oco(uid, client, meta, symbol, _round_qty(vol, meta.step), tp, sl)
+        except Exception as e:
+            self.stats["unprotected"] += 1
+            if tid not in self.warned:
+                self.warned.add(tid)
+                outbox.notify(uid, f"⚠️ #{tid} {symbol}: OCO на бирже нет, выставить заново не удалось ({e}).\n"
+                                   f"Позиция без TP/SL — проверь на Binance.")
+            return
+        await db_execute("UPDATE trades SET oco_list_id=?, oco_order_ids=? WHERE id=? AND status='open' AND managed=1",
+                         (list_id, leg_ids, tid))
+        trade_monitor.relink(tid, list_id)
+        self.warned.discard(tid)
+        self.stats["reprotected"] += 1
+        outbox.notify(uid, f"🛡 #{tid} {symbol}: OCO выставлен заново (TP={tp}, SL={sl})")
+
+    async def run(self):
+        """poke()-нутых юзеров сверяет каждые OCO_POLL_SEC, всех — раз в RECONCILE_SEC."""
+        last_full = float("-inf")  # первый проход полный: исполнения, пока бот был выключен
+        while True:
+            await asyncio.sleep(OCO_POLL_SEC)
+            if time.monotonic() - last_full >= RECONCILE_SEC:
+                last_full, uids, self.dirty = time.monotonic(), None, set()
+            elif self.dirty:
+                uids, self.dirty = self.dirty, set()
+            else:
+                continue
+            try:
+                await self.reconcile(uids)
+            except Exception:
+                logging.exception("reconcile failed")
+
+user_streams = UserStreams()
+reconciler = Reconciler()
 
 # ---------------- Risk Management ----------------
 def today_bounds_utc():
@@ -143,114 +1977,925 @@ def week_bounds_utc():
     end = start + timedelta(days=7)
     return start, end
 
-def get_period_pnl(uid, start_dt_utc: datetime, end_dt_utc: datetime) -> float:
-    cur.execute("""SELECT COALESCE(SUM(pnl),0) FROM trades
-                   WHERE user_id=? AND status IN ('win','loss') AND closed_at BETWEEN ? AND ?""",
-                (uid, start_dt_utc.isoformat(" "), end_dt_utc.isoformat(" ")))
-    return float(cur.fetchone()[0] or 0.0)
+async def get_period_pnl(uid, start_dt_utc: datetime, end_dt_utc: datetime) -> float:
+    row = await db_query("""SELECT COALESCE(SUM(pnl),0) FROM trades
+                            WHERE user_id=? AND status IN ('win','loss') AND closed_at >= ? AND closed_at < ?""",
+                         (uid, start_dt_utc.isoformat(" "), end_dt_utc.isoformat(" ")), one=True)
+    return float(row[0] or 0.0)
+
+async def get_trades_today(uid):
+    start, end = today_bounds_utc()
+    row = await db_query("""SELECT COUNT(*) FROM trades
+                            WHERE user_id=? AND created_at >= ? AND created_at < ?""",
+                         (uid, start.isoformat(" "), end.isoformat(" ")), one=True)
+    return row[0] or 0
+
+class RiskCounters:
+    """Реализованный PnL за день/неделю и число сделок за день (UTC)."""
+    __slots__ = ("day", "week", "day_pnl", "week_pnl", "day_trades")
+
+    def __init__(self, day, week):
+        self.day, self.week = day, week
+        self.day_pnl = self.week_pnl = 0.0
+        self.day_trades = 0
+
+class RiskBook:
+    """Счётчики лимитов в памяти: check_limits без SQL.
 
-def get_trades_today(uid):
-    cur.execute("""SELECT COUNT(*) FROM trades
-                   WHERE user_id=? AND DATE(created_at)=DATE('now')""", (uid,))
-    return cur.fetchone()[0] or 0
+    Обновляются в save_trade/settle_trade, обнуляются на границе UTC суток и
+    недели, при старте собираются из БД двумя агрегатами по всем юзерам.
+    """
+
+    def __init__(self):
+        self.users = {}
+
+    def get(self, uid: int) -> RiskCounters:
+        day, week = today_bounds_utc()[0], week_bounds_utc()[0]
+        rc = self.users.get(uid)
+        if rc is None:
+            rc = self.users[uid] = RiskCounters(day, week)
+        if rc.day != day:
+            rc.day, rc.day_pnl, rc.day_trades = day, 0.0, 0
+        if rc.week != week:
+            rc.week, rc.week_pnl = week, 0.0
+        return rc
+
+    def on_open(self, uid: int):
+        self.get(uid).day_trades += 1
+
+    def on_close(self, uid: int, pnl: float):
+        rc = self.get(uid)
+        rc.day_pnl += pnl
+        rc.week_pnl += pnl
+
+    async def rebuild(self):
+        dstart, dend = today_bounds_utc()
+        wstart, wend = week_bounds_utc()
+        users = {}
+        pnl_rows = await db_query("""SELECT user_id,
+                                            SUM(CASE WHEN closed_at >= ? THEN pnl ELSE 0 END), SUM(pnl)
+                                     FROM trades
+                                     WHERE status IN ('win','loss') AND closed_at >= ? AND closed_at < ?
+                                       AND user_id % ? = ?
+                                     GROUP BY user_id""",
+                                  (dstart.isoformat(" "), wstart.isoformat(" "), wend.isoformat(" "),
+                                   WORKER_COUNT, WORKER_INDEX))
+        for uid, day_pnl, week_pnl in pnl_rows:
+            rc = users[uid] = RiskCounters(dstart, wstart)
+            rc.day_pnl, rc.week_pnl = float(day_pnl or 0), float(week_pnl or 0)
+        count_rows = await db_query("""SELECT user_id, COUNT(*) FROM trades
+                                       WHERE created_at >= ? AND created_at < ? AND user_id % ? = ?
+                                       GROUP BY user_id""",
+                                    (dstart.isoformat(" "), dend.isoformat(" "), WORKER_COUNT, WORKER_INDEX))
+        for uid, n in count_rows:
+            users.setdefault(uid, RiskCounters(dstart, wstart)).day_trades = n
+        self.users = users
+        return len(users)
+
+    async def verify(self, uid: int) -> RiskCounters:
+        """Сверка с SQL (RISK_VERIFY=1): расхождение логируется, верим БД."""
+        rc = self.get(uid)
+        day_pnl = await get_period_pnl(uid, *today_bounds_utc())
+        week_pnl = await get_period_pnl(uid, *week_bounds_utc())
+        trades = await get_trades_today(uid)
+        if (abs(day_pnl - rc.day_pnl) > 1e-6 or abs(week_pnl - rc.week_pnl) > 1e-6
+                or trades != rc.day_trades):
+            logging.warning("risk counters drift uid=%s mem=(%.6f, %.6f, %d) sql=(%.6f, %.6f, %d)",
+                            uid, rc.day_pnl, rc.week_pnl, rc.day_trades, day_pnl, week_pnl, trades)
+            rc.day_pnl, rc.week_pnl, rc.day_trades = day_pnl, week_pnl, trades
+        return rc
 
-def check_limits(u: dict):
+risk_book = RiskBook()
+
+async def check_limits(u: dict):
     depo = float(u["depo"] or 0)
     if depo <= 0:
         return True, ""
-    start, end = today_bounds_utc()
-    pnl_day = get_period_pnl(u["user_id"], start, end)
-    day_pct = (pnl_day / depo) * 100.0
+    rc = await risk_book.verify(u["user_id"]) if RISK_VERIFY else risk_book.get(u["user_id"])
+    day_pct = (rc.day_pnl / depo) * 100.0
     if day_pct <= -abs(u["limit_daily"]):
         return False, "⛔ Дневной лимит просадки достигнут."
 
-    wstart, wend = week_bounds_utc()
-    pnl_week = get_period_pnl(u["user_id"], wstart, wend)
-    week_pct = (pnl_week / depo) * 100.0
+    week_pct = (rc.week_pnl / depo) * 100.0
     if week_pct <= -abs(u["limit_weekly"]):
         return False, "⛔ Недельный лимит просадки достигнут."
 
-    if get_trades_today(u["user_id"]) >= int(u["limit_max_trades"]):
+    if rc.day_trades >= int(u["limit_max_trades"]):
         return False, "⛔ Достигнут лимит сделок на сегодня."
     return True, ""
 
+# ---------------- Portfolio exposure ----------------
+class PortfolioBook:
+    """Открытая экспозиция юзеров: позиции из trades, оценка по PRICE_BOOK.
+
+    На юзера — {symbol: [qty, cost, gross_qty, n]}: qty/cost со знаком (шорт
+    сигналов < 0) дают нереализованный PnL, gross_qty — notional без взаимозачёта.
+    Проверка новой сделки — O(символов юзера); scan() считает всех юзеров разом в NumPy.
+    """
+
+    def __init__(self):
+        self.positions = {}  # uid -> {symbol: [qty, cost, gross_qty, сделок]}
+        self.trades = {}     # trade_id -> (uid, symbol, qty, cost)
+        self.breached = set()
+        self.rates = {}       # quote -> (курс к USDT, ts) из REST, пока стрим пары не дал цену
+        self._columns = None  # колонки для scan(); сбрасываются при любом изменении позиций
+
+    def on_open(self, trade_id, uid, symbol, entry, tp, vol):
+        pair = rate_symbol(split_symbol(symbol)[1])
+        if pair:
+            market_feed.watch(pair)
+        qty = -float(vol) if tp is not None and float(tp) < float(entry) else float(vol)
+        cost = qty * float(entry)
+        self.trades[trade_id] = (uid, symbol, qty, cost)
+        pos = self.positions.setdefault(uid, {}).setdefault(symbol, [0.0, 0.0, 0.0, 0])
+        pos[0] += qty
+        pos[1] += cost
+        pos[2] += abs(qty)
+        pos[3] += 1
+        self._columns = None
+
+    def on_close(self, trade_id):
+        t = self.trades.pop(trade_id, None)
+        if t is None:
+            return
+        uid, symbol, qty, cost = t
+        book = self.positions[uid]
+        pos = book[symbol]
+        pos[0] -= qty
+        pos[1] -= cost
+        pos[2] -= abs(qty)
+        pos[3] -= 1
+        if not pos[3]:
+            del book[symbol]
+            if not book:
+                del self.positions[uid]
+        self._columns = None
+
+    async def rebuild(self):
+        rows = await db_query("""SELECT id, user_id, symbol, entry, tp, volume FROM trades
+                                 WHERE status IN ('open','signal_open') AND user_id % ? = ?""",
+                              (WORKER_COUNT, WORKER_INDEX))
+        self.positions, self.trades = {}, {}
+        for row in rows:
+            self.on_open(*row)
+        return len(self.trades)
+
+    def quote_rate(self, quote: str):
+        """Курс котировки к USDT: стрим пары, иначе свежий REST-курс; нет ни того, ни другого — None."""
+        pair = rate_symbol(quote)
+        if pair is None:
+            return 1.0
+        q = PRICE_BOOK.get(pair)
+        if q and q.last:
+            return 1.0 / q.last if quote in INVERSE_QUOTES else q.last
+        rate, ts = self.rates.get(quote, (None, 0.0))
+        return rate if time.time() - ts <= PORTFOLIO_RATE_TTL else None
+
+    async def ensure_rates(self, u, symbols):
+        """Курсы котировок для проверки лимитов: подписка на пару и разовый REST, пока стрим молчит."""
+        if not any(float(u[k] or 0) for k in ("limit_max_exposure", "limit_max_asset", "limit_max_open_dd")):
+            return
+        for quote in {split_symbol(s)[1] for s in symbols}:
+            pair = rate_symbol(quote)
+            if pair is None or self.quote_rate(quote) is not None:
+                continue
+            market_feed.watch(pair)
+            try:
+                price = await ex_call(0, public_price, pair)
+            except Exception:
+                continue  # check() откажет: без курса экспозицию не оценить
+            self.rates[quote] = (1.0 / price if quote in INVERSE_QUOTES else price, time.time())
+
+    def mark(self, symbol: str, qty: float, cost: float, gross: float):
+        """-> (notional, нереализованный PnL) в USDT или None, если курса котировки нет;
+        нет цены символа — по средней цене входа."""
+        rate = self.quote_rate(split_symbol(symbol)[1])
+        if rate is None:
+            return None
+        q = PRICE_BOOK.get(symbol)
+        price = q.last if q else (cost / qty if qty else 0.0)
+        return gross * price * rate, (qty * price - cost) * rate
+
+    def notional(self, symbol: str, qty: float, price: float):
+        rate = self.quote_rate(split_symbol(symbol)[1])
+        return None if rate is None else qty * price * rate
+
+    def summary(self, uid: int) -> dict:
+        """unpriced — котировки без курса к USDT: их позиции в суммы не вошли."""
+        s = {"total": 0.0, "upnl": 0.0, "symbols": {}, "assets": {}, "quotes": {}, "unpriced": set()}
+        for symbol, (qty, cost, gross, _) in self.positions.get(uid, {}).items():
+            base, quote = split_symbol(symbol)
+            marked = self.mark(symbol, qty, cost, gross)
+            if marked is None:
+                s["unpriced"].add(quote)
+                continue
+            notional, upnl = marked
+            s["total"] += notional
+            s["upnl"] += upnl
+            s["symbols"][symbol] = (notional, upnl)
+            s["assets"][base] = s["assets"].get(base, 0.0) + notional
+            s["quotes"][quote] = s["quotes"].get(quote, 0.0) + notional
+        return s
+
+    def check(self, u, symbol: str, notional: float, pending=()):
+        """Лимиты портфеля для новой сделки; pending — [(symbol, notional)] уже принятых в этой пачке."""
+        depo = float(u["depo"] or 0)
+        max_total, max_asset, max_dd = (float(u[k] or 0) for k in
+                                        ("limit_max_exposure", "limit_max_asset", "limit_max_open_dd"))
+        if depo <= 0 or not (max_total or max_asset or max_dd):
+            return True, ""
+        s = self.summary(u["user_id"])
+        unpriced = s["unpriced"] | ({split_symbol(symbol)[1]} if notional is None else set())
+        if unpriced:
+            return False, (f"⛔ Нет курса {', '.join(sorted(unpriced))} к USDT — экспозицию не оценить, "
+                           f"попробуй чуть позже.")
+        if max_dd and s["upnl"] <= -depo * max_dd / 100.0:
+            return False, f"⛔ Лимит нереализованной просадки: {s['upnl']:.2f} USDT ({max_dd}% депо)."
+        total = s["total"] + sum(n for _, n in pending) + notional
+        if max_total and total > depo * max_total / 100.0:
+            return False, (f"⛔ Лимит экспозиции: открыто {s['total']:.2f} + {notional:.2f} USDT "
+                           f"> {max_total}% депо.")
+        base = split_symbol(symbol)[0]
+        in_asset = (s["assets"].get(base, 0.0) + notional
+                    + sum(n for sym, n in pending if split_symbol(sym)[0] == base))
+        if max_asset and in_asset > depo * max_asset / 100.0:
+            return False, f"⛔ Лимит на актив {base}: {in_asset:.2f} USDT > {max_asset}% депо."
+        return True, ""
+
+    def _build_columns(self):
+        import numpy as np
+        uids, syms, rows = [], [], []
+        for uid, book in self.positions.items():
+            for symbol, (qty, cost, gross, _) in book.items():
+                uids.append(uid)
+                syms.append(symbol)
+                rows.append((qty, cost, gross))
+        user_ids, user_idx = np.unique(np.array(uids, dtype=np.int64), return_inverse=True)
+        symbols = sorted(set(syms))
+        pos = {s: i for i, s in enumerate(symbols)}
+        sym_idx = np.array([pos[s] for s in syms], dtype=np.intp)
+        self._columns = (user_ids, user_idx, symbols, sym_idx, np.array(rows, dtype=float).reshape(-1, 3))
+        return self._columns
+
+    def scan(self):
+        """Все юзеры шарда разом -> (user_ids, exposure, upnl) в USDT; цены берутся по символу один раз."""
+        import numpy as np
+        user_ids, user_idx, symbols, sym_idx, data = self._columns or self._build_columns()
+        if not len(user_ids):
+            return user_ids, np.zeros(0), np.zeros(0)
+        book = [PRICE_BOOK.get(s) for s in symbols]
+        price = np.array([q.last if q else np.nan for q in book])[sym_idx]
+        rate = np.array([self.quote_rate(split_symbol(s)[1]) for s in symbols], dtype=float)[sym_idx]  # None -> nan
+        qty, cost, gross = data[:, 0], data[:, 1], data[:, 2]
+        no_price = np.isnan(price)
+        if no_price.any():  # по средней цене входа
+            price[no_price] = np.divide(cost[no_price], qty[no_price],
+                                        out=np.zeros(no_price.sum()), where=qty[no_price] != 0)
+        exposure = np.bincount(user_idx, weights=gross * price * rate, minlength=len(user_ids))
+        upnl = np.bincount(user_idx, weights=(qty * price - cost) * rate, minlength=len(user_ids))
+        return user_ids, exposure, upnl
+
+    async def watch(self):
+        """Раз в PORTFOLIO_SCAN_SEC: кто пробил лимит нереализованной просадки — одно уведомление на эпизод."""
+        while True:
+            await asyncio.sleep(PORTFOLIO_SCAN_SEC)
+            try:
+                user_ids, _, upnl = self.scan()
+                breached = set()
+                for uid, loss in zip(user_ids[upnl < 0].tolist(), upnl[upnl < 0].tolist()):
+                    u = await get_user(uid)
+                    depo, max_dd = float(u["depo"] or 0), float(u["limit_max_open_dd"] or 0)
+                    if depo > 0 and max_dd and loss <= -depo * max_dd / 100.0:
+                        breached.add(uid)
+                        if uid not in self.breached:
+                            outbox.notify(uid, f"⚠️ Нереализованная просадка {loss:.2f} USDT превысила "
+                                               f"{max_dd}% депо — новые сделки заблокированы.")
+                self.breached = breached
+            except Exception:
+                logging.exception("portfolio scan failed")
+
+portfolio = PortfolioBook()
+
+# ---------------- Archive ----------------
+# Холодный слой: закрытые сделки старше ARCHIVE_DAYS уезжают из SQLite в
+# Parquet по юзеру и месяцу created_at. Чтение: месяцы вне диапазона
+# отсекаются по каталогам, остальное фильтруется pyarrow по статистике row
+# groups. Горячие строки имеют приоритет: id, уже лежащий в SQLite (архиватор
+# упал между записью файла и удалением), из архива пропускается.
+ARCHIVE_COLUMNS = ["id", "symbol", "entry", "tp", "sl", "volume", "status", "exit", "pnl",
+                   "created_at", "closed_at", "commission"]
+_archive_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="archive")
+
+def _arrow():
+    """(pyarrow, pyarrow.parquet, pyarrow.dataset) или None — зависимость необязательная."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        import pyarrow.dataset as ds
+    except ImportError:
+        return None
+    return pa, pq, ds
+
+def archive_user_dir(uid: int) -> str:
+    return os.path.join(ARCHIVE_DIR, f"user_id={uid}")
+
+def has_archive(uid: int) -> bool:
+    return os.path.isdir(archive_user_dir(uid))
+
+def write_archive(rows: list) -> int:
+    """rows: (user_id, *ARCHIVE_COLUMNS), отсортированы по user_id, created_at -> файлов записано.
+
+    Один файл на (юзер, месяц), дописывается без повторов по id: если архиватор
+    упал между записью и DELETE, следующий проход не создаст вторую копию строк.
+    """
+    pa, pq, _ = _arrow()
+    schema = pa.schema([("id", pa.int64()), ("symbol", pa.string()), ("entry", pa.float64()),
+                        ("tp", pa.float64()), ("sl", pa.float64()), ("volume", pa.float64()),
+                        ("status", pa.string()), ("exit", pa.float64()), ("pnl", pa.float64()),
+                        ("created_at", pa.string()), ("closed_at", pa.string()), ("commission", pa.float64())])
+    created = ARCHIVE_COLUMNS.index("created_at") + 1
+    groups = {}
+    for r in rows:
+        groups.setdefault((r[0], r[created][:7]), []).append(r[1:])
+    for (uid, month), part in groups.items():
+        d = os.path.join(archive_user_dir(uid), f"month={month}")
+        os.makedirs(d, exist_ok=True)
+        path, tmp = os.path.join(d, "trades.parquet"), os.path.join(d, ".trades.parquet.tmp")  # "." — dataset не читает
+        old = pq.read_table(path, schema=schema) if os.path.exists(path) else None
+        if old is not None:
+            archived = set(old.column("id").to_pylist())
+            part = [row for row in part if row[0] not in archived]
+        table = pa.table([[row[i] for row in part] for i in range(len(ARCHIVE_COLUMNS))], schema=schema)
+        if old is not None:
+            table = pa.concat_tables([old, table])
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, path)
+    return len(groups)
+
+async def archive_old_trades(days: int) -> int:
+    """Переносит закрытые сделки старше days дней своего шарда в Parquet; возвращает число строк."""
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat(" ")
+    loop = asyncio.get_running_loop()
+    total = 0
+    while True:
+        rows = await db_query(f"""SELECT user_id, {', '.join(ARCHIVE_COLUMNS)} FROM trades
+                                  WHERE status IN ('win','loss') AND closed_at < ? AND user_id % ? = ?
+                                  ORDER BY user_id, created_at, id LIMIT ?""",
+                              (cutoff, WORKER_COUNT, WORKER_INDEX, ARCHIVE_BATCH))
+        if not rows:
+            return total
+        with metrics.span("archive.write"):
+            await loop.run_in_executor(_archive_pool, write_archive, rows)
+        ids = [(r[1],) for r in rows]
+        await db_write(lambda c: c.executemany("DELETE FROM trades WHERE id=?", ids))
+        total += len(rows)
+        if len(rows) < ARCHIVE_BATCH:
+            return total
+
+async def archiver():
+    if not ARCHIVE_DAYS:
+        return
+    if _arrow() is None:
+        logging.warning("ARCHIVE_DAYS=%s, но pyarrow не установлен — архив выключен", ARCHIVE_DAYS)
+        return
+    while True:
+        try:
+            # неделя нужна горячей: недельный лимит и счётчики риска читают trades
+            n = await archive_old_trades(max(ARCHIVE_DAYS, 8))
+            if n:
+                logging.info("archived %d closed trades", n)
+        except Exception:
+            logging.exception("archive failed")
+        await asyncio.sleep(ARCHIVE_EVERY)
+
+def read_archive(uid: int, columns: list, flt: dict = None):
+    """Таблицы pyarrow по месяцам (по возрастанию), отфильтрованные по flt: from/to (created_at), symbol."""
+    if not has_archive(uid):
+        return
+    arrow = _arrow()
+    if arrow is None:
+        logging.warning("archive of %s skipped: pyarrow не установлен", uid)
+        return
+    _, _, ds = arrow
+    flt = flt or {}
+    lo, hi, symbol = flt.get("from"), flt.get("to"), flt.get("symbol")
+    expr = None
+    for cond in ((ds.field("created_at") >= lo) if lo else None,
+                 (ds.field("created_at") < hi) if hi else None,
+                 (ds.field("symbol") == symbol) if symbol else None):
+        if cond is not None:
+            expr = cond if expr is None else expr & cond
+    base = archive_user_dir(uid)
+    for month_dir in sorted(os.listdir(base)):
+        month = month_dir.partition("=")[2]
+        if (lo and month < lo[:7]) or (hi and month > hi[:7]):
+            continue
+        table = ds.dataset(os.path.join(base, month_dir), format="parquet").to_table(columns=columns, filter=expr)
+        if table.num_rows:
+            yield table
+
+def iter_archive_rows(uid: int, columns: list, flt: dict = None, sort_by=("created_at", "id")):
+    """Строки архива кортежами, внутри месяца отсортированы по sort_by."""
+    for table in read_archive(uid, columns, flt):
+        table = table.sort_by([(c, "ascending") for c in sort_by])
+        yield from zip(*(table.column(c).to_pylist() for c in columns))
+
+def drop_archived_dups(rows):
+    """Строки горячего слоя и архива, уже слитые по (время, id) горячими вперёд:
+    сделка, что есть в обоих (архиватор упал между записью файла и DELETE), идёт
+    подряд — оставляем первую, из SQLite. Память не зависит от длины истории."""
+    last = None
+    for row in rows:
+        if row[0] != last:
+            yield row
+        last = row[0]
+
+def read_archived_pnl(uid: int) -> list:
+    """(id, closed_at, pnl) всех архивных сделок юзера."""
+    return list(iter_archive_rows(uid, ["id", "closed_at", "pnl"], sort_by=("closed_at", "id")))
+
+# ---------------- Charts ----------------
+def render_equity_png(closed_at: list, pnl: list) -> bytes:
+    """Equity curve в PNG. Выполняется в процессе пула: только Figure API, без pyplot."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(7, 4.5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.plot([datetime.fromisoformat(x) for x in closed_at], list(accumulate(pnl)), marker="o")
+    ax.set_title("Equity Curve (Cumulative PnL)")
+    ax.set_xlabel("Дата")
+    ax.set_ylabel("USDT")
+    ax.grid(True)
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+_render_pool = None
+
+def _watch_parent(parent: int):
+    # процесс пула не замечает смерти воркера (kill -9) и остаётся сиротой — выходим сами;
+    # родитель в ОС у него forkserver, поэтому следим за pid воркера напрямую
+    while True:
+        try:
+            os.kill(parent, 0)
+        except ProcessLookupError:
+            os._exit(0)
+        except PermissionError:
+            pass
+        time.sleep(1)
+
+def _render_init(parent: int):
+    threading.Thread(target=_watch_parent, args=(parent,), daemon=True).start()
+
+def _new_render_pool() -> ProcessPoolExecutor:
+    # fork из многопоточного процесса (пулы, DBWriter) может унести чужую захваченную блокировку
+    return ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("forkserver"),
+                               initializer=_render_init, initargs=(os.getpid(),))
+
+# uid -> PNG; запись сбрасывает settle_trade, т.е. график валиден до следующей закрытой сделки
+_equity_cache = OrderedDict()  # uid -> (id последней закрытой сделки, PNG)
+
+async def equity_png(uid: int):
+    """PNG equity пользователя (из кэша или из пула процессов), None если закрытых сделок нет.
+
+    Кэш годен, пока id последней закрытой сделки тот же: рендер, начатый до
+    закрытия новой сделки, кладёт PNG со старым ключом и при следующем запросе не отдаётся.
+    """
+    global _render_pool
+    last = await db_query("""SELECT id FROM trades WHERE user_id=? AND status IN ('win','loss')
+                             ORDER BY closed_at DESC, id DESC LIMIT 1""", (uid,), one=True)
+    key = last[0] if last else None
+    cached = _equity_cache.get(uid)
+    if cached is not None and cached[0] == key:
+        _equity_cache.move_to_end(uid)
+        return cached[1]
+    rows = await db_query("""SELECT id, closed_at, pnl FROM trades
+                             WHERE user_id=? AND status IN ('win','loss') ORDER BY closed_at, id""", (uid,))
+    if has_archive(uid):
+        with metrics.span("archive.read"):
+            cold = await asyncio.get_running_loop().run_in_executor(_archive_pool, read_archived_pnl, uid)
+        # архив разложен по месяцам created_at, по closed_at он не упорядочен — сортируем всё
+        # (sorted устойчив: при равном (closed_at, id) горячая строка остаётся первой)
+        rows = list(drop_archived_dups(sorted(rows + cold, key=lambda r: (r[1], r[0]))))
+    if not rows:
+        return None
+    if _render_pool is None:
+        _render_pool = _new_render_pool()
+    _, closed_at, pnl = zip(*rows)
+    with metrics.span("render.equity"):
+        png = await asyncio.get_running_loop().run_in_executor(
+            _render_pool, render_equity_png, list(closed_at), list(pnl))
+    _equity_cache[uid] = (key, png)
+    while len(_equity_cache) > EQUITY_CACHE_SIZE:
+        _equity_cache.popitem(last=False)
+    return png
+
+# ---------------- Export ----------------
+EXPORT_COLUMNS = ["id", "symbol", "entry", "tp", "sl", "volume", "status", "exit", "pnl", "created_at", "closed_at"]
+_export_pool = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+def parse_export_filters(args: str) -> dict:
+    """from=YYYY-MM-DD to=YYYY-MM-DD symbol=BTCUSDT -> {"from", "to", "symbol"}; даты по created_at,
+    to включительно (в фильтре — начало следующего дня)."""
+    flt = {}
+    for p in (args or "").split():
+        key, _, val = p.partition("=")
+        if key == "from":
+            flt["from"] = datetime.fromisoformat(val).isoformat(" ")
+        elif key == "to":
+            flt["to"] = (datetime.fromisoformat(val) + timedelta(days=1)).isoformat(" ")
+        elif key == "symbol":
+            flt["symbol"] = val.upper()
+        else:
+            raise ValueError(p)
+    return flt
+
+def _sql_filter(flt: dict):
+    sql, params = [], []
+    for key, cond in (("from", "created_at >= ?"), ("to", "created_at < ?"), ("symbol", "symbol = ?")):
+        if key in flt:
+            sql.append(cond)
+            params.append(flt[key])
+    return "".join(f" AND {x}" for x in sql), params
+
+def _iter_trade_rows(uid: int, flt: dict, page: int = 1000):
+    """Сделки (архив + SQLite) в порядке created_at, id: курсор отдельного read-only
+    соединения и архив по месяцам сливаются, память не растёт с историей."""
+    where, params = _sql_filter(flt)
+    c = _db_connect(readonly=True)
+    try:
+        cursor = c.execute(f"""SELECT {', '.join(EXPORT_COLUMNS)} FROM trades
+                               WHERE user_id=?{where} ORDER BY created_at, id""", [uid, *params])
+        hot = (row for rows in iter(lambda: cursor.fetchmany(page), []) for row in rows)
+        if not has_archive(uid):
+            yield from hot
+            return
+        created = EXPORT_COLUMNS.index("created_at")
+        # merge при равном ключе отдаёт сначала строку первого потока — горячего
+        yield from drop_archived_dups(heapq.merge(hot, iter_archive_rows(uid, EXPORT_COLUMNS, flt),
+                                                  key=lambda r: (r[created], r[0])))
+    finally:
+        c.close()
+
+def write_trades_csv(uid: int, flt: dict):
+    """CSV в spooled-буфер; возвращает (файл, число строк)."""
+    buf = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    text = io.TextIOWrapper(buf, encoding="utf-8", newline="")
+    w = csv.writer(text, lineterminator="\n")
+    w.writerow(EXPORT_COLUMNS)
+    n = 0
+    for row in _iter_trade_rows(uid, flt):
+        w.writerow(row)
+        n += 1
+    text.flush()
+    text.detach()
+    buf.seek(0)
+    return buf, n
+
+def write_trades_xlsx(uid: int, flt: dict):
+    """XLSX (openpyxl write-only) + лист Summary, посчитанный по ходу выгрузки."""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Trades")
+    ws.append(EXPORT_COLUMNS + ["risk_R", "reward_R", "rr_ratio"])
+    n = closed = wins = 0
+    total_pnl = 0.0
+    for row in _iter_trade_rows(uid, flt):
+        entry, tp, sl, status, pnl = row[2], row[3], row[4], row[6], row[8]
+        risk_r = entry - sl if entry is not None and sl is not None else None
+        reward_r = tp - entry if tp is not None and entry is not None else None
+        rr = reward_r / risk_r if risk_r and reward_r is not None else None
+        ws.append(list(row) + [risk_r, reward_r, rr])
+        n += 1
+        if status in ("win", "loss"):
+            closed += 1
+            wins += (pnl or 0) > 0
+            total_pnl += pnl or 0
+    summary = wb.create_sheet("Summary")
+    summary.append(["total_trades", "closed_trades", "wins", "losses", "winrate_%", "total_pnl"])
+    summary.append([n, closed, wins, closed - wins, (wins / closed * 100) if closed else 0.0, total_pnl])
+    buf = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    wb.save(buf)
+    buf.seek(0)
+    return buf, n
+
+async def export_trades(message: types.Message, writer, ext: str):
+    uid = message.from_user.id
+    try:
+        flt = parse_export_filters(message.get_args())
+    except ValueError:
+        await reply(message, f"⚠️ Пример: /export_{ext} from=2024-01-01 to=2024-12-31 symbol=BTCUSDT")
+        return
+    loop = asyncio.get_running_loop()
+    with metrics.span(f"export.{ext}"):
+        buf, n = await loop.run_in_executor(_export_pool, writer, uid, flt)
+    try:
+        if not n:
+            await reply(message, "Нет сделок для экспорта.")
+            return
+        await outbox.send(message.chat.id, bot.send_document, types.InputFile(buf, filename=f"trades_{uid}.{ext}"))
+    finally:
+        buf.close()
+
+# ---------------- Trade entry ----------------
+class TradeRejected(Exception):
+    """Сетап не прошёл проверку; текст исключения — готовый ответ пользователю."""
+
+def size_trade(u, entry: float, sl: float) -> float:
+    """Объём по риску: risk_amount / stop_distance."""
+    risk_pct = float(u["risk"] or 0)
+    depo = float(u["depo"] or 0)
+    if risk_pct <= 0 or depo <= 0:
+        raise TradeRejected("⚠️ Сначала задай депозит и риск: /set_depo и /set_risk")
+    stop_distance = abs(entry - sl)
+    if stop_distance <= 0:
+        raise TradeRejected("⚠️ Некорректный SL.")
+    risk_amount = depo * (risk_pct / 100.0)
+    return risk_amount / stop_distance
+
+def fit_to_filters(meta: SymbolMeta, symbol: str, entry, tp, sl, raw_volume):
+    """Округление под step/tick и проверка minQty/minNotional -> (qty, entry, tp, sl)."""
+    qty = _round_qty(raw_volume, meta.step)
+    entry_r = float(_round_price(entry, meta.tick))
+    tp_r = float(_round_price(tp, meta.tick))
+    sl_r = float(_round_price(sl, meta.tick))
+    if qty <= 0 or qty < meta.min_qty:
+        raise TradeRejected(f"⚠️ Объём {qty} меньше минимального {meta.min_qty} для {symbol}")
+    if float(qty) * entry_r < meta.min_notional:
+        raise TradeRejected(f"⚠️ Сумма ордера меньше минимальной ({meta.min_notional} USDT) для {symbol}")
+    return qty, entry_r, tp_r, sl_r
+
+Placement = namedtuple("Placement", "avg_entry qty order_id commission oco_list_id oco_order_ids")
+
+async def place_oco(uid: int, client, meta: SymbolMeta, symbol: str, qty, tp_r, sl_r):
+    """OCO SELL (TP/SL) -> (orderListId, orderId ног через запятую)."""
+    stop_limit_price = float(_round_price(sl_r * 0.999, meta.tick))
+    oco = await ex_call(
+        uid, client.create_oco_order, symbol=symbol, side=SIDE_SELL, quantity=str(qty),
+        price=str(tp_r), stopPrice=str(sl_r),
+        stopLimitPrice=str(stop_limit_price), stopLimitTimeInForce="GTC"
+    )
+    return oco.get("orderListId"), ",".join(str(o["orderId"]) for o in oco.get("orders", []))
+
+async def place_auto_trade(uid: int, client, meta: SymbolMeta, symbol: str, qty, entry_r, tp_r, sl_r) -> Placement:
+    """MARKET BUY + OCO SELL (TP/SL).
+
+    Если OCO не встал после исполненной покупки, позиция всё равно возвращается
+    (oco_list_id=None): её сохраняют, а Reconciler выставляет OCO заново.
+    """
+    order = await ex_call(
+        uid, client.create_order, symbol=symbol, side=SIDE_BUY, type=ORDER_TYPE_MARKET, quantity=str(qty)
+    )
+
+    # средняя цена и комиссия из fills (если биржа вернула); комиссия в базовой
+    # валюте уменьшает то, что реально можно продать
+    avg_entry, sell_qty, fee = entry_r, qty, 0.0
+    if order.get('fills'):
+        exec_qty, exec_quote, base_fee = Decimal('0'), Decimal('0'), Decimal('0')
+        for f in order['fills']:
+            exec_qty += Decimal(f['qty'])
+            exec_quote += Decimal(f['price']) * Decimal(f['qty'])
+            asset, commission = f.get('commissionAsset'), f.get('commission') or '0'
+            if asset and symbol.startswith(asset):
+                base_fee += Decimal(commission)
+            fee += fee_in_quote(symbol, float(commission), asset, float(f['price']))
+        if exec_qty > 0:
+            avg_entry = float(exec_quote / exec_qty)
+            sell_qty = _round_qty(exec_qty - base_fee, meta.step)
+
+    try:
+        oco_list_id, oco_order_ids = await place_oco(uid, client, meta, symbol, sell_qty, tp_r, sl_r)
+    except Exception:
+        logging.exception("OCO %s for user %s failed after market buy", symbol, uid)
+        oco_list_id, oco_order_ids = None, None
+    return Placement(avg_entry, sell_qty, order.get("orderId"), fee, oco_list_id, oco_order_ids)
+
+def track_trade(trade_id, uid, symbol, entry, tp, sl, status, oco_list_id=None):
+    trade_monitor.add(trade_id, uid, symbol, entry, tp, sl, status, oco_list_id)
+    market_feed.watch(symbol)
+    if status == "open":
+        user_streams.watch(uid)
+
+def parse_setups(text: str):
+    """Строки "SYMBOL ENTRY TP SL" (пробелы/запятые/;) -> ([(n, symbol, entry, tp, sl)], [(n, ошибка)])."""
+    rows, errors = [], []
+    for n, line in enumerate((text or "").splitlines(), start=1):
+        parts = line.replace(",", " ").replace(";", " ").split()
+        if not parts:
+            continue
+        try:
+            rows.append((n, parts[0].upper(), float(parts[1]), float(parts[2]), float(parts[3])))
+        except (IndexError, ValueError):
+            if not (n == 1 and parts[0].lower() == "symbol"):  # заголовок CSV
+                errors.append((n, "ожидается SYMBOL ENTRY TP SL"))
+    return rows, errors
+
+async def open_bulk(u, setups: list):
+    """Пачка сетапов: лимиты один раз, фильтры из кэша, ордера параллельно, запись одной транзакцией.
+
+    Возвращает (opened, rejected): opened — (trade_id, symbol, qty, entry, tp, sl, есть ли OCO),
+    rejected — (номер строки, причина).
+    """
+    uid = u["user_id"]
+    ok, reason = await check_limits(u)
+    if not ok:
+        return [], [(n, reason) for n, *_ in setups]
+    rejected = []
+    room = max(int(u["limit_max_trades"]) - risk_book.get(uid).day_trades, 0)
+    if len(setups) > room:
+        rejected += [(n, "⛔ лимит сделок на сегодня") for n, *_ in setups[room:]]
+        setups = setups[:room]
+
+    sized = []
+    for n, symbol, entry, tp, sl in setups:
+        try:
+            sized.append((n, symbol, entry, tp, sl, size_trade(u, entry, sl)))
+        except TradeRejected as e:
+            rejected.append((n, str(e)))
+    pending = []  # (symbol, notional) принятых сетапов — для лимитов портфеля
+    await portfolio.ensure_rates(u, {item[1] for item in sized})
+
+    if u["mode"] == "signal":
+        accepted = []
+        for item in sized:
+            n, sym, e, _, _, vol = item
+            notional = portfolio.notional(sym, vol, e)
+            ok, reason = portfolio.check(u, sym, notional, pending)
+            if not ok:
+                rejected.append((n, reason))
+                continue
+            pending.append((sym, notional))
+            accepted.append(item)
+        sized = accepted
+        ids = await save_trades(uid, [(sym, e, tp, sl, vol, "signal_open", None) for _, sym, e, tp, sl, vol in sized])
+        opened = []
+        for trade_id, (_, sym, e, tp, sl, vol) in zip(ids, sized):
+            track_trade(trade_id, uid, sym, e, tp, sl, "signal_open")
+            opened.append((trade_id, sym, vol, e, tp, sl, True))
+        return opened, rejected
+
+    client = await user_client(u)
+    testnet = bool(u["use_testnet"])
+    metas = {}
+    for sym in {r[1] for r in sized}:
+        try:
+            metas[sym] = (cached_symbol_meta(sym, testnet)
+                          or await ex_call(uid, _get_symbol_filters, client, sym, testnet))
+        except Exception as e:
+            metas[sym] = e
+    ready = []
+    for n, sym, entry, tp, sl, vol in sized:
+        meta = metas[sym]
+        try:
+            if isinstance(meta, Exception):
+                raise TradeRejected(f"⚠️ {meta}")
+            ready.append((n, sym, meta) + fit_to_filters(meta, sym, entry, tp, sl, vol))
+        except TradeRejected as e:
+            rejected.append((n, str(e)))
+
+    # баланс — один запрос на всю пачку, сетапы берём по порядку, пока хватает
+    free_usdt = await ex_call(uid, user_get_balance, client, "USDT")
+    affordable = []
+    for item in ready:
+        n, sym, meta, qty, entry_r = item[:5]
+        need = float(qty) * (fresh_price(sym, testnet) or entry_r)
+        if need > free_usdt:
+            rejected.append((n, f"⚠️ Недостаточно USDT: нужно {need:.2f}, доступно {free_usdt:.2f}"))
+            continue
+        notional = portfolio.notional(sym, float(qty), fresh_price(sym, testnet) or entry_r)
+        ok, reason = portfolio.check(u, sym, notional, pending)
+        if not ok:
+            rejected.append((n, reason))
+            continue
+        pending.append((sym, notional))
+        free_usdt -= need
+        affordable.append(item)
+
+    async def place(item):
+        n, sym, meta, qty, entry_r, tp_r, sl_r = item
+        try:
+            return item, await place_auto_trade(uid, client, meta, sym, qty, entry_r, tp_r, sl_r)
+        except Exception as e:
+            return item, e
+
+    placed = []
+    for item, res in await asyncio.gather(*(place(i) for i in affordable)):
+        if isinstance(res, Exception):
+            rejected.append((item[0], f"⛔ {res}"))
+        else:
+            placed.append((item, res))
+    ids = await save_trades(uid, [(sym, p.avg_entry, tp_r, sl_r, float(p.qty), "open", p.oco_list_id,
+                                   p.order_id, p.oco_order_ids, p.commission)
+                                  for (_, sym, _, _, _, tp_r, sl_r), p in placed])
+    opened = []
+    for trade_id, ((_, sym, _, _, _, tp_r, sl_r), p) in zip(ids, placed):
+        track_trade(trade_id, uid, sym, p.avg_entry, tp_r, sl_r, "open", p.oco_list_id)
+        opened.append((trade_id, sym, float(p.qty), p.avg_entry, tp_r, sl_r, p.oco_list_id is not None))
+    return opened, rejected
+
+def format_bulk_result(opened: list, rejected: list) -> str:
+    lines = [f"📦 Пакет: открыто {len(opened)}, отклонено {len(rejected)}"]
+    lines += [f"✅ #{tid} {sym} vol≈{vol:.6f} entry={e} TP={tp} SL={sl}" + ("" if protected else " ⚠️ без OCO, бот повторит")
+              for tid, sym, vol, e, tp, sl, protected in opened]
+    lines += [f"• строка {n}: {reason}" for n, reason in sorted(rejected)]
+    text = "\n".join(lines)
+    return text if len(text) <= 4000 else text[:3990] + "\n…"
+
 # ================== Start / Mode select ==================
-@dp.message_handler(commands=['start'])
-async def start_cmd(message: types.Message):
+@dp.message_handler(commands=['start'], state="*")
+async def start_cmd(message: types.Message, state: FSMContext):
     uid = message.from_user.id
-    u = get_user(uid)
+    u = await get_user(uid)
+    await state.finish()
 
     kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     kb.add("📩 Сигналы", "🤖 Авто-трейд")
-    await message.answer(
+    await reply(message,
         "Привет! Выбери режим работы бота:\n"
         "• 📩 Сигналы — только рекомендации, без реальных ордеров\n"
         "• 🤖 Авто‑трейд — реальные ордера через Binance (нужны API ключи)",
         reply_markup=kb
     )
 
-@dp.message_handler(lambda m: m.text in ["📩 Сигналы", "🤖 Авто-трейд"])
-async def set_mode(message: types.Message):
+MODE_BUTTONS = {"📩 Сигналы": "signal", "🤖 Авто-трейд": "auto"}
+
+class KeySetup(StatesGroup):
+    """Мастер ввода Binance ключей: хендлеры шагов срабатывают только в своём состоянии."""
+    api_key = State()
+    api_secret = State()
+    network = State()
+
+@dp.message_handler(text=list(MODE_BUTTONS), state="*")
+async def set_mode(message: types.Message, state: FSMContext):
     uid = message.from_user.id
-    if "Сигналы" in message.text:
-        set_user(uid, mode="signal")
-        await message.answer("✅ Режим «Сигналы» активирован. Буду записывать сделки в журнал без реальной торговли.",
-                             reply_markup=ReplyKeyboardRemove())
+    if MODE_BUTTONS[message.text] == "signal":
+        await state.finish()
+        await set_user(uid, mode="signal")
+        await reply(message, "✅ Режим «Сигналы» активирован. Буду записывать сделки в журнал без реальной торговли.",
+                    reply_markup=ReplyKeyboardRemove())
     else:
-        set_user(uid, mode="auto")
+        await set_user(uid, mode="auto")
+        await KeySetup.api_key.set()
         kb = ReplyKeyboardRemove()
-        await message.answer("🤖 Режим «Авто‑трейд». Пришли *Binance API Key* сообщением.",
-                             reply_markup=kb, parse_mode="Markdown")
+        await reply(message, "🤖 Режим «Авто‑трейд». Пришли *Binance API Key* сообщением.\n/cancel — отменить",
+                    reply_markup=kb, parse_mode="Markdown")
 
-@dp.message_handler(lambda m: True)
-async def capture_keys(message: types.Message):
-    """Простая пошаговая логика ввода ключей для режима auto."""
-    uid = message.from_user.id
-    u = get_user(uid)
+@dp.message_handler(commands=['cancel'], state=KeySetup)
+async def key_setup_cancel(message: types.Message, state: FSMContext):
+    await state.finish()
+    await reply(message, "Ввод ключей отменён. Вернуться — /start", reply_markup=ReplyKeyboardRemove())
 
-    # ожидаем API ключ, если auto и ключей ещё нет
-    if u["mode"] == "auto" and not u["api_key"]:
-        if len(message.text.strip()) < 10:
-            await message.answer("⚠️ Похоже, это не API Key. Отправь корректный Binance API Key.")
-            return
-        set_user(uid, binance_api_key=message.text.strip())
-        await message.answer("Отлично! Теперь отправь *Binance API Secret* сообщением.",
-                             parse_mode="Markdown")
+@dp.message_handler(lambda m: not m.is_command(), state=KeySetup.api_key)
+async def key_setup_api_key(message: types.Message):
+    if len(message.text.strip()) < 10:
+        await reply(message, "⚠️ Похоже, это не API Key. Отправь корректный Binance API Key.")
         return
+    await set_user(message.from_user.id, binance_api_key=message.text.strip())
+    await KeySetup.next()
+    await reply(message, "Отлично! Теперь отправь *Binance API Secret* сообщением.",
+                parse_mode="Markdown")
 
-    if u["mode"] == "auto" and u["api_key"] and not u["api_secret"]:
-        if len(message.text.strip()) < 10:
-            await message.answer("⚠️ Похоже, это не API Secret. Отправь корректный Binance API Secret.")
-            return
-        set_user(uid, binance_api_secret=message.text.strip())
-        kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-        kb.add("Testnet", "Mainnet")
-        await message.answer("Выбери режим Binance для торговли:", reply_markup=kb)
+@dp.message_handler(lambda m: not m.is_command(), state=KeySetup.api_secret)
+async def key_setup_api_secret(message: types.Message):
+    if len(message.text.strip()) < 10:
+        await reply(message, "⚠️ Похоже, это не API Secret. Отправь корректный Binance API Secret.")
         return
+    await set_user(message.from_user.id, binance_api_secret=message.text.strip())
+    await KeySetup.next()
+    kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    kb.add("Testnet", "Mainnet")
+    await reply(message, "Выбери режим Binance для торговли:", reply_markup=kb)
 
-    if u["mode"] == "auto" and u["api_key"] and u["api_secret"] and message.text in ["Testnet", "Mainnet"]:
-        use_testnet = 1 if message.text == "Testnet" else 0
-        set_user(uid, use_testnet=use_testnet)
-        await message.answer("✅ Ключи сохранены. Можно торговать командами.\n"
-                             "Подсказка: /help", reply_markup=ReplyKeyboardRemove())
-        return
+@dp.message_handler(text=["Testnet", "Mainnet"], state=KeySetup.network)
+async def key_setup_network(message: types.Message, state: FSMContext):
+    await set_user(message.from_user.id, use_testnet=1 if message.text == "Testnet" else 0)
+    await state.finish()
+    await reply(message,
+        "✅ Ключи сохранены. Можно торговать командами.\n"
+        "Подсказка: /help",
+        reply_markup=ReplyKeyboardRemove()
+    )
 
-    # если это не ввод ключей — кинем help при /help
-    if message.text == "/help":
-        await send_help(message)
-        return
+@dp.message_handler(state=KeySetup)
+async def key_setup_other(message: types.Message):
+    await reply(message, "⚠️ Сейчас идёт ввод ключей — ответь на вопрос выше или /cancel")
 
 # ------------------- Commands core -------------------
 @dp.message_handler(commands=['help'])
 async def send_help(message: types.Message):
-    await message.answer(
+    await reply(message,
         "Команды:\n"
         "/set_depo 1000 — задать депозит (виртуальный)\n"
         "/set_risk 2 — риск на сделку (%)\n"
         "/set_limits daily=5 weekly=15 max_trades=20 — лимиты риска\n"
-        "/risk_limits — показать текущие лимиты\n\n"
+        "  портфель (% депо, 0 — выкл.): exposure=300 asset=100 open_dd=10\n"
+        "/risk_limits — показать текущие лимиты\n"
+        "/exposure — открытая экспозиция по символам и активам\n\n"
         "Торговля:\n"
         "/new_trade BTCUSDT 30000 32000 29000 — открыть (в signal: только запись)\n"
+        "/bulk_trade + строки SYMBOL ENTRY TP SL (или CSV файлом) — пачка сетапов\n"
         "/close_trade <id> <win|loss> <exit_price> — закрыть сделку вручную\n"
         "/balance — балансы (только auto)\n"
         "/cancel_all BTCUSDT — отменить ордера (auto)\n\n"
@@ -259,6 +2904,7 @@ async def send_help(message: types.Message):
         "/equity — график equity\n"
         "/export_csv — CSV\n"
         "/export_xlsx — Excel\n"
+        "  фильтры: from=2024-01-01 to=2024-12-31 symbol=BTCUSDT\n"
     )
 
 @dp.message_handler(commands=['set_depo'])
@@ -266,90 +2912,131 @@ async def set_depo_cmd(message: types.Message):
     try:
         val = float(message.get_args())
         uid = message.from_user.id
-        set_user(uid, depo=val)
-        await message.answer(f"💰 Депозит установлен: {val:.2f} USDT")
+        await set_user(uid, depo=val)
+        await reply(message, f"💰 Депозит установлен: {val:.2f} USDT")
     except:
-        await message.answer("⚠️ Пример: /set_depo 1000")
+        await reply(message, "⚠️ Пример: /set_depo 1000")
 
 @dp.message_handler(commands=['set_risk'])
 async def set_risk_cmd(message: types.Message):
     try:
         val = float(message.get_args())
         uid = message.from_user.id
-        set_user(uid, risk=val)
-        await message.answer(f"⚖️ Риск на сделку: {val:.2f}%")
+        await set_user(uid, risk=val)
+        await reply(message, f"⚖️ Риск на сделку: {val:.2f}%")
     except:
-        await message.answer("⚠️ Пример: /set_risk 2")
+        await reply(message, "⚠️ Пример: /set_risk 2")
 
 @dp.message_handler(commands=['set_limits'])
 async def set_limits_cmd(message: types.Message):
     uid = message.from_user.id
-    u = get_user(uid)
     parts = (message.get_args() or "").split()
     try:
+        fields = {}
         for p in parts:
-            if p.startswith("daily="): set_user(uid, limits_daily=float(p.split("=",1)[1]))
-            elif p.startswith("weekly="): set_user(uid, limits_weekly=float(p.split("=",1)[1]))
-            elif p.startswith("max_trades="): set_user(uid, limits_max_trades=int(p.split("=",1)[1]))
-        u = get_user(uid)
-        await message.answer(f"🛡️ Лимиты обновлены: "
-                             f"day {u['limit_daily']}% | week {u['limit_weekly']}% | max/day {u['limit_max_trades']}")
+            if p.startswith("daily="): fields["limits_daily"] = float(p.split("=",1)[1])
+            elif p.startswith("weekly="): fields["limits_weekly"] = float(p.split("=",1)[1])
+            elif p.startswith("max_trades="): fields["limits_max_trades"] = int(p.split("=",1)[1])
+            elif p.startswith("exposure="): fields["limits_max_exposure"] = float(p.split("=",1)[1])
+            elif p.startswith("asset="): fields["limits_max_asset"] = float(p.split("=",1)[1])
+            elif p.startswith("open_dd="): fields["limits_max_open_dd"] = float(p.split("=",1)[1])
+        u = await get_user(uid)
+        if fields:
+            await set_user(uid, **fields)
+        await reply(message,
+            f"🛡️ Лимиты обновлены: "
+            f"day {u['limit_daily']}% | week {u['limit_weekly']}% | max/day {u['limit_max_trades']}\n"
+            f"exposure {u['limit_max_exposure']}% | asset {u['limit_max_asset']}% | "
+            f"open dd {u['limit_max_open_dd']}% (0 — выкл.)"
+        )
     except Exception:
-        await message.answer("⚠️ Пример: /set_limits daily=5 weekly=15 max_trades=20")
+        await reply(message, "⚠️ Пример: /set_limits daily=5 weekly=15 max_trades=20 exposure=300 asset=100 open_dd=10")
 
 @dp.message_handler(commands=['risk_limits'])
 async def risk_limits_cmd(message: types.Message):
     uid = message.from_user.id
-    u = get_user(uid)
+    u = await get_user(uid)
     depo = float(u["depo"] or 0)
     if depo <= 0:
-        await message.answer("Сначала задай депозит: /set_depo 1000")
+        await reply(message, "Сначала задай депозит: /set_depo 1000")
         return
-    dstart, dend = today_bounds_utc()
-    wstart, wend = week_bounds_utc()
-    d = (get_period_pnl(uid, dstart, dend) / depo) * 100.0
-    w = (get_period_pnl(uid, wstart, wend) / depo) * 100.0
-    t = get_trades_today(uid)
-    await message.answer(
+    rc = await risk_book.verify(uid) if RISK_VERIFY else risk_book.get(uid)
+    d = (rc.day_pnl / depo) * 100.0
+    w = (rc.week_pnl / depo) * 100.0
+    t = rc.day_trades
+    s = portfolio.summary(uid)
+    await reply(message,
         "🛡️ Лимиты риска:\n"
         f"Daily: {u['limit_daily']}% | Текущий день: {d:.2f}%\n"
         f"Weekly: {u['limit_weekly']}% | Текущая неделя: {w:.2f}%\n"
-        f"Max trades/day: {u['limit_max_trades']} | Сегодня: {t}"
+        f"Max trades/day: {u['limit_max_trades']} | Сегодня: {t}\n"
+        f"Exposure: {u['limit_max_exposure']}% | Открыто: {s['total'] / depo * 100:.2f}%\n"
+        f"Asset max: {u['limit_max_asset']}% | Крупнейший: {max(s['assets'].values(), default=0) / depo * 100:.2f}%\n"
+        f"Open DD: {u['limit_max_open_dd']}% | Сейчас: {s['upnl'] / depo * 100:.2f}%"
     )
 
+@dp.message_handler(commands=['exposure'])
+async def exposure_cmd(message: types.Message):
+    s = portfolio.summary(message.from_user.id)
+    if not s["symbols"]:
+        await reply(message, "Открытых сделок нет.")
+        return
+    lines = [f"📊 Экспозиция: {s['total']:.2f} USDT | нереализованный PnL {s['upnl']:.2f}"]
+    lines += [f"• {sym}: {n:.2f} | PnL {p:.2f}" for sym, (n, p) in sorted(s["symbols"].items(), key=lambda x: -x[1][0])]
+    lines.append("По активам: " + ", ".join(f"{a} {n:.2f}" for a, n in sorted(s["assets"].items(), key=lambda x: -x[1])))
+    lines.append("По котировке: " + ", ".join(f"{q or '?'} {n:.2f}" for q, n in sorted(s["quotes"].items(), key=lambda x: -x[1])))
+    if s["unpriced"]:
+        lines.append(f"⚠️ Нет курса к USDT: {', '.join(sorted(s['unpriced']))} — эти позиции не учтены")
+    await reply(message, "\n".join(lines))
+
 @dp.message_handler(commands=['balance'])
 async def balance_cmd(message: types.Message):
     uid = message.from_user.id
-    u = get_user(uid)
+    u = await get_user(uid)
     if u["mode"] != "auto":
-        await message.answer("ℹ️ Баланс доступен только в режиме Авто‑трейд.")
+        await reply(message, "ℹ️ Баланс доступен только в режиме Авто‑трейд.")
         return
     try:
-        client = get_user_client(u)
-        account = client.get_account()
+        client = await user_client(u)
+        account = await ex_call(uid, client.get_account)
         lines = ["💰 Балансы:"]
         for b in account["balances"]:
             total = float(b["free"]) + float(b["locked"])
             if total > 0:
                 lines.append(f"• {b['asset']}: {total}")
-        await message.answer("\n".join(lines))
+        await reply(message, "\n".join(lines))
     except Exception as e:
-        await message.answer(f"⛔ Ошибка получения балансов: {e}")
+        await reply(message, f"⛔ Ошибка получения балансов: {e}")
 
 @dp.message_handler(commands=['cancel_all'])
 async def cancel_all_cmd(message: types.Message):
     uid = message.from_user.id
-    u = get_user(uid)
+    u = await get_user(uid)
     if u["mode"] != "auto":
-        await message.answer("ℹ️ Отмена ордеров доступна только в режиме Авто‑трейд.")
+        await reply(message, "ℹ️ Отмена ордеров доступна только в режиме Авто‑трейд.")
         return
     try:
         symbol = message.get_args().split()[0].upper()
-        client = get_user_client(u)
-        res = client.cancel_open_orders(symbol=symbol)
-        await message.answer(f"🚫 Отменены все ордера по {symbol}\n{res}")
+        client = await user_client(u)
+        res = await ex_call(uid, client.cancel_open_orders, symbol=symbol)
+
+        def unmanage(c):
+            ids = [r[0] for r in c.execute("SELECT id FROM trades WHERE user_id=? AND symbol=? AND status='open'",
+                                           (uid, symbol))]
+            c.executemany("UPDATE trades SET managed=0 WHERE id=?", [(i,) for i in ids])
+            return ids
+        # OCO отменены намеренно: Reconciler их больше не восстанавливает
+        ids = await db_write(unmanage)
+        for tid in ids:
+            trade_monitor.discard(tid)
+            reconciler.warned.discard(tid)
+        text = f"🚫 Отменены все ордера по {symbol}\n{res}"
+        if ids:
+            text += (f"\nСделки {', '.join(f'#{i}' for i in ids)} бот больше не сопровождает — "
+                     f"закрой их сам: /close_trade ID win|loss ЦЕНА")
+        await reply(message, text)
     except Exception as e:
-        await message.answer(f"⛔ Ошибка отмены: {e}")
+        await reply(message, f"⛔ Ошибка отмены: {e}")
 
 @dp.message_handler(commands=['new_trade'])
 async def new_trade_cmd(message: types.Message):
@@ -358,83 +3045,106 @@ async def new_trade_cmd(message: types.Message):
     """
     try:
         uid = message.from_user.id
-        u = get_user(uid)
+        u = await get_user(uid)
 
         # lim checks
-        ok, reason = check_limits(u)
+        ok, reason = await check_limits(u)
         if not ok:
-            await message.answer(reason)
+            await reply(message, reason)
             return
 
         symbol, entry, tp, sl = message.get_args().split()
         symbol = symbol.upper()
         entry = float(entry); tp = float(tp); sl = float(sl)
 
-        risk_pct = float(u["risk"] or 0)
-        depo = float(u["depo"] or 0)
-        if risk_pct <= 0 or depo <= 0:
-            await message.answer("⚠️ Сначала задай депозит и риск: /set_depo и /set_risk")
-            return
-
-        stop_distance = abs(entry - sl)
-        if stop_distance <= 0:
-            await message.answer("⚠️ Некорректный SL.")
-            return
-
-        risk_amount = depo * (risk_pct / 100.0)
-        raw_volume = risk_amount / stop_distance
+        raw_volume = size_trade(u, entry, sl)
+        await portfolio.ensure_rates(u, [symbol])
 
         if u["mode"] == "signal":
             # Только запись сигнала (без Binance)
-            trade_id = save_trade(uid, symbol, entry, tp, sl, raw_volume, status="signal_open")
-            await message.answer(f"📝 Сигнал сохранён #{trade_id} {symbol}\n"
-                                 f"entry={entry} TP={tp} SL={sl} vol≈{raw_volume:.6f}")
+            ok, reason = portfolio.check(u, symbol, portfolio.notional(symbol, raw_volume, entry))
+            if not ok:
+                await reply(message, reason)
+                return
+            trade_id = await save_trade(uid, symbol, entry, tp, sl, raw_volume, status="signal_open")
+            track_trade(trade_id, uid, symbol, entry, tp, sl, "signal_open")
+            await reply(message,
+                f"📝 Сигнал сохранён #{trade_id} {symbol}\n"
+                f"entry={entry} TP={tp} SL={sl} vol≈{raw_volume:.6f}"
+            )
             return
 
         # AUTO MODE: реальная торговля
-        client = get_user_client(u)
-        lot_step, tick = _get_symbol_filters(client, symbol)
-        qty = _round_qty(raw_volume, lot_step)
-        entry_r = float(_round_price(entry, tick))
-        tp_r = float(_round_price(tp, tick))
-        sl_r = float(_round_price(sl, tick))
+        client = await user_client(u)
+        testnet = bool(u["use_testnet"])
+        meta = (cached_symbol_meta(symbol, testnet)
+                or await ex_call(uid, _get_symbol_filters, client, symbol, testnet))
+        qty, entry_r, tp_r, sl_r = fit_to_filters(meta, symbol, entry, tp, sl, raw_volume)
 
         # проверка баланса
-        last_price = user_get_price(client, symbol)
+        last_price = fresh_price(symbol, testnet)
+        if last_price is None:
+            last_price, free_usdt = await asyncio.gather(
+                ex_call(uid, user_get_price, client, symbol),
+                ex_call(uid, user_get_balance, client, "USDT"),
+            )
+        else:
+            free_usdt = await ex_call(uid, user_get_balance, client, "USDT")
         quote_needed = float(qty) * last_price
-        free_usdt = user_get_balance(client, "USDT")
         if quote_needed > free_usdt:
-            await message.answer(f"⚠️ Недостаточно USDT: нужно {quote_needed:.2f}, доступно {free_usdt:.2f}")
+            await reply(message, f"⚠️ Недостаточно USDT: нужно {quote_needed:.2f}, доступно {free_usdt:.2f}")
+            return
+        ok, reason = portfolio.check(u, symbol, portfolio.notional(symbol, float(qty), last_price))
+        if not ok:
+            await reply(message, reason)
             return
 
-        # MARKET BUY
-        order = client.create_order(
-            symbol=symbol, side=SIDE_BUY, type=ORDER_TYPE_MARKET, quantity=str(qty)
-        )
+        p = await place_auto_trade(uid, client, meta, symbol, qty, entry_r, tp_r, sl_r)
+        trade_id = await save_trade(uid, symbol, p.avg_entry, tp_r, sl_r, float(p.qty), status="open",
+                                    oco_list_id=p.oco_list_id, entry_order_id=p.order_id,
+                                    oco_order_ids=p.oco_order_ids, commission=p.commission)
+        track_trade(trade_id, uid, symbol, p.avg_entry, tp_r, sl_r, "open", p.oco_list_id)
+        text = f"✅ Открыто #{trade_id} {symbol}\nqty={p.qty} entry≈{p.avg_entry:.8f} TP={tp_r} SL={sl_r}"
+        if p.oco_list_id is None:
+            text += "\n⚠️ OCO не выставлен — позиция пока без TP/SL, бот повторит попытку"
+        await reply(message, text)
 
-        # средняя цена из fills (если биржа вернула)
-        avg_entry = entry_r
-        if 'fills' in order and order['fills']:
-            exec_qty, exec_quote = Decimal('0'), Decimal('0')
-            for f in order['fills']:
-                exec_qty += Decimal(f['qty'])
-                exec_quote += Decimal(f['price']) * Decimal(f['qty'])
-            if exec_qty > 0:
-                avg_entry = float(exec_quote / exec_qty)
-
-        # OCO SELL (TP/SL)
-        stop_limit_price = float(_round_price(sl_r * 0.999, tick))
-        client.create_oco_order(
-            symbol=symbol, side=SIDE_SELL, quantity=str(qty),
-            price=str(tp_r), stopPrice=str(sl_r),
-            stopLimitPrice=str(stop_limit_price), stopLimitTimeInForce="GTC"
-        )
+    except TradeRejected as e:
+        await reply(message, str(e))
+    except Exception as e:
+        await reply(message, f"⛔ Ошибка: {e}\nПример: /new_trade BTCUSDT 30000 32000 29000")
 
-        trade_id = save_trade(uid, symbol, avg_entry, tp_r, sl_r, float(qty), status="open")
-        await message.answer(f"✅ Открыто #{trade_id} {symbol}\nqty={qty} entry≈{avg_entry:.8f} TP={tp_r} SL={sl_r}")
+@dp.message_handler(commands=['bulk_trade'])
+async def bulk_trade_cmd(message: types.Message):
+    """
+    /bulk_trade, дальше по строке на сетап: SYMBOL ENTRY TP SL
+    """
+    await run_bulk(message, message.get_args())
+
+@dp.message_handler(content_types=types.ContentType.DOCUMENT)
+async def bulk_trade_file(message: types.Message):
+    """CSV-файл с сетапами (symbol,entry,tp,sl)."""
+    if not (message.document.file_name or "").lower().endswith(".csv"):
+        return
+    buf = io.BytesIO()
+    await message.document.download(destination_file=buf)
+    await run_bulk(message, buf.getvalue().decode("utf-8-sig", errors="replace"))
 
+async def run_bulk(message: types.Message, text: str):
+    setups, errors = parse_setups(text)
+    if not setups:
+        await reply(message, "⚠️ Пример:\n/bulk_trade\nBTCUSDT 30000 32000 29000\nETHUSDT 2000 2200 1900")
+        return
+    if len(setups) > BULK_MAX_ROWS:
+        await reply(message, f"⚠️ Не больше {BULK_MAX_ROWS} сетапов за раз.")
+        return
+    try:
+        u = await get_user(message.from_user.id)
+        opened, rejected = await open_bulk(u, setups)
     except Exception as e:
-        await message.answer(f"⛔ Ошибка: {e}\nПример: /new_trade BTCUSDT 30000 32000 29000")
+        await reply(message, f"⛔ Ошибка: {e}")
+        return
+    await reply(message, format_bulk_result(opened, rejected + errors))
 
 @dp.message_handler(commands=['close_trade'])
 async def close_trade_cmd(message: types.Message):
@@ -445,106 +3155,324 @@ async def close_trade_cmd(message: types.Message):
         args = message.get_args().split()
         trade_id = int(args[0]); status = args[1].lower(); exit_price = float(args[2])
         if status not in ("win", "loss"):
-            await message.answer("⚠️ Статус: win или loss")
+            await reply(message, "⚠️ Статус: win или loss")
             return
-        cur.execute("SELECT user_id, entry, volume FROM trades WHERE id=?", (trade_id,))
-        row = cur.fetchone()
-        if not row:
-            await message.answer("⚠️ Сделка не найдена")
+        res = await settle_trade(trade_id, exit_price, status, owner=message.from_user.id)
+        if not res:
+            await reply(message, "⚠️ Сделка не найдена или уже закрыта")
             return
-        uid, entry, vol = row
-        pnl = (exit_price - float(entry)) * float(vol)
-        close_trade_db(trade_id, exit_price, pnl, status)
-        # обновим виртуальный депо
-        u = get_user(uid)
-        set_user(uid, depo=float(u["depo"] or 0) + pnl)
-        await message.answer(f"✅ Закрыта #{trade_id} ({status}) exit={exit_price} | PnL={pnl:.2f}")
+        pnl = res[1]
+        await reply(message, f"✅ Закрыта #{trade_id} ({status}) exit={exit_price} | PnL={pnl:.2f}")
     except Exception:
-        await message.answer("⚠️ Пример: /close_trade 12 win 31500")
+        await reply(message, "⚠️ Пример: /close_trade 12 win 31500")
 
 # ---------------- Отчётность ----------------
 @dp.message_handler(commands=['report'])
 async def report_cmd(message: types.Message):
     uid = message.from_user.id
-    df = df_user_trades(uid)
-    if df.empty:
-        await message.answer("Пока нет сделок.")
+    st = await db_query("""SELECT trades, closed, wins, gross_win, gross_loss, equity, max_dd
+                           FROM user_stats WHERE user_id=?""", (uid,), one=True)
+    if not st or not st[0]:
+        await reply(message, "Пока нет сделок.")
         return
-    closed = df[df['status'].isin(['win','loss'])]
-    total_trades = len(df); closed_trades = len(closed)
-    wins = (closed['pnl'] > 0).sum(); losses = (closed['pnl'] <= 0).sum()
-    total_pnl = float(closed['pnl'].sum()) if closed_trades else 0.0
-    avg_win = float(closed[closed['pnl'] > 0]['pnl'].mean() or 0.0) if wins else 0.0
-    avg_loss = float(closed[closed['pnl'] <= 0]['pnl'].mean() or 0.0) if losses else 0.0
+    total_trades, closed_trades, wins, gross_win, gross_loss, total_pnl, max_dd = st
+    losses = closed_trades - wins
+    avg_win = gross_win / wins if wins else 0.0
+    avg_loss = gross_loss / losses if losses else 0.0
     winrate = (wins / closed_trades * 100.0) if closed_trades else 0.0
-    u = get_user(uid)
+    expectancy = total_pnl / closed_trades if closed_trades else 0.0
+    pf = f"{gross_win / -gross_loss:.2f}" if gross_loss < 0 else ("∞" if gross_win > 0 else "—")
+    by_symbol = await db_query("""SELECT symbol, closed, wins, pnl FROM user_symbol_stats
+                                  WHERE user_id=? ORDER BY pnl DESC LIMIT 10""", (uid,))
+    u = await get_user(uid)
     text = ( "📊 Отчёт\n"
              f"Всего: {total_trades} | Закрыто: {closed_trades}\n"
              f"🏆 {wins} | ❌ {losses} | Winrate: {winrate:.2f}%\n"
              f"💵 Total PnL: {total_pnl:.2f}\n"
              f"📈 Avg Win: {avg_win:.2f} | 📉 Avg Loss: {avg_loss:.2f}\n"
+             f"⚖️ Profit factor: {pf} | Expectancy: {expectancy:.2f}\n"
+             f"📉 Max drawdown: {max_dd:.2f}\n"
              f"💰 Депозит (вирт.): {float(u['depo'] or 0):.2f} USDT" )
-    await message.answer(text)
+    if by_symbol:
+        text += "\n\nПо символам:\n" + "\n".join(
+            f"• {sym}: {n} сд. | WR {w / n * 100:.0f}% | PnL {p:.2f}" for sym, n, w, p in by_symbol)
+    await reply(message, text)
 
 @dp.message_handler(commands=['equity'])
 async def equity_cmd(message: types.Message):
     uid = message.from_user.id
-    df = df_user_trades(uid)
-    closed = df[df['status'].isin(['win','loss'])].copy()
-    if closed.empty:
-        await message.answer("Нет закрытых сделок для графика.")
+    png = await equity_png(uid)
+    if png is None:
+        await reply(message, "Нет закрытых сделок для графика.")
         return
-    closed['closed_at'] = pd.to_datetime(closed['closed_at'])
-    closed = closed.sort_values('closed_at')
-    closed['cum_pnl'] = closed['pnl'].cumsum()
-    y = closed['cum_pnl']
-    plt.figure(figsize=(7,4.5))
-    plt.plot(closed['closed_at'], y, marker="o")
-    plt.title("Equity Curve (Cumulative PnL)")
-    plt.xlabel("Дата")
-    plt.ylabel("USDT")
-    plt.grid(True)
-    plt.tight_layout()
-    img = f"equity_{uid}.png"
-    plt.savefig(img); plt.close()
-    await message.answer_photo(open(img, "rb"))
+    await outbox.send(message.chat.id, bot.send_photo, types.InputFile(io.BytesIO(png), filename="equity.png"))
 
 @dp.message_handler(commands=['export_csv'])
 async def export_csv_cmd(message: types.Message):
-    uid = message.from_user.id
-    df = df_user_trades(uid)
-    if df.empty:
-        await message.answer("Нет сделок для экспорта.")
-        return
-    path = f"trades_{uid}.csv"
-    df.to_csv(path, index=False, encoding="utf-8")
-    await message.answer_document(open(path, "rb"))
+    await export_trades(message, write_trades_csv, "csv")
 
 @dp.message_handler(commands=['export_xlsx'])
 async def export_xlsx_cmd(message: types.Message):
-    uid = message.from_user.id
-    df = df_user_trades(uid)
-    if df.empty:
-        await message.answer("Нет сделок для экспорта.")
+    await export_trades(message, write_trades_xlsx, "xlsx")
+
+# ---------------- Admin / metrics ----------------
+def stat_gauges() -> dict:
+    g = {}
+    for group, stats in (("clients", client_registry.stats), ("user_cache", user_cache.stats),
+                         ("exchange", exchange_scheduler.stats), ("outbox", outbox.stats),
+                         ("user_stream", user_streams.stats), ("reconcile", reconciler.stats)):
+        for key, value in stats.items():
+            g[(group, key)] = value
+    g[("user_cache", "hit_rate")] = round(user_cache.hit_rate(), 4)
+    g[("exchange", "queue_depth")] = exchange_scheduler.queue_depth()
+    g[("exchange", "used_weight")] = exchange_scheduler.used_weight
+    for priority, label in enumerate(("orders", "other")):
+        w = exchange_scheduler.wait_stats(priority)
+        g[("exchange", f"queue_depth_{label}")] = exchange_scheduler.queue_depth(priority)
+        for q in ("p50", "p95", "max"):
+            g[("exchange", f"wait_{q}_{label}_seconds")] = round(w[q], 6)
+    g[("outbox", "chats")] = len(outbox.chats)
+    g[("db", "write_queue")] = db_writer.queue.qsize()
+    g[("monitor", "trades")] = len(trade_monitor.trades)
+    return g
+
+async def start_metrics_server(port: int):
+    from aiohttp import web
+    async def handle(request: web.Request):
+        return web.Response(text=metrics.prometheus(stat_gauges()), content_type="text/plain")
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, port).start()
+
+@dp.message_handler(commands=['stats'])
+async def stats_cmd(message: types.Message):
+    """/stats — латентности и счётчики; /stats profile — старт/стоп профилировщика (ADMIN_IDS)."""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    if message.get_args().strip() == "profile":
+        if not profiler.running:
+            profiler.start()
+            await reply(message,
+                f"🔬 Профилировщик запущен, шаг {PROFILE_INTERVAL * 1000:.0f} мс. "
+                f"Остановить — /stats profile"
+            )
+            return
+        folded = profiler.stop()
+        lines = [f"🔬 {profiler.samples} сэмплов за {time.monotonic() - profiler.started:.0f} с, топ по self-time:"]
+        lines += [f"{n * 100 / profiler.samples:5.1f}% {frame}" for frame, n in profiler.top()]
+        await reply(message, "\n".join(lines))
+        if folded:
+            await outbox.send(message.chat.id, bot.send_document,
+                              types.InputFile(io.BytesIO(folded.encode()), filename="profile.folded"))
         return
-    df['risk_R'] = (df['entry'] - df['sl'])
-    df['reward_R'] = (df['tp'] - df['entry'])
-    df['rr_ratio'] = df['reward_R'] / df['risk_R'].replace(0, pd.NA)
-    path = f"trades_{uid}.xlsx"
-    with pd.ExcelWriter(path, engine="openpyxl") as w:
-        df.to_excel(w, index=False, sheet_name="Trades")
-        closed = df[df['status'].isin(['win','loss'])]
-        summary = {
-            "total_trades": [len(df)],
-            "closed_trades": [len(closed)],
-            "wins": [(closed['pnl'] > 0).sum()],
-            "losses": [(closed['pnl'] <= 0).sum()],
-            "winrate_%": [((closed['pnl'] > 0).sum() / len(closed) * 100) if len(closed) else 0.0],
-            "total_pnl": [float(closed['pnl'].sum()) if len(closed) else 0.0],
-        }
-        pd.DataFrame(summary).to_excel(w, index=False, sheet_name="Summary")
-    await message.answer_document(open(path, "rb"))
+    lines = ["⏱ span: n | p50 / p95 / p99, мс"]
+    for name in sorted(metrics.samples, key=lambda n: -metrics.totals[n][1]):
+        p50, p95, p99 = (v * 1000 for v in metrics.quantiles(name))
+        lines.append(f"{name}: {metrics.totals[name][0]} | {p50:.1f} / {p95:.1f} / {p99:.1f}")
+    lines.append("")
+    lines += [f"{group}.{key}={value}" for (group, key), value in sorted(stat_gauges().items())]
+    text = "\n".join(lines)
+    await reply(message, text if len(text) <= 4000 else text[:3990] + "\n…")
 
 # ------------------- Run -------------------
+async def on_startup(dp: Dispatcher):
+    init_db()
+    asyncio.create_task(db_writer.run())
+    await dp.storage.load()
+    await risk_book.rebuild()
+    await portfolio.rebuild()
+    asyncio.create_task(portfolio.watch())
+    asyncio.create_task(archiver())
+    await trade_monitor.load()
+    asyncio.create_task(trade_monitor.poll_oco())
+    asyncio.create_task(reconciler.run())
+    asyncio.create_task(user_streams.run())
+    asyncio.create_task(symbol_meta_refresher())
+    asyncio.create_task(market_feed.track_open_trades())
+    asyncio.create_task(market_feed.run())
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT + WORKER_INDEX)
+    asyncio.create_task(warm_up())
+    metrics.observe("startup.ready", time.perf_counter() - _IMPORT_STARTED)
+    logging.info("startup: imports %.3fs, ready %.3fs", _IMPORT_SECONDS, time.perf_counter() - _IMPORT_STARTED)
+
+def _warm_render_worker() -> int:
+    import matplotlib.backends.backend_agg  # noqa: F401 — импорт в процессе пула
+    return os.getpid()
+
+async def warm_up():
+    """Прогрев в фоне, когда апдейты уже принимаются: python-binance (если есть auto-юзеры) и пул рендера."""
+    global _render_pool
+    await asyncio.sleep(WARMUP_DELAY)
+    loop = asyncio.get_running_loop()
+    try:
+        if EXCHANGE_BACKEND != "fake" and await has_auto_users():
+            await loop.run_in_executor(None, binance_client_cls)
+        if _render_pool is None:
+            _render_pool = _new_render_pool()
+        with metrics.span("warmup.render"):
+            await asyncio.gather(*(loop.run_in_executor(_render_pool, _warm_render_worker)
+                                   for _ in range(RENDER_WORKERS)))
+    except Exception:
+        logging.exception("warm-up failed")
+
+# ------------------- Webhook + worker processes -------------------
+# Фронт (aiohttp) только принимает апдейт и кладёт его в очередь воркера
+# user_id % BOT_WORKERS; воркер — отдельный процесс со своим event loop,
+# апдейты одного юзера обрабатывает строго по порядку. Общее состояние — SQLite (WAL).
+# Фоновые службы не выделены в отдельный процесс: каждый воркер ведёт свой шард
+# юзеров целиком (TradeMonitor, Reconciler, user-data streams, архиватор — только
+# по своим сделкам), но держит своё соединение MarketFeed (символы своего шарда,
+# у шардов они пересекаются) и свой DBWriter — коммиты воркеров идут по очереди
+# через лок записи SQLite, отсюда DB_BUSY_TIMEOUT, растущий с BOT_WORKERS. Поэтому
+# воркеров не больше, чем ядер: лишние только добавят соединений и ожидания лока.
+UPDATE_KINDS = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+                "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+                "chat_join_request")
+
+def update_user_id(data: dict) -> int:
+    for kind in UPDATE_KINDS:
+        obj = data.get(kind)
+        if obj:
+            user = obj.get("from") or obj.get("user") or obj.get("chat") or {}
+            return user.get("id") or 0
+    return 0
+
+async def _user_chain(uid: int, q: deque, chains: dict):
+    try:
+        while q:
+            try:
+                # своя задача = свой контекст: ctx_state и прочие ContextVar aiogram
+                # не протекают из прошлого апдейта, порядок сохраняется await'ом
+                await asyncio.create_task(dp.process_update(q.popleft()))
+            except Exception:
+                logging.exception("update of %s failed", uid)
+    finally:
+        chains.pop(uid, None)
+
+async def _worker_loop(updates):
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+    loop = asyncio.get_running_loop()
+    chains = {}  # user_id -> deque[Update]; цепочка живёт, пока у юзера есть апдейты
+    while True:
+        raw = await loop.run_in_executor(None, updates.get)
+        if raw is None:  # фронт останавливается
+            break
+        data = json.loads(raw)
+        uid = update_user_id(data)
+        q = chains.get(uid)
+        if q is None:
+            q = chains[uid] = deque()
+            asyncio.create_task(_user_chain(uid, q, chains))
+        q.append(types.Update(**data))
+    # дорабатываем принятые апдейты и гасим пул рендера сами, иначе его процессы
+    # переживут воркер и повиснут сиротами
+    deadline = loop.time() + WORKER_STOP_SEC
+    while chains and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=True, cancel_futures=True)
+
+def _release_reader(q):
+    """Снимает лок чтения очереди, если его унёс умерший воркер.
+
+    Убитый в q.get() процесс не отпускает лок, и новый воркер ждал бы его вечно.
+    Читатель у очереди один — этот воркер, так что, пока его нет, лок можно
+    освободить из фронта: апдейты в очереди сохраняются и порядок тоже.
+    """
+    q._rlock.acquire(False)  # свободен — берём, занят мёртвым — и так наш
+    q._rlock.release()
+
+def worker_main(index: int, count: int, updates):
+    global WORKER_INDEX, WORKER_COUNT
+    WORKER_INDEX, WORKER_COUNT = index, count
+    # лимиты Binance на IP и Telegram на бота общие — делим поровну между воркерами
+    exchange_scheduler.weight_limit //= count
+    outbox.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE / count, max(OUTBOX_GLOBAL_RATE / count, 1))
+    asyncio.get_event_loop().run_until_complete(_worker_loop(updates))
+
+def run_webhook():
+    from aiohttp import web
+    c = _db_connect()
+    migrate(c)
+    c.close()
+    global BOT_WORKERS
+    cores = os.cpu_count() or 1
+    if BOT_WORKERS > cores:
+        logging.warning("BOT_WORKERS=%d > %d ядер, запускаю %d воркеров", BOT_WORKERS, cores, cores)
+        BOT_WORKERS = cores
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(WORKER_QUEUE_MAX) for _ in range(BOT_WORKERS)]
+    workers = [None] * BOT_WORKERS
+
+    def start_worker(i: int):
+        # не daemon: воркеру нужны свои дочерние процессы (пул рендера equity)
+        workers[i] = ctx.Process(target=worker_main, args=(i, BOT_WORKERS, queues[i]), name=f"bot-worker-{i}")
+        workers[i].start()
+
+    for i in range(BOT_WORKERS):
+        start_worker(i)
+
+    async def supervise(app):
+        async def loop():
+            while True:
+                await asyncio.sleep(WORKER_CHECK_SEC)
+                for i, p in enumerate(workers):
+                    if not p.is_alive():
+                        logging.error("worker %d exited with %s, restarting", i, p.exitcode)
+                        _release_reader(queues[i])
+                        start_worker(i)
+        app["supervisor"] = asyncio.create_task(loop())
+
+    async def handle(request: web.Request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        raw = await request.read()
+        try:
+            uid = update_user_id(json.loads(raw))
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            queues[uid % BOT_WORKERS].put_nowait(raw)
+        except queue.Full:
+            return web.Response(status=503)  # Telegram повторит доставку позже
+        return web.Response()
+
+    async def set_webhook(app):
+        if WEBHOOK_URL:
+            extra = {"secret_token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+            await bot.set_webhook(WEBHOOK_URL, **extra)
+
+    async def close_bot(app):
+        app["supervisor"].cancel()
+        loop = asyncio.get_running_loop()
+        for i, q in enumerate(queues):
+            try:
+                await loop.run_in_executor(None, q.put, None, True, WORKER_STOP_SEC)
+            except queue.Full:
+                logging.error("worker %d queue is full, terminating", i)
+                workers[i].terminate()
+        for p in workers:
+            await loop.run_in_executor(None, p.join, WORKER_STOP_SEC + 5)
+            if p.is_alive():
+                logging.error("worker %s did not stop, terminating", p.name)
+                p.terminate()
+                p.join(5)
+        await (await bot.get_session()).close()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    app.on_startup.append(set_webhook)
+    app.on_startup.append(supervise)
+    app.on_cleanup.append(close_bot)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
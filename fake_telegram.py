@@ -0,0 +1,206 @@
+"""Локальный фейковый Telegram Bot API для офлайн-проверки бота.
+
+Бот подключается через TG_API_SERVER=http://127.0.0.1:8081 и работает как
+с настоящим API: getUpdates (long polling) или setWebhook, sendMessage /
+sendPhoto / sendDocument. Лимиты как у Telegram — в чат и на бота в
+секунду; превышение отвечает 429 с retry_after, так что видно, как Outbox
+держит темп и переживает RetryAfter.
+
+Апдейты подкладываются через POST /_inject {"user_id": 1, "text": "/help"}
+(или список таких объектов); при выставленном webhook они уходят на него.
+GET /_stats — сколько сообщений получил каждый чат, сколько было 429,
+задержки доставки ответов; GET /_messages?chat_id=1 — последние сообщения чата.
+
+Пример:
+    python fake_telegram.py --port 8081 --chat-rate 1 --global-rate 30
+    TG_API_SERVER=http://127.0.0.1:8081 TG_TOKEN=123:fake python bot.py
+"""
+import time
+import asyncio
+import argparse
+from collections import deque
+
+import aiohttp
+from aiohttp import web
+
+
+def make_update(update_id: int, user_id: int, text: str, message_id: int = None) -> dict:
+    """Update с личным сообщением от user_id (chat.id = user_id, как в личке)."""
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    message = {"message_id": message_id or update_id, "date": int(time.time()), "from": user,
+               "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]}, "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+class RateWindow:
+    """Сколько запросов было за последнюю секунду (скользящее окно)."""
+    __slots__ = ("limit", "times")
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.times = deque()
+
+    def hit(self, now: float) -> float:
+        """Учитывает запрос; 0 — в лимите, иначе через сколько секунд можно снова."""
+        while self.times and now - self.times[0] >= 1.0:
+            self.times.popleft()
+        if self.limit and len(self.times) >= self.limit:
+            return 1.0 - (now - self.times[0])
+        self.times.append(now)
+        return 0.0
+
+
+class FakeTelegram:
+    def __init__(self, chat_rate: float = 1, global_rate: float = 30, bot_id: int = 1):
+        self.chat_rate = chat_rate
+        self.global_rate = RateWindow(global_rate)
+        self.chats = {}        # chat_id -> RateWindow
+        self.bot_id = bot_id
+        self.updates = deque()
+        self.new_update = asyncio.Event()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.webhook = None
+        self.injected = {}     # chat_id -> deque[время инжекта] — для задержки ответа
+        self.sent = {}         # chat_id -> [сообщений, 429]
+        self.messages = {}     # chat_id -> deque[текст/подпись] последних сообщений
+        self.latencies = []    # сек от инжекта до первого ответа в тот же чат
+        self.methods = {}      # method -> вызовов
+        self._http = None
+
+    # -------- API бота --------
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.methods[method] = self.methods.get(method, 0) + 1
+        params = await self._params(request)
+        if method == "getUpdates":
+            return self._ok(await self._get_updates(params))
+        if method == "getMe":
+            return self._ok({"id": self.bot_id, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"})
+        if method == "setWebhook":
+            self.webhook = params.get("url") or None
+            if params.get("drop_pending_updates") in ("true", "True", True):
+                self.updates.clear()
+            return self._ok(True)
+        if method == "getWebhookInfo":
+            return self._ok({"url": self.webhook or "", "has_custom_certificate": False,
+                             "pending_update_count": len(self.updates)})
+        if method == "deleteWebhook":
+            self.webhook = None
+            return self._ok(True)
+        if method.startswith("send") and method != "sendChatAction":
+            chat_id = int(params.get("chat_id", 0))
+            retry = max(self.global_rate.hit(time.monotonic()),
+                        self.chats.setdefault(chat_id, RateWindow(self.chat_rate)).hit(time.monotonic()))
+            stat = self.sent.setdefault(chat_id, [0, 0])
+            if retry:
+                stat[1] += 1
+                retry_after = max(int(retry + 0.999), 1)
+                return web.json_response({"ok": False, "error_code": 429,
+                                          "description": f"Too Many Requests: retry after {retry_after}",
+                                          "parameters": {"retry_after": retry_after}}, status=429)
+            stat[0] += 1
+            self.messages.setdefault(chat_id, deque(maxlen=100)).append(
+                params.get("text") or params.get("caption") or method)
+            pending = self.injected.get(chat_id)
+            if pending:
+                self.latencies.append(time.monotonic() - pending.popleft())
+            return self._ok(self._message(chat_id, params))
+        return self._ok(True)
+
+    @staticmethod
+    async def _params(request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        return {k: v for k, v in (await request.post()).items() if isinstance(v, str)}
+
+    @staticmethod
+    def _ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+    def _message(self, chat_id: int, params: dict) -> dict:
+        self.next_message_id += 1
+        return {"message_id": self.next_message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        if offset < 0:  # skip_updates: всё, кроме последнего, забывается
+            while len(self.updates) > 1:
+                self.updates.popleft()
+            return list(self.updates)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return list(self.updates)[:limit]
+
+    # -------- управление тестом --------
+    async def inject(self, user_id: int, text: str) -> dict:
+        update = make_update(self.next_update_id, user_id, text)
+        self.next_update_id += 1
+        self.injected.setdefault(user_id, deque()).append(time.monotonic())
+        if self.webhook:
+            if self._http is None:
+                self._http = aiohttp.ClientSession()
+            async with self._http.post(self.webhook, json=update) as resp:
+                if resp.status != 200:
+                    self.updates.append(update)  # как Telegram: доставим позже через повтор
+        else:
+            self.updates.append(update)
+            self.new_update.set()
+        return update
+
+    async def handle_inject(self, request: web.Request):
+        data = await request.json()
+        items = data if isinstance(data, list) else [data]
+        updates = [await self.inject(int(x["user_id"]), x["text"]) for x in items]
+        return web.json_response({"injected": len(updates)})
+
+    def stats(self) -> dict:
+        lat = sorted(self.latencies)
+        pick = lambda q: lat[min(int(len(lat) * q), len(lat) - 1)] if lat else 0.0
+        return {"chats": len(self.sent), "messages": sum(s[0] for s in self.sent.values()),
+                "rate_limited": sum(s[1] for s in self.sent.values()), "methods": self.methods,
+                "reply_latency": {"count": len(lat), "p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99)}}
+
+    async def handle_stats(self, request: web.Request):
+        return web.json_response(self.stats())
+
+    async def handle_messages(self, request: web.Request):
+        return web.json_response(list(self.messages.get(int(request.query["chat_id"]), ())))
+
+    async def close(self, app=None):
+        if self._http is not None:
+            await self._http.close()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 * 1024)  # sendDocument в Telegram — до 50 МБ
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/bot{token}/{method}", self.handle)
+        app.router.add_post("/_inject", self.handle_inject)
+        app.router.add_get("/_stats", self.handle_stats)
+        app.router.add_get("/_messages", self.handle_messages)
+        app.on_cleanup.append(self.close)
+        return app
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--chat-rate", type=float, default=1, help="сообщений/с в один чат, 0 — без лимита")
+    ap.add_argument("--global-rate", type=float, default=30, help="сообщений/с на бота, 0 — без лимита")
+    args = ap.parse_args()
+    web.run_app(FakeTelegram(args.chat_rate, args.global_rate).app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()